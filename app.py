@@ -2,14 +2,22 @@ import streamlit as st
 from pathlib import Path
 import os
 import json
-from db import init_db, load_mock_emails, get_emails, get_email, save_processed, get_processed, get_prompts, save_prompt, save_draft, get_drafts
+import html
+import time
+from db import init_db, load_mock_emails, get_emails, get_email_page, search_emails, get_email, get_inbox_stats, save_processed, get_processed, get_prompts, save_prompt, save_draft, get_drafts
 import llm
-from imap_ingest import fetch_imap_emails
+import llm_async
+import llm_client
+import llm_metrics
+import batch
+import rules
+from imap_ingest import sync_imap, LAZY_BODIES
 import streamlit.components.v1 as components
 
 BASE = Path(__file__).parent
 DATA_DIR = BASE / 'data'
 MOCK_PATH = DATA_DIR / 'mock_emails.json'
+INBOX_PAGE_SIZE = 25
 
 st.set_page_config(page_title='Email Productivity Agent', layout='wide', initial_sidebar_state='expanded')
 
@@ -422,6 +430,8 @@ if 'view_mode' not in st.session_state:
     st.session_state['view_mode'] = 'inbox'  # 'inbox' or 'detail'
 if 'chat_history' not in st.session_state:
     st.session_state.chat_history = []
+if 'inbox_cursors' not in st.session_state:
+    st.session_state['inbox_cursors'] = [None]  # cursor of each visited page; last is current
 
 # Sidebar Configuration
 st.sidebar.markdown("<h2 style='text-align: center; color: #ffffff;'>⚙️ Configuration</h2>", unsafe_allow_html=True)
@@ -445,6 +455,31 @@ if llm_key:
 else:
     st.sidebar.markdown("<div class='warning-badge'>🤖 Mock Mode (No API Key)</div>", unsafe_allow_html=True)
 
+use_cache = st.sidebar.checkbox('♻️ Reuse cached AI responses', value=True, help='Identical analyses are served from the local cache instead of calling the model again.')
+combined_analysis = st.sidebar.checkbox('🔗 Single-call analysis', value=llm.COMBINED_ANALYSIS, help='Categorize and extract tasks with one combined prompt instead of two requests.')
+_stats = llm.cache_stats()
+st.sidebar.caption(f"Cache: {_stats['hits']} hits · {_stats['misses']} misses")
+_prep = llm.preprocess_stats()
+if _prep['emails']:
+    st.sidebar.caption(f"Input tokens saved: {_prep['tokens_saved']:,} of {_prep['tokens_in']:,} · {_prep['truncated']} truncated")
+_rules = rules.stats()
+if _rules['emails']:
+    st.sidebar.caption(f"Rules: {_rules['classified']} of {_rules['emails']} emails ({_rules['share_classified']:.0%}) "
+                       f"classified without AI · {_rules['llm_calls_avoided']} calls avoided")
+
+with st.sidebar.expander('📈 AI Usage (24h)', expanded=False):
+    _usage = llm_metrics.summary(since=time.time() - 86400)
+    if not _usage['calls']:
+        st.caption('No AI calls recorded yet.')
+    else:
+        u1, u2 = st.columns(2)
+        u1.metric('Calls', _usage['calls'], help=f"{_usage['cache_hits']} served from cache")
+        u2.metric('Est. cost', f"${_usage['cost_usd']:.4f}")
+        u1.metric('Tokens', f"{_usage['prompt_tokens'] + _usage['completion_tokens']:,}",
+                  help=f"{_usage['prompt_tokens']:,} prompt · {_usage['completion_tokens']:,} completion")
+        u2.metric('Avg latency', f"{_usage['avg_latency_ms'] / 1000:.1f}s" if _usage['avg_latency_ms'] is not None else '—')
+        st.caption(f"{_usage['errors']} failed · {_usage['parse_fallbacks']} replies not valid JSON")
+
 st.sidebar.markdown('---')
 
 prompts = get_prompts() or {}
@@ -453,12 +488,14 @@ with st.sidebar.expander('📝 Customize AI Prompts', expanded=False):
     st.markdown("*Fine-tune the AI behavior*")
     cat = st.text_area('Categorization', value=prompts.get('categorization_prompt', ''), height=100)
     act = st.text_area('Action Extraction', value=prompts.get('action_item_prompt', ''), height=100)
+    analysis = st.text_area('Combined Analysis', value=prompts.get('analysis_prompt', ''), height=100)
     auto = st.text_area('Auto-Reply', value=prompts.get('auto_reply_prompt', ''), height=100)
     chat_sys = st.text_area('Chat Instructions', value=prompts.get('chat_system_instructions', ''), height=80)
     if st.button('💾 Save Prompts'):
         try:
             save_prompt('categorization_prompt', cat)
             save_prompt('action_item_prompt', act)
+            save_prompt('analysis_prompt', analysis)
             save_prompt('auto_reply_prompt', auto)
             save_prompt('chat_system_instructions', chat_sys)
             st.success('✅ Prompts saved!')
@@ -466,6 +503,25 @@ with st.sidebar.expander('📝 Customize AI Prompts', expanded=False):
         except Exception as e:
             st.error(f'❌ Error: {e}')
 
+with st.sidebar.expander('🧹 Bulk-Mail Rules', expanded=False):
+    st.markdown("*Classify matching emails without calling the AI*")
+    for rule in rules.list_rules():
+        r1, r2 = st.columns([4, 1])
+        r1.caption(f"{rule['field']} ~ `{rule['pattern']}` → **{rule['category']}**")
+        if r2.button('✖', key=f"del_rule_{rule['id']}", help='Delete rule'):
+            rules.delete_rule(rule['id'])
+            st.rerun()
+    rule_field = st.selectbox('Match', rules.FIELDS, help='sender: pattern like *@example.com; subject/body: text contained')
+    rule_pattern = st.text_input('Pattern', placeholder='*@spammy.io')
+    rule_category = st.selectbox('Category', rules.CATEGORIES)
+    if st.button('➕ Add Rule'):
+        try:
+            rules.add_rule(rule_field, rule_pattern, rule_category)
+            st.success('✅ Rule added!')
+            st.rerun()
+        except ValueError as e:
+            st.error(f'❌ {e}')
+
 # Main Header
 st.markdown("""
 <div class='main-header'>
@@ -500,7 +556,7 @@ with st.expander('👋 Quick Start Guide', expanded=False):
     
     if col_b.button('🧪 Test AI', use_container_width=True):
         try:
-            emails_list = get_emails()
+            emails_list = get_emails(limit=1)
             if not emails_list:
                 st.info('💡 Load demo first!')
             else:
@@ -509,8 +565,7 @@ with st.expander('👋 Quick Start Guide', expanded=False):
                 prompts = get_prompts()
                 
                 with st.spinner('🤖 AI Processing...'):
-                    cat_out = llm.categorize(e.get('body',''), prompts.get('categorization_prompt',''))
-                    act_out = llm.extract_actions(e.get('body',''), prompts.get('action_item_prompt',''))
+                    cat_out, act_out = llm_client.submit(llm_async.analyze_email(e.get('body',''), prompts, use_cache=use_cache, combined=combined_analysis, email=e))
                 
                 st.markdown(f"**📧 Test Email:** {e.get('subject')}")
                 col1, col2 = st.columns(2)
@@ -570,6 +625,8 @@ if st.session_state.view_mode == 'inbox':
                 imap_user = st.text_input('Email', value=imap_user_default)
                 imap_pass = st.text_input('Password', type='password', value=imap_pass_default)
                 imap_limit = st.number_input('Max Messages', value=imap_limit_default, min_value=1, max_value=500)
+                imap_headers_only = st.checkbox('Headers first', value=LAZY_BODIES,
+                                                help='Skip attachments; bodies download when an email is opened or analyzed')
                 
                 if provider == 'Gmail':
                     st.info('💡 Use App Password with 2FA')
@@ -593,20 +650,8 @@ if st.session_state.view_mode == 'inbox':
                     if imap_server and imap_user and imap_pass:
                         try:
                             with st.spinner('Fetching...'):
-                                msgs = fetch_imap_emails(imap_server, imap_user, imap_pass, limit=imap_limit)
-                                import sqlite3
-                                init_db()
-                                conn = sqlite3.connect(os.path.join(os.path.dirname(__file__), 'data', 'email_agent.db'))
-                                c = conn.cursor()
-                                for m in msgs:
-                                    c.execute('SELECT 1 FROM emails WHERE id=?', (m['id'],))
-                                    if c.fetchone():
-                                        continue
-                                    c.execute('INSERT INTO emails(id, sender, subject, timestamp, body) VALUES (?, ?, ?, ?, ?)',
-                                              (m['id'], m['sender'], m['subject'], m['timestamp'], m['body']))
-                                conn.commit()
-                                conn.close()
-                            st.success(f'✅ {len(msgs)} fetched!')
+                                result = sync_imap(imap_server, imap_user, imap_pass, limit=imap_limit, headers_only=imap_headers_only)
+                            st.success(f"✅ {result['fetched']} fetched, {result['inserted']} new!")
                             st.rerun()
                         except Exception as e:
                             _friendly_imap_error(e)
@@ -614,19 +659,19 @@ if st.session_state.view_mode == 'inbox':
                         st.error('⚠️ Fill all fields')
     
     # Stats Dashboard
-    emails = get_emails()
+    stats = get_inbox_stats()
     col_s1, col_s2, col_s3 = st.columns(3)
     
     with col_s1:
         st.markdown(f"""
         <div class='metric-card'>
-            <div class='metric-value'>{len(emails)}</div>
+            <div class='metric-value'>{stats['total']}</div>
             <div class='metric-label'>Total Emails</div>
         </div>
         """, unsafe_allow_html=True)
     
     with col_s2:
-        processed_count = sum(1 for e in emails if get_processed(e['id']))
+        processed_count = stats['processed']
         st.markdown(f"""
         <div class='metric-card'>
             <div class='metric-value'>{processed_count}</div>
@@ -635,7 +680,7 @@ if st.session_state.view_mode == 'inbox':
         """, unsafe_allow_html=True)
     
     with col_s3:
-        draft_count = sum(len(get_drafts(e['id']) or []) for e in emails)
+        draft_count = stats['drafts']
         st.markdown(f"""
         <div class='metric-card'>
             <div class='metric-value'>{draft_count}</div>
@@ -643,11 +688,48 @@ if st.session_state.view_mode == 'inbox':
         </div>
         """, unsafe_allow_html=True)
     
+    # Batch processing
+    unprocessed = stats['total'] - stats['processed']
+    if unprocessed > 0:
+        col_b1, col_b2 = st.columns([2, 1])
+        with col_b1:
+            batch_concurrency = st.slider('Parallel requests', min_value=1, max_value=16, value=4, key='batch_concurrency')
+        with col_b2:
+            st.markdown("<br>", unsafe_allow_html=True)
+            if st.button(f'⚡ Process {unprocessed} Unprocessed', use_container_width=True, key='batch_process'):
+                bar = st.progress(0.0, text='Starting...')
+                
+                def _update(p):
+                    bar.progress(p['done'] / max(p['total'], 1), text=f"{p['done']}/{p['total']} processed")
+                
+                result = batch.run_batch(concurrency=batch_concurrency, use_cache=use_cache, combined=combined_analysis, on_progress=_update)
+                if result['failed']:
+                    st.warning(f"⚠️ {result['failed']} emails failed; processed {result['saved']}.")
+                else:
+                    st.success(f"✅ Processed {result['saved']} emails!")
+                st.rerun()
+    
     st.markdown("<br>", unsafe_allow_html=True)
     
+    # Search
+    search_q = st.text_input('Search emails', placeholder='🔎 Search sender, subject or body...', key='inbox_search', label_visibility='collapsed').strip()
+    if search_q != st.session_state.get('inbox_query', ''):
+        st.session_state['inbox_query'] = search_q
+        st.session_state['inbox_cursors'] = [None]
+    cursor = st.session_state['inbox_cursors'][-1]
+    if search_q:
+        page = search_emails(search_q, INBOX_PAGE_SIZE, cursor)
+    else:
+        page = get_email_page(INBOX_PAGE_SIZE, cursor)
+    emails = page['items']
+    
     # Email List with better organization
     if emails:
-        st.markdown(f"<p style='color: #ffffff; font-weight: 600; font-size: 1.1em;'>📨 {len(emails)} Messages</p>", unsafe_allow_html=True)
+        page_no = len(st.session_state['inbox_cursors'])
+        if search_q:
+            st.markdown(f"<p style='color: #ffffff; font-weight: 600; font-size: 1.1em;'>🔎 Results for \"{html.escape(search_q)}\" · Page {page_no}</p>", unsafe_allow_html=True)
+        else:
+            st.markdown(f"<p style='color: #ffffff; font-weight: 600; font-size: 1.1em;'>📨 {stats['total']} Messages · Page {page_no}</p>", unsafe_allow_html=True)
         
         # Show emails in a grid
         for idx, e in enumerate(emails):
@@ -657,12 +739,16 @@ if st.session_state.view_mode == 'inbox':
                 preview = e.get('subject', '(no subject)')[:60]
                 sender = e.get('sender', 'Unknown')
                 timestamp = e.get('timestamp', '')
+                snippet_html = ''
+                if e.get('snippet'):
+                    snippet_html = f"<div style='color: rgba(255, 255, 255, 0.8); font-size: 0.9em; margin-top: 5px;'>{html.escape(e['snippet'])}</div>"
                 
                 st.markdown(f"""
                 <div class='email-preview-card'>
                     <div style='font-weight: 600; font-size: 1.1em; margin-bottom: 5px;'>📧 {preview}</div>
                     <div style='color: rgba(255, 255, 255, 0.7); font-size: 0.9em;'>From: {sender}</div>
                     <div style='color: rgba(255, 255, 255, 0.6); font-size: 0.85em;'>{timestamp}</div>
+                    {snippet_html}
                 </div>
                 """, unsafe_allow_html=True)
             
@@ -672,6 +758,23 @@ if st.session_state.view_mode == 'inbox':
                     st.session_state['view_mode'] = 'detail'
                     st.session_state.chat_history = []
                     st.rerun()
+        
+        # Pagination
+        col_prev, _, col_next = st.columns([1, 4, 1])
+        with col_prev:
+            if page_no > 1 and st.button('← Newer', use_container_width=True, key='inbox_prev'):
+                st.session_state['inbox_cursors'].pop()
+                st.rerun()
+        with col_next:
+            if page['next_cursor'] and st.button('Older →', use_container_width=True, key='inbox_next'):
+                st.session_state['inbox_cursors'].append(page['next_cursor'])
+                st.rerun()
+    elif len(st.session_state['inbox_cursors']) > 1:
+        # the page we were on became empty (e.g. emails removed); start over
+        st.session_state['inbox_cursors'] = [None]
+        st.rerun()
+    elif search_q:
+        st.info("🔎 No emails match your search.")
     else:
         st.info("📭 No emails. Load mock data to start!")
 
@@ -742,12 +845,15 @@ else:
         with col_act1:
             if st.button('🔍 Analyze Email', use_container_width=True):
                 db_prompts = get_prompts()
-                with st.spinner('🤖 Analyzing...'):
-                    categories = llm.categorize(email.get('body',''), db_prompts.get('categorization_prompt', ''))
-                    tasks = llm.extract_actions(email.get('body',''), db_prompts.get('action_item_prompt', ''))
-                    save_processed(selected, categories, tasks)
-                st.success('✅ Analysis complete!')
-                st.rerun()
+                try:
+                    with st.spinner('🤖 Analyzing...'):
+                        categories, tasks = llm_client.submit(llm_async.analyze_email(email.get('body',''), db_prompts, use_cache=use_cache, combined=combined_analysis, email=email))
+                        save_processed(selected, categories, tasks)
+                except llm.LLMError as exc:
+                    st.error(f'⚠️ Analysis failed: {exc}')
+                else:
+                    st.success('✅ Analysis complete!')
+                    st.rerun()
         
         with col_act2:
             tone = st.selectbox('Reply Tone', ['friendly','professional','concise','formal'], key='tone_select')
@@ -755,13 +861,23 @@ else:
         with col_act3:
             if st.button('✍️ Generate Draft', use_container_width=True):
                 db_prompts = get_prompts()
-                with st.spinner('✍️ Drafting...'):
-                    draft = llm.generate_draft(email.get('body',''), db_prompts.get('auto_reply_prompt', ''), tone)
+                preview = st.empty()
+                raw = ''
+                try:
+                    # show the reply body as it streams in
+                    for delta in llm.generate_draft_stream(email.get('body',''), db_prompts.get('auto_reply_prompt', ''), tone, use_cache=use_cache):
+                        raw += delta
+                        preview.text(llm.draft_preview(raw) + '▌')
+                    draft = llm.parse_draft(raw)
+                except llm.LLMError as exc:
+                    preview.empty()
+                    st.error(f'⚠️ Draft failed: {exc}')
+                else:
                     subj = draft.get('subject') or f"Re: {email.get('subject','')}"
                     body = draft.get('body') or draft.get('text') or str(draft)
                     save_draft(selected, subj, body, {'generated_by': 'llm', 'tone': tone})
-                st.success('✅ Draft saved!')
-                st.rerun()
+                    st.success('✅ Draft saved!')
+                    st.rerun()
         
         # View Drafts Section
         st.markdown("<div class='section-header'>📝 Generated Drafts</div>", unsafe_allow_html=True)
@@ -796,10 +912,20 @@ else:
         
         if send_clicked and user_q and user_q.strip():
             db_prompts = get_prompts()
-            with st.spinner('🤖 Thinking...'):
-                answer = llm.chat_with_email(email.get('body',''), db_prompts, user_q)
+            st.markdown(f"<div class='chat-bubble-user'><strong>You:</strong><br>{user_q}</div>", unsafe_allow_html=True)
+            bubble = st.empty()
+            answer = ''
+            try:
+                for delta in llm.chat_with_email_stream(email.get('body',''), db_prompts, user_q):
+                    answer += delta
+                    bubble.markdown(f"<div class='chat-bubble-assistant'><strong>AI:</strong><br>{answer}▌</div>", unsafe_allow_html=True)
+            except llm.LLMError as exc:
+                # failed replies are not added to the history
+                bubble.empty()
+                st.error(f'⚠️ Chat failed: {exc}')
+            else:
                 st.session_state.chat_history.append({'user': user_q, 'assistant': answer})
-            st.rerun()
+                st.rerun()
         
         if st.session_state.chat_history:
             if st.button('🗑️ Clear Chat History'):
@@ -824,13 +950,13 @@ else:
                         tester_prompt = get_prompts().get(prompt_type, '')
                         
                         if prompt_type == 'categorization_prompt':
-                            out = llm.categorize(tester_input, tester_prompt)
+                            out = llm.categorize(tester_input, tester_prompt, use_cache=use_cache)
                             st.markdown("**📊 Categorization Results:**")
                         elif prompt_type == 'action_item_prompt':
-                            out = llm.extract_actions(tester_input, tester_prompt)
+                            out = llm.extract_actions(tester_input, tester_prompt, use_cache=use_cache)
                             st.markdown("**✅ Extracted Actions:**")
                         elif prompt_type == 'auto_reply_prompt':
-                            out = llm.generate_draft(tester_input, tester_prompt, test_tone)
+                            out = llm.generate_draft(tester_input, tester_prompt, test_tone, use_cache=use_cache)
                             st.markdown("**✍️ Generated Draft:**")
                         else:
                             out = llm.chat_with_email(tester_input, get_prompts(), 'Summarize this content')
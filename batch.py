@@ -0,0 +1,143 @@
+"""
+Bulk processing of unprocessed emails (categorize + extract actions).
+
+Emails the rules classifier (rules.py) is sure about are categorized
+locally; the rest are analyzed concurrently through llm_async with a bounded
+number of in-flight requests and an optional requests-per-minute limit.
+Results are written to the `processed` table in batched transactions.
+Bodies of header-first IMAP emails are downloaded up front, one pipelined
+fill_bodies pass per mailbox, instead of one IMAP round trip per email.
+
+Functions:
+- process_unprocessed(...) (async) / run_batch(...) (sync wrapper)
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import db
+import imap_ingest
+import llm
+import llm_async
+import llm_client
+import rules
+
+log = logging.getLogger(__name__)
+
+
+def requests_per_email(combined: Optional[bool] = None) -> int:
+    # categorize + extract_actions, unless the combined analysis prompt is used
+    if combined is None:
+        combined = llm.COMBINED_ANALYSIS
+    return 1 if combined else 2
+
+
+class RateLimiter:
+    """Spaces out acquisitions so no more than `per_minute` happen in any minute."""
+
+    def __init__(self, per_minute: Optional[float]):
+        self.interval = 60.0 / per_minute if per_minute else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, cost: int = 1):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval * cost
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+def _prefetch_bodies(emails: List[Dict[str, Any]]):
+    """Download missing bodies for `emails` with one fill_bodies pass per
+    account/mailbox; whatever fails is left to the lazy per-email download."""
+    by_mailbox: Dict[tuple, List[int]] = {}
+    for e in emails:
+        if e.get('body_fetched') is False and e.get('account'):
+            by_mailbox.setdefault((e['account'], e['mailbox']), []).append(e['id'])
+    for (account, mailbox), email_ids in by_mailbox.items():
+        creds = imap_ingest.credentials_for(account)
+        if creds is None:
+            continue
+        try:
+            imap_ingest.fill_bodies(*creds, mailbox=mailbox, email_ids=email_ids)
+        except Exception as e:
+            log.warning('Body prefetch for %s/%s failed: %s', account, mailbox, e)
+
+
+def new_progress(total: int) -> Dict[str, Any]:
+    return {'total': total, 'done': 0, 'failed': 0, 'saved': 0, 'status': 'running', 'started_at': time.time(), 'finished_at': None}
+
+
+async def process_emails(emails: List[Dict[str, Any]], prompts: Dict[str, str], concurrency: int = 4,
+                         requests_per_minute: Optional[float] = None, use_cache: bool = True,
+                         combined: Optional[bool] = None, flush_every: int = 25, progress: Optional[Dict[str, Any]] = None,
+                         on_progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """Analyze `emails` and persist the results; returns the progress dict.
+
+    `progress` is updated in place as emails complete so callers can poll it;
+    `on_progress` is called after each email.
+    """
+    progress = progress if progress is not None else new_progress(len(emails))
+    limiter = RateLimiter(requests_per_minute)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    pending: List[tuple] = []
+    await asyncio.to_thread(_prefetch_bodies, emails)
+
+    def flush():
+        if pending:
+            db.save_processed_many(pending)
+            progress['saved'] += len(pending)
+            pending.clear()
+
+    async def worker(e):
+        async with semaphore:
+            try:
+                if e.get('body_fetched') is False:
+                    # header-first IMAP ingestion: stored by the prefetch, or downloaded now
+                    e = {**e, 'body': (await asyncio.to_thread(db.get_email, e['id'])).get('body', '')}
+                # obvious bulk mail is classified locally and takes no rate limit budget
+                categories = rules.classify(e, requests_per_email(combined))
+                if categories is not None:
+                    tasks = []
+                else:
+                    await limiter.acquire(requests_per_email(combined))
+                    categories, tasks = await llm_async.analyze_email(e.get('body', ''), prompts, use_cache=use_cache,
+                                                                      combined=combined)
+            except Exception:
+                progress['failed'] += 1
+            else:
+                pending.append((e['id'], categories, tasks))
+                if len(pending) >= flush_every:
+                    flush()
+            progress['done'] += 1
+            if on_progress:
+                on_progress(progress)
+
+    try:
+        await asyncio.gather(*(worker(e) for e in emails))
+        flush()
+        progress['status'] = 'finished'
+    except Exception as exc:
+        progress['status'] = 'error'
+        progress['error'] = str(exc)
+        raise
+    finally:
+        progress['finished_at'] = time.time()
+    return progress
+
+
+async def process_unprocessed(limit: Optional[int] = None, sender: Optional[str] = None,
+                              email_ids: Optional[List[int]] = None, **kwargs) -> Dict[str, Any]:
+    """Process every email (or the filtered subset) not yet in `processed`."""
+    emails = db.get_unprocessed_emails(limit=limit, sender=sender, email_ids=email_ids)
+    return await process_emails(emails, db.get_prompts(), **kwargs)
+
+
+def run_batch(**kwargs) -> Dict[str, Any]:
+    """Blocking wrapper around process_unprocessed for non-async callers."""
+    return llm_client.run(process_unprocessed(**kwargs))
@@ -0,0 +1,82 @@
+"""
+Benchmark: email ingestion throughput of db.save_emails (duplicate ids looked
+up in one pass, then executemany + INSERT OR IGNORE in one transaction)
+versus the original save_emails (its own connection, SELECT-then-INSERT per
+row), both on the current schema with its indexes and FTS triggers.
+Run: `python benchmarks/bench_bulk_ingest.py [--sizes 1000 10000 100000] [--repeat 3]`
+Each size is ingested into a fresh temporary database, then re-ingested to
+measure the all-duplicates path; the two versions alternate and the median
+of --repeat runs is reported.
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import db
+
+
+def _make_emails(n):
+    return [{'id': i, 'sender': f'user{i % 500}@example.com', 'subject': f'Subject {i}',
+             'timestamp': f'2025-11-{i % 28 + 1:02d}T09:{i % 60:02d}:00', 'body': 'Lorem ipsum ' * 40}
+            for i in range(1, n + 1)]
+
+
+def _baseline_save(emails):
+    # save_emails as it was before the connection pool and the bulk path
+    db.init_db()
+    conn = sqlite3.connect(db.DB_PATH)
+    c = conn.cursor()
+    for e in emails:
+        if not e or 'id' not in e:
+            continue
+        c.execute('SELECT 1 FROM emails WHERE id=?', (e['id'],))
+        if c.fetchone():
+            continue
+        c.execute(
+            'INSERT INTO emails(id, sender, subject, timestamp, body) VALUES (?, ?, ?, ?, ?)',
+            (e.get('id'), e.get('sender', ''), e.get('subject', ''), e.get('timestamp', ''), e.get('body', ''))
+        )
+    conn.commit()
+    conn.close()
+
+
+def _run(fn, emails):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        db.init_db()
+        start = time.perf_counter()
+        fn(emails)
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        fn(emails)
+        again = time.perf_counter() - start
+        db.close_db()
+    return len(emails) / first, len(emails) / again
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    versions = [('baseline', _baseline_save), ('bulk', db.save_emails)]
+    for n in args.sizes:
+        emails = _make_emails(n)
+        results = {label: [] for label, _ in versions}
+        for _ in range(args.repeat):
+            for label, fn in versions:
+                results[label].append(_run(fn, emails))
+        for label, runs in results.items():
+            first = statistics.median(r[0] for r in runs)
+            again = statistics.median(r[1] for r in runs)
+            print(f'{label:<9} n={n:<7} insert {first:10.0f} msg/s   re-ingest {again:10.0f} msg/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark: two-call analysis (categorization_prompt + action_item_prompt)
+versus the single combined analysis_prompt, over data/mock_emails.json.
+Run: `python benchmarks/bench_combined_analysis.py [--limit 15]`
+Requires OPENAI_API_KEY for latency and token usage; without a key it only
+prints the estimated input size of each approach (about 4 chars per token).
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import llm
+import llm_client
+
+BASE = os.path.join(os.path.dirname(__file__), '..')
+
+
+def _load():
+    with open(os.path.join(BASE, 'data', 'mock_emails.json'), 'r', encoding='utf-8') as f:
+        emails = json.load(f)
+    with open(os.path.join(BASE, 'prompts', 'default_prompts.json'), 'r', encoding='utf-8') as f:
+        prompts = json.load(f)
+    return emails, prompts
+
+
+def _requests(body, prompts, combined):
+    if combined:
+        return [(llm._analysis_messages(body, prompts['analysis_prompt']), 800)]
+    return [(llm._categorize_messages(body, prompts['categorization_prompt']), 300),
+            (llm._extract_messages(body, prompts['action_item_prompt']), 500)]
+
+
+def _chars(messages):
+    return sum(len(m['content']) for m in messages)
+
+
+def _run(client, body, prompts, combined):
+    # calls the API directly (no cache) so usage numbers are available
+    latency, prompt_tokens, completion_tokens = 0.0, 0, 0
+    for messages, max_tokens in _requests(body, prompts, combined):
+        start = time.perf_counter()
+        resp = client.chat.completions.create(model=llm.OPENAI_MODEL, messages=messages,
+                                              temperature=0.0, max_tokens=max_tokens)
+        latency += time.perf_counter() - start
+        prompt_tokens += resp.usage.prompt_tokens
+        completion_tokens += resp.usage.completion_tokens
+    return latency, prompt_tokens, completion_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=15)
+    args = parser.parse_args()
+    emails, prompts = _load()
+    emails = emails[:args.limit]
+
+    for combined in (False, True):
+        label = 'combined' if combined else 'two-call'
+        chars = sum(_chars(m) for e in emails for m, _ in _requests(e['body'], prompts, combined))
+        print(f'{label:<9} requests={len(emails) * (1 if combined else 2):<4} est. input tokens={chars // 4}')
+
+    client = llm_client.sync_client(llm.OPENAI_KEY)
+    if llm.IS_MOCK or client is None:
+        print('\nOPENAI_API_KEY not set: skipping latency/usage measurement.')
+        return
+
+    print()
+    for combined in (False, True):
+        label = 'combined' if combined else 'two-call'
+        runs = [_run(client, e['body'], prompts, combined) for e in emails]
+        print(f'{label:<9} median latency {statistics.median(r[0] for r in runs):6.2f}s  '
+              f'prompt tokens {sum(r[1] for r in runs):6d}  completion tokens {sum(r[2] for r in runs):6d}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark: per-call latency of db.py reads/writes with the pooled
+connection layer versus the old connect-and-init-on-every-call pattern.
+Run: `python benchmarks/bench_db_connections.py [--calls 2000]`
+Then checks that connections opened by short-lived threads are closed when
+the threads exit.
+Uses a temporary database; the real data/email_agent.db is never touched.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import db
+import db_pool
+
+
+LEGACY_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS emails (id INTEGER PRIMARY KEY, sender TEXT, subject TEXT, timestamp TEXT, body TEXT)',
+    'CREATE TABLE IF NOT EXISTS processed (email_id INTEGER PRIMARY KEY, categories TEXT, tasks TEXT)',
+    'CREATE TABLE IF NOT EXISTS prompts (name TEXT PRIMARY KEY, content TEXT)',
+    'CREATE TABLE IF NOT EXISTS drafts (id INTEGER PRIMARY KEY AUTOINCREMENT, email_id INTEGER, subject TEXT, body TEXT, metadata TEXT)',
+)
+
+
+def _legacy_get_email(path, email_id):
+    # mirrors the previous db.py: fresh connection + CREATE TABLE checks per call
+    conn = sqlite3.connect(path)
+    for stmt in LEGACY_SCHEMA:
+        conn.execute(stmt)
+    conn.commit()
+    r = conn.execute('SELECT id, sender, subject, timestamp, body FROM emails WHERE id=?', (email_id,)).fetchone()
+    conn.close()
+    return r
+
+
+def _legacy_save_processed(path, email_id):
+    conn = sqlite3.connect(path)
+    conn.execute('REPLACE INTO processed(email_id, categories, tasks) VALUES (?, ?, ?)', (email_id, '{}', '[]'))
+    conn.commit()
+    conn.close()
+
+
+def _time(label, fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i % 100 + 1)
+    elapsed = time.perf_counter() - start
+    print(f'{label:<32} {elapsed / calls * 1e6:9.1f} us/call')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        db.save_emails([{'id': i, 'sender': f's{i}@example.com', 'subject': f'Subject {i}',
+                         'timestamp': f'2025-11-01T00:{i % 60:02d}:00', 'body': 'x' * 500} for i in range(1, 101)])
+
+        print(f'{args.calls} calls each\n')
+        _time('get_email (legacy)', lambda i: _legacy_get_email(db.DB_PATH, i), args.calls)
+        _time('get_email (pooled)', db.get_email, args.calls)
+        _time('save_processed (legacy)', lambda i: _legacy_save_processed(db.DB_PATH, i), args.calls)
+        _time('save_processed (pooled)', lambda i: db.save_processed(i, {}, []), args.calls)
+
+        open_fds = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        for _ in range(20):
+            thread = threading.Thread(target=db.get_email, args=(1,))
+            thread.start()
+            thread.join()
+        assert len(db_pool._threads) <= 1, len(db_pool._threads)
+        if open_fds is not None:
+            assert len(os.listdir('/proc/self/fd')) <= open_fds + 1
+        print('20 short-lived threads: their connections closed on exit')
+        db.close_db()
+
+
+if __name__ == '__main__':
+    main()
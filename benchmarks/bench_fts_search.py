@@ -0,0 +1,105 @@
+"""
+Benchmark: db.search_emails latency on a large synthetic mailbox.
+Run: `python benchmarks/bench_fts_search.py [--size 500000] [--runs 20]`
+Builds the corpus in a temporary database through db.save_emails (so the
+FTS triggers do the indexing), then times first-page and second-page
+queries for rare, medium and common terms. First checks on a small mailbox
+that following next_cursor returns every match exactly once, across the
+end of the ranked window.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import db
+
+WORDS = ('project deployment invoice meeting review budget release schedule payment customer '
+         'report quarterly roadmap design security incident outage migration contract renewal '
+         'newsletter offer discount password reset onboarding hiring feedback survey travel').split()
+QUERIES = ('orion', 'invoice overdue', 'project', 'payment customer')
+
+
+def _make_emails(n, seed=7):
+    rnd = random.Random(seed)
+    for i in range(1, n + 1):
+        words = rnd.choices(WORDS, k=60)
+        if i % 5000 == 0:
+            words.append('orion')  # rare term
+        if i % 50 == 0:
+            words.append('overdue')
+        yield {'id': i, 'sender': f'user{i % 2000}@example.com', 'subject': ' '.join(words[:6]),
+               'timestamp': f'2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}T09:00:00', 'body': ' '.join(words)}
+
+
+def _build(n, chunk=20000):
+    batch = []
+    for e in _make_emails(n):
+        batch.append(e)
+        if len(batch) == chunk:
+            db.save_emails(batch)
+            batch = []
+    if batch:
+        db.save_emails(batch)
+
+
+def _time_query(q, runs, cursor=None):
+    samples = []
+    page = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        page = db.search_emails(q, limit=20, cursor=cursor)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples), page
+
+
+def _check_paging(tmp, matches=30, window=10):
+    db.DB_PATH = os.path.join(tmp, 'paging.db')
+    db.save_emails([{'id': i, 'sender': 'a@example.com', 'subject': f'orion {i}', 'body': 'orion ' * (i % 4 + 1),
+                     'timestamp': f'2025-01-01T00:00:{i % 60:02d}'} for i in range(1, matches + 1)])
+    saved, db.SEARCH_RANK_WINDOW = db.SEARCH_RANK_WINDOW, window
+    try:
+        for limit in (1, 3, 5, 7, 10, 20, 30, 50):
+            ids, cursor = [], None
+            while True:
+                page = db.search_emails('orion', limit=limit, cursor=cursor)
+                ids += [item['id'] for item in page['items']]
+                cursor = page['next_cursor']
+                if not cursor:
+                    break
+            assert sorted(ids) == list(range(1, matches + 1)), (limit, ids)
+    finally:
+        db.SEARCH_RANK_WINDOW = saved
+        db.close_db()
+    print(f'paging: {matches} matches, rank window {window}: every match once for every page size\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=500000)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _check_paging(tmp)
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        start = time.perf_counter()
+        _build(args.size)
+        print(f'indexed {args.size} emails in {time.perf_counter() - start:.1f}s\n')
+        for q in QUERIES:
+            median, worst, page = _time_query(q, args.runs)
+            line = f'{q!r:<18} page1 median {median:7.1f} ms  max {worst:7.1f} ms'
+            if page['next_cursor']:
+                median, worst, _ = _time_query(q, args.runs, page['next_cursor'])
+                line += f'   page2 median {median:7.1f} ms'
+            print(line)
+        db.close_db()
+
+
+if __name__ == '__main__':
+    main()
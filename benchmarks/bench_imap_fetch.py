@@ -0,0 +1,84 @@
+"""
+Benchmark: IMAP ingestion throughput at different UID FETCH batch sizes
+against a local stand-in server with simulated per-command latency. Also
+checks that a batch the server refuses raises instead of going missing and
+that sync_imap does not move its checkpoint past it.
+Run: `python benchmarks/bench_imap_fetch.py [--messages 500] [--latency 0.02] [--batch-sizes 1 10 50 200]`
+"""
+import argparse
+import imaplib
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['IMAP_SSL'] = '0'
+
+import db
+import imap_ingest
+from fake_imap_server import FakeIMAPServer, make_message
+
+
+def _check_refused_batch(srv):
+    srv.fail_fetches = 1
+    try:
+        imap_ingest.fetch_imap_emails(srv.address, 'bench', 'bench', limit=20, batch_size=10)
+    except imaplib.IMAP4.error as exc:
+        print(f'refused batch: raises ({exc})')
+    else:
+        raise AssertionError('a UID FETCH answered with NO was silently skipped')
+    finally:
+        srv.fail_fetches = 0
+
+
+def _check_sync_checkpoint(srv):
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, 'bench.db')
+        first = imap_ingest.sync_imap(srv.address, 'bench', 'bench', limit=10, batch_size=10)
+        inbox = srv.mailboxes['INBOX']
+        for i in range(10):
+            inbox.append(make_message(len(inbox.messages) + 1))
+        srv.fail_fetches = 1
+        try:
+            imap_ingest.sync_imap(srv.address, 'bench', 'bench', limit=10, batch_size=10)
+        except imaplib.IMAP4.error:
+            pass
+        finally:
+            srv.fail_fetches = 0
+        state = db.get_sync_state(first['account'], 'INBOX')
+        assert state['last_uid'] == first['last_uid'], 'checkpoint moved past a refused batch'
+        resumed = imap_ingest.sync_imap(srv.address, 'bench', 'bench', limit=10, batch_size=10)
+        assert resumed['since_uid'] == first['last_uid'] and resumed['inserted'] == 10
+        db.close_db()
+    print(f'refused batch during sync: checkpoint kept at UID {first["last_uid"]}, resumed from there')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated seconds per IMAP command')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 50, 200])
+    args = parser.parse_args()
+
+    srv = FakeIMAPServer(latency=args.latency).start()
+    try:
+        for i in range(1, args.messages + 1):
+            srv.mailboxes['INBOX'].append(make_message(i))
+        print(f'{args.messages} messages, {args.latency * 1000:.0f} ms per command\n')
+        for batch_size in args.batch_sizes:
+            start = time.perf_counter()
+            emails = imap_ingest.fetch_imap_emails(srv.address, 'bench', 'bench', limit=args.messages,
+                                                   batch_size=batch_size)
+            elapsed = time.perf_counter() - start
+            assert len(emails) == args.messages
+            print(f'batch={batch_size:<5} {elapsed:7.2f}s  {len(emails) / elapsed:8.1f} msg/s')
+        print()
+        _check_refused_batch(srv)
+        _check_sync_checkpoint(srv)
+    finally:
+        srv.stop()
+
+
+if __name__ == '__main__':
+    main()
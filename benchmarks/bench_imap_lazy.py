@@ -0,0 +1,63 @@
+"""
+Benchmark: full RFC822 ingestion versus header-first ingestion (BODYSTRUCTURE
++ From/Subject/Date) on messages with PDF attachments, against the local
+stand-in server. Reports wall time and bytes sent by the server, plus the
+cost of opening a few emails on demand (db.get_email, one reused connection)
+and of the later text-only body pass (imap_ingest.fill_bodies).
+Run: `python benchmarks/bench_imap_lazy.py [--messages 200] [--attachment-kb 500] [--latency 0.02]`
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['IMAP_SSL'] = '0'
+
+import db
+import imap_ingest
+from fake_imap_server import FakeIMAPServer, make_message
+
+
+def _measure(srv, fn):
+    sent = srv.bytes_sent
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start, srv.bytes_sent - sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--attachment-kb', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated seconds per IMAP command')
+    args = parser.parse_args()
+
+    srv = FakeIMAPServer(latency=args.latency).start()
+    try:
+        for i in range(1, args.messages + 1):
+            # every other message carries an attachment
+            srv.mailboxes['INBOX'].append(make_message(i, attachment_size=args.attachment_kb * 1024 if i % 2 else 0))
+        print(f'{args.messages} messages, {args.attachment_kb} KB attachment on half, '
+              f'{args.latency * 1000:.0f} ms per command\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            for headers_only in (False, True):
+                db.DB_PATH = os.path.join(tmp, f'bench_{headers_only}.db')
+                label = 'header-first' if headers_only else 'full'
+                _, elapsed, sent = _measure(srv, lambda: imap_ingest.sync_imap(
+                    srv.address, 'bench', 'bench', limit=args.messages, headers_only=headers_only))
+                print(f'{label:<13} listing {elapsed:6.2f}s  {sent / 1e6:8.2f} MB')
+                if headers_only:
+                    logins = srv.logins
+                    _, elapsed, sent = _measure(srv, lambda: [db.get_email(i) for i in range(1, 11)])
+                    print(f'{"":<13} 10 opens {elapsed:5.2f}s  {sent / 1e6:8.2f} MB  ({srv.logins - logins} login)')
+                    result, elapsed, sent = _measure(srv, lambda: imap_ingest.fill_bodies(srv.address, 'bench', 'bench'))
+                    print(f'{"":<13} bodies  {elapsed:6.2f}s  {sent / 1e6:8.2f} MB  ({result["filled"]} filled)')
+                db.close_db()
+    finally:
+        srv.stop()
+
+
+if __name__ == '__main__':
+    main()
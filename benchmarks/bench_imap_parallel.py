@@ -0,0 +1,59 @@
+"""
+Benchmark: imap_sync.sync_sources over several accounts and mailboxes with
+different worker counts, against the local stand-in server with simulated
+per-command latency. Prints wall time and per-source throughput.
+Run: `python benchmarks/bench_imap_parallel.py [--accounts 3] [--mailboxes 3] [--messages 100] [--workers 1 4 8]`
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['IMAP_SSL'] = '0'
+
+import db
+import imap_ingest
+import imap_sync
+from fake_imap_server import FakeIMAPServer, Mailbox, make_message
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--accounts', type=int, default=3)
+    parser.add_argument('--mailboxes', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=100, help='messages per mailbox')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated seconds per IMAP command')
+    parser.add_argument('--batch', type=int, default=20, help='IMAP_FETCH_BATCH for the run')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    args = parser.parse_args()
+
+    imap_ingest.FETCH_BATCH_SIZE = args.batch
+    srv = FakeIMAPServer(latency=args.latency).start()
+    names = ['INBOX'] + [f'Label {n}' for n in range(1, args.mailboxes)]
+    for name in names:
+        srv.mailboxes[name] = Mailbox()
+        for i in range(1, args.messages + 1):
+            srv.mailboxes[name].append(make_message(i))
+    # every "account" is a different username on the same server
+    sources = [{'server': srv.address, 'username': f'user{a}', 'password': 'x', 'mailbox': m}
+               for a in range(args.accounts) for m in names]
+    print(f'{len(sources)} sources x {args.messages} messages, {args.latency * 1000:.0f} ms per command\n')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for workers in args.workers:
+                db.DB_PATH = os.path.join(tmp, f'bench_{workers}.db')
+                start = time.perf_counter()
+                progress = imap_sync.sync_sources(sources, max_workers=workers, limit=args.messages)
+                elapsed = time.perf_counter() - start
+                rates = [s['msgs_per_sec'] or 0 for s in progress['sources']]
+                print(f'workers={workers:<3} {elapsed:6.2f}s  total {progress["fetched"] / elapsed:7.1f} msg/s  '
+                      f'per source {min(rates):6.1f}-{max(rates):6.1f} msg/s  failed={progress["failed_sources"]}')
+                db.close_db()
+    finally:
+        srv.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Benchmark: llm._parse_json_response (bracket scanner + raw_decode + schema
+validation) against the previous greedy-regex version, on a corpus of messy
+model outputs: JSON in code fences, prose with braces before and after it,
+several JSON values, Python-style quotes, apostrophes, truncated output and
+long chatty replies. Reports time per call and how many outputs each version
+parses to the expected value (None: falls back to the raw text), then checks
+that adversarial input (thousands of invalid candidates, deep nesting) is
+handled in linear time without errors and that stray or quoted brackets
+do not hide the value.
+Run: `python benchmarks/bench_json_extract.py [--repeat 200]`
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import llm
+
+CATEGORIES = {'categories': ['Meeting', 'Action Required'], 'confidence': 0.8, 'notes': "Asks for the team's slides."}
+TASKS = [{'task': 'Send the Q3 deck', 'assignee': 'Bob', 'due': '2025-10-03', 'context': 'board packet {draft}'},
+         {'task': 'Book room', 'assignee': '', 'due': '', 'context': 'design review'}]
+DRAFT = {'subject': 'Re: Design review', 'body': 'Hi Alice,\n\nWednesday works. I\'ll bring the mocks.\n\nBest,\nSam',
+         'followups': ['Share the agenda']}
+
+
+def _legacy_extract(text: str):
+    json_match = re.search(r'({[\s\S]*}|\[[\s\S]*\])', text)
+    if not json_match:
+        return None
+    jtext = json_match.group(1)
+    try:
+        return json.loads(jtext)
+    except Exception:
+        try:
+            return json.loads(jtext.replace("'", '"'))
+        except Exception:
+            return None
+
+
+def _legacy_parse(text: str, task: str):
+    # the old _parse_json_response: extractor, then json.loads of the whole text
+    parsed = _legacy_extract(text)
+    if parsed is not None:
+        return parsed
+    try:
+        return json.loads(text)
+    except Exception:
+        return None
+
+
+def _corpus(rng: random.Random):
+    """(task, output, expected value) triples."""
+    chatter = ('Sure! I looked at the {email} you sent and grouped things [roughly] by urgency. '
+               'Let me know if you want changes. ') * 20
+    cases = []
+    for task, value in (('categorize', CATEGORIES), ('extract', TASKS), ('draft', DRAFT)):
+        dumped = json.dumps(value)
+        pretty = json.dumps(value, indent=2)
+        cases += [(task, text, expected) for text, expected in (
+            (dumped, value),
+            (f'```json\n{pretty}\n```', value),
+            (f'Here is the result:\n{pretty}\nHope this helps {{smile}}!', value),
+            (f'{chatter}\n{dumped}\n{chatter}', value),
+            (f'{dumped}\n\nAlternatively: {dumped}', value),
+            (f'Note [1]: see below.\n{dumped}', value),
+            (repr(value), value),
+            (f'Result: {dumped[:len(dumped) * 2 // 3]}', None),
+            (f'{chatter}No structured data found.', None),
+        )]
+    rng.shuffle(cases)
+    return cases
+
+
+def _new_parse(text: str, task: str):
+    return llm._parse_json_response(text, task, lambda t: None)
+
+
+def _run(name, fn, corpus, repeat):
+    correct = sum(fn(text, task) == expected for task, text, expected in corpus)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for task, text, _expected in corpus:
+            fn(text, task)
+    per_call = (time.perf_counter() - start) / (repeat * len(corpus)) * 1e6
+    print(f'{name:<24} {per_call:8.1f} us/call   {correct}/{len(corpus)} parsed as expected')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    corpus = _corpus(random.Random(0))
+    _run('regex (previous)', _legacy_parse, corpus, args.repeat)
+    _run('single-pass scanner', _new_parse, corpus, args.repeat)
+
+    # near misses normalized by llm_schemas
+    assert _new_parse('["Meeting"]', 'categorize') == {'categories': ['Meeting']}
+    assert _new_parse('{"tasks": [{"task": "Call Bob"}]}', 'extract')[0]['assignee'] == ''
+    assert _new_parse('{"category": "Urgent", "confidence": "0.7"}', 'categorize')['confidence'] == 0.7
+    assert _new_parse('{"summary": "no body"}', 'draft') is None
+    print('schema validation: near misses normalized, wrong shapes rejected')
+
+    extract = llm._extract_json_from_text
+    assert extract('Items: [1) first. Then {"categories": ["A"]}') == {'categories': ['A']}
+    assert extract("Items: [1) first. Then {'a': 'it}s'}") == {'a': 'it}s'}
+    assert extract("{'a': 'it{s'}") == {'a': 'it{s'}
+    assert extract('Result: {"categories": ["Meeting"], "confidence": 0.') is None
+    assert extract("Result: {'categories': ['Meeting'], 'notes': 'cut") is None
+    print('stray brackets looked past, quoted brackets in literals skipped, cut-off output rejected')
+
+    timings = []
+    for n in (10000, 40000):
+        start = time.perf_counter()
+        assert _new_parse('{"k": [1, 2, x]} ' * n, 'categorize') is None
+        timings.append(time.perf_counter() - start)
+    print(f'invalid candidates x10k {timings[0]:.2f}s, x40k {timings[1]:.2f}s (linear: ~4x)')
+    assert timings[1] < timings[0] * 8
+    for depth in (1000, 5000):
+        assert _new_parse('[' * depth + ']' * depth, 'categorize') is None
+        assert _new_parse('Here: ' + '{"a": ' * depth, 'draft') is None
+    print('nesting 1000/5000 deep: falls back to raw text')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Check: OpenAI failure handling (llm_resilience) against a local fake API
+that answers with scripted 429s, 5xx errors, rejected requests and dropped
+connections. Verifies retries honor Retry-After, permanent errors are not
+retried, the circuit breaker opens and recovers, streams retry before the
+first chunk, and failed calls never reach the response cache.
+Run: `python benchmarks/bench_llm_resilience.py`
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+# must be set before llm creates its clients
+os.environ['OPENAI_API_KEY'] = 'test-key'
+os.environ.setdefault('LLM_BACKOFF_BASE', '0.05')
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai_server import FakeOpenAIServer
+
+import db
+import llm
+import llm_async
+import llm_client
+import llm_resilience
+
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def _run(name, srv, script, fn):
+    srv.script.clear()
+    srv.script.extend(script)
+    before = srv.requests
+    start = time.perf_counter()
+    try:
+        outcome = fn()
+    except llm.LLMError as exc:
+        outcome = exc
+    elapsed = time.perf_counter() - start
+    label = type(outcome).__name__ if isinstance(outcome, Exception) else 'ok'
+    print(f'{name:<34} {label:<18} requests {srv.requests - before}   {elapsed:5.2f}s')
+    return outcome, srv.requests - before, elapsed
+
+
+def main():
+    srv = FakeOpenAIServer(reply='{"categories": ["Test"], "confidence": 0.9}').start()
+    llm_client.BASE_URL = srv.base_url
+    llm_client.close()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            db.init_db()
+
+            out, n, elapsed = _run('429 + Retry-After: 1, then ok', srv, [(429, 1)],
+                                   lambda: llm._call_openai(MESSAGES))
+            assert not isinstance(out, Exception) and n == 2 and elapsed >= 1.0
+
+            out, n, _ = _run('500, 503, then ok', srv, [(500, None), (503, None)],
+                             lambda: llm._call_openai(MESSAGES))
+            assert not isinstance(out, Exception) and n == 3
+
+            out, n, _ = _run('dropped connection, then ok', srv, ['disconnect'],
+                             lambda: llm._call_openai(MESSAGES))
+            assert not isinstance(out, Exception) and n == 2
+
+            out, n, _ = _run('400 (not retried)', srv, [(400, None)],
+                             lambda: llm.categorize('hello', 'classify', use_cache=True))
+            assert isinstance(out, llm.PermanentError) and n == 1
+            key = llm.cache_key('categorize', llm._categorize_messages('hello', 'classify'), 0.0, 300)
+            assert db.get_cached_response(key, 3600) is None, 'failed call was cached'
+
+            out, n, _ = _run('500 on every retry', srv, [(500, None)] * (llm_resilience.MAX_RETRIES + 1),
+                             lambda: llm._call_openai(MESSAGES))
+            assert isinstance(out, llm.TransientError) and n == llm_resilience.MAX_RETRIES + 1
+            # that also tripped the breaker (default threshold 5); close it again
+            assert llm_resilience.breaker.state == 'open'
+            llm_resilience.breaker.record_success()
+
+            out, n, _ = _run('stream: 503, then ok', srv, [(503, None)],
+                             lambda: ''.join(llm.chat_with_email_stream('hello', {}, 'summarize')))
+            assert out == srv.reply and n == 2
+
+            out, n, _ = _run('async: 429, then ok', srv, [(429, 0)],
+                             lambda: asyncio.run(llm_async._call_openai(MESSAGES)))
+            assert out == srv.reply and n == 2
+
+            # circuit breaker: three consecutive failures open it for 0.5s
+            llm_resilience.breaker = llm_resilience.CircuitBreaker(3, 0.5)
+            retries, llm_resilience.MAX_RETRIES = llm_resilience.MAX_RETRIES, 0
+            for _ in range(3):
+                _run('breaker: 500', srv, [(500, None)], lambda: llm._call_openai(MESSAGES))
+            out, n, _ = _run('breaker open (fails fast)', srv, [], lambda: llm._call_openai(MESSAGES))
+            assert isinstance(out, llm.CircuitOpenError) and n == 0
+            time.sleep(0.5)
+            out, n, _ = _run('breaker half-open trial', srv, [], lambda: llm._call_openai(MESSAGES))
+            assert not isinstance(out, Exception) and n == 1 and llm_resilience.breaker.state == 'closed'
+            llm_resilience.MAX_RETRIES = retries
+
+            bucket = llm_resilience.TokenBucket(60)
+            waits = [bucket.reserve(1) for _ in range(61)]
+            print(f'{"token bucket 60/min, 61 requests":<34} last wait {waits[-1]:.2f}s')
+            assert waits[59] == 0 and 0.9 < waits[60] <= 1.0
+            print('status', llm_resilience.status())
+            db.close_db()
+    finally:
+        srv.stop()
+
+
+if __name__ == '__main__':
+    main()
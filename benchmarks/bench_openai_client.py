@@ -0,0 +1,134 @@
+"""
+Benchmark: OpenAI client reuse (llm_client) against a client built per request,
+for threaded sync calls and concurrent async calls, using the local fake API
+(fake_openai_server.py). Reports throughput and how many TCP connections the
+server accepted, checks that llm_client.run() and close() close the per-loop
+async clients, that submit() reuses one loop and client and that llm.py keeps
+working after close(), then shows a slow response being cut off by OPENAI_TIMEOUT.
+Run: `python benchmarks/bench_openai_client.py [--requests 200] [--concurrency 8] [--latency 0.01]`
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ['OPENAI_API_KEY'] = 'test-key'
+
+from fake_openai_server import FakeOpenAIServer
+from openai import APITimeoutError, AsyncOpenAI, OpenAI
+
+import llm
+import llm_client
+
+KEY = 'test-key'
+MESSAGES = [{'role': 'user', 'content': 'hello'}]
+
+
+def _request(client):
+    return client.chat.completions.create(model='fake', messages=MESSAGES, max_tokens=50)
+
+
+def _fresh_sync(base_url):
+    with OpenAI(api_key=KEY, base_url=base_url, max_retries=0) as client:
+        return _request(client)
+
+
+async def _fresh_async(base_url):
+    async with AsyncOpenAI(api_key=KEY, base_url=base_url, max_retries=0) as client:
+        return await _request(client)
+
+
+def _report(name, srv, fn, n):
+    before = srv.connections
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<32} {elapsed:6.2f}s  {n / elapsed:7.1f} req/s  {srv.connections - before:5d} connections')
+
+
+def _threaded(call, n, concurrency):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda _: call(), range(n)))
+
+
+def _gathered(make_call, n, concurrency):
+    async def run():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with semaphore:
+                await make_call()
+
+        await asyncio.gather(*(one() for _ in range(n)))
+    llm_client.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.01)
+    args = parser.parse_args()
+    n, c = args.requests, args.concurrency
+
+    srv = FakeOpenAIServer(latency=args.latency).start()
+    llm_client.BASE_URL = srv.base_url
+    try:
+        _report('sync, client per request', srv, lambda: _threaded(lambda: _fresh_sync(srv.base_url), n, c), n)
+        shared = llm_client.sync_client(KEY)
+        _report('sync, shared pooled client', srv, lambda: _threaded(lambda: _request(shared), n, c), n)
+        _report('async, client per request', srv, lambda: _gathered(lambda: _fresh_async(srv.base_url), n, c), n)
+        _report('async, shared pooled client', srv,
+                lambda: _gathered(lambda: _request(llm_client.async_client(KEY)), n, c), n)
+
+        # every asyncio.run() used to leave its loop's client and connection pool open
+        clients = []
+
+        async def used_client():
+            clients.append(llm_client.async_client(KEY))
+            return await _request(clients[-1])
+        for _ in range(5):
+            llm_client.run(used_client())
+        assert not llm_client._async_clients and all(client.is_closed() for client in clients)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(used_client())
+        llm_client.close()
+        assert clients[-1].is_closed()
+        loop.close()
+        print(f'{"async clients after run()/close()":<32} all {len(clients)} closed')
+
+        # submit() keeps one loop (and its client) across calls, as Streamlit reruns need
+        for _ in range(5):
+            llm_client.submit(used_client())
+        assert len({id(client) for client in clients[-5:]}) == 1
+        llm_client.close()
+        assert clients[-1].is_closed()
+        llm_client.submit(used_client())
+        assert not clients[-1].is_closed()
+        print(f'{"async clients after submit()":<32} 1 client for 5 calls, rebuilt after close()')
+
+        # llm.py looks the sync client up per call, so a second app lifespan still works
+        llm._call_openai(MESSAGES)
+        llm_client.close()
+        llm._call_openai(MESSAGES)
+        print(f'{"sync calls after close()":<32} new client built')
+
+        # a hung response is abandoned after the read timeout instead of blocking the worker
+        llm_client.close()
+        llm_client.TIMEOUT, srv.latency = 0.5, 3.0
+        start = time.perf_counter()
+        try:
+            _request(llm_client.sync_client(KEY))
+        except APITimeoutError:
+            print(f'{"3s response, OPENAI_TIMEOUT=0.5":<32} {time.perf_counter() - start:6.2f}s  timed out')
+        llm_client.close()
+    finally:
+        srv.stop()
+
+
+if __name__ == '__main__':
+    main()
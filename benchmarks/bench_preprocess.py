@@ -0,0 +1,79 @@
+"""
+Check + benchmark: email pre-processing before LLM calls (llm.prepare_email).
+
+Regression: every email in data/mock_emails.json (short, no quoted history)
+must reach the model unchanged for every task, so prompts, cache keys and
+outputs stay the same, and an unsubscribe footer leaves a marker behind (the
+Newsletter/Promo signal for categorize). Then reports input tokens before and after cleaning
+for synthetic long reply threads built from the same emails, and the
+truncation of one long message to the task budgets.
+Run: `python benchmarks/bench_preprocess.py [--depth 6]`
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import llm
+
+BASE = os.path.join(os.path.dirname(__file__), '..')
+TASKS = ['categorize', 'extract', 'analyze', 'draft', 'chat']
+SIGNATURE = '--\nJordan Lee | Senior Manager\nAcme Corp | +1 555 0100 | www.acme.example\n\nSent from my iPhone'
+DISCLAIMER = ('CONFIDENTIALITY NOTICE: This e-mail and any attachments are intended only for the named recipient '
+              'and may contain privileged and confidential information. If you are not the intended recipient, '
+              'please notify the sender and delete this message. ' * 3)
+
+
+def _thread(emails, depth: int) -> str:
+    """A reply chain `depth` messages deep, newest first, each quoting the previous one."""
+    text = ''
+    for n, e in enumerate(emails[:depth]):
+        message = f"{e['body']}\n\n{SIGNATURE}\n\n{DISCLAIMER}"
+        if text:
+            quoted = '\n'.join('> ' + line for line in text.split('\n'))
+            message += f"\n\nOn Mon, Sep {n + 1}, 2025 at 10:00 AM {e['sender']} wrote:\n{quoted}"
+        text = message
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=6)
+    args = parser.parse_args()
+    with open(os.path.join(BASE, 'data', 'mock_emails.json'), 'r', encoding='utf-8') as f:
+        emails = json.load(f)
+
+    for e in emails:
+        for task in TASKS:
+            assert llm.prepare_email(e['body'], task) == e['body'], (e['id'], task)
+    print(f'{len(emails)} mock emails x {len(TASKS)} tasks: unchanged')
+    newsletter = ('This week: three new product launches and our roadmap for Q4.\n\n'
+                  'You received this email because you subscribed. To unsubscribe, click here or manage your preferences.')
+    prepared = llm.prepare_email(newsletter, 'categorize')
+    assert 'To unsubscribe' not in prepared and prepared.endswith(llm.UNSUBSCRIBE_MARKER), prepared
+    print(f'unsubscribe footer -> "{llm.UNSUBSCRIBE_MARKER}"')
+
+    threads = [_thread(emails[i:] + emails[:i], args.depth) for i in range(len(emails))]
+    print(f"token counting: {'tiktoken' if llm.tiktoken else 'estimate (4 chars/token)'}")
+    for task in TASKS:
+        before = sum(llm.count_tokens(t) for t in threads)
+        start = time.perf_counter()
+        prepared = [llm.prepare_email(t, task) for t in threads]
+        elapsed = (time.perf_counter() - start) / len(threads) * 1000
+        after = sum(llm.count_tokens(t) for t in prepared)
+        print(f'{task:<10} {before / len(threads):7.0f} -> {after / len(threads):6.0f} tokens/email '
+              f'({1 - after / before:5.1%} saved, budget {llm.INPUT_TOKEN_BUDGETS[task]}, {elapsed:.2f} ms/email)')
+    # one long message with nothing to strip is cut to the task budget
+    long_text = '\n\n'.join(e['body'] for e in emails) * 20
+    for task in ('categorize', 'draft'):
+        cut = llm.prepare_email(long_text, task)
+        assert llm.count_tokens(cut) <= llm.INPUT_TOKEN_BUDGETS[task] + 5
+        print(f'{task:<10} long message {llm.count_tokens(long_text):7d} -> {llm.count_tokens(cut):6d} tokens')
+    print('stats', llm.preprocess_stats())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Check + benchmark: the pre-LLM rules classifier (rules.py).
+
+Runs a batch over data/mock_emails.json plus synthetic bulk mail (with
+List-Unsubscribe / Precedence / Auto-Submitted headers) and personal mail
+that borrows bulk wording, against the local fake API, with the rules on and
+off. Verifies the obvious bulk mail never reaches the API, personal mail
+always does, and user rules from SQLite take effect; reports the share of
+emails and API requests avoided and the classifier's time per email.
+Run: `python benchmarks/bench_rules.py [--copies 20]`
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# must be set before llm creates its clients
+os.environ['OPENAI_API_KEY'] = 'test-key'
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai_server import FakeOpenAIServer
+
+import batch
+import db
+import llm
+import llm_client
+import rules
+
+BASE = os.path.join(os.path.dirname(__file__), '..')
+# mock email id -> category the rules must assign (everything else goes to the LLM)
+EXPECTED = {2: 'Newsletter', 4: 'Spam', 11: 'Promo'}
+BULK = [
+    ({'sender': 'Acme Weekly <news@acme.example>', 'subject': 'Acme Weekly #42', 'body': 'Read online. Product news...',
+      'list_unsubscribe': '<mailto:unsub@acme.example>', 'precedence': 'bulk'}, 'Newsletter'),
+    ({'sender': 'deals@store.example', 'subject': 'Cyber Monday: 30% off everything', 'body': 'Shop now, free shipping.',
+      'list_unsubscribe': '<https://store.example/u>'}, 'Promo'),
+    ({'sender': 'no-reply@accounts.example', 'subject': 'Security alert: new sign-in from Chrome on Windows',
+      'body': 'If this was you, you can ignore this email.', 'auto_submitted': 'auto-generated'}, 'Alert'),
+    ({'sender': 'prizes@lucky.example', 'subject': 'WINNER!!! Claim your reward', 'body': 'Click here: http://203.0.113.7/claim'},
+     'Spam'),
+]
+PERSONAL = [
+    {'sender': 'dana@partner.example', 'subject': 'Sale numbers for the board', 'body': 'Could you send the Q3 deals list by Friday?'},
+    {'sender': 'info@clientco.example', 'subject': 'Weekly update on the migration', 'body': 'Please review the attached plan and confirm.'},
+    {'sender': 'ops@infra.example', 'subject': 'Alert: payments error rate', 'body': 'Please investigate and roll back if needed.'},
+    # bulk headers and an automated sender, but it asks the reader to act
+    {'sender': 'news@acme.com', 'subject': 'Contract', 'body': 'could you review the attached contract and confirm by Friday?',
+     'list_unsubscribe': '<mailto:unsub@acme.com>', 'precedence': 'bulk'},
+]
+
+
+def _corpus(copies: int):
+    with open(os.path.join(BASE, 'data', 'mock_emails.json'), 'r', encoding='utf-8') as f:
+        mock = json.load(f)
+    emails, expected = [], {}
+    next_id = 1
+    for _ in range(copies):
+        for e in mock:
+            emails.append({**e, 'id': next_id})
+            expected[next_id] = EXPECTED.get(e['id'])
+            next_id += 1
+        for e, category in BULK:
+            emails.append({**e, 'id': next_id, 'timestamp': '2025-11-05T10:00:00'})
+            expected[next_id] = category
+            next_id += 1
+        for e in PERSONAL:
+            emails.append({**e, 'id': next_id, 'timestamp': '2025-11-05T10:00:00'})
+            expected[next_id] = None
+            next_id += 1
+    return emails, expected
+
+
+def _batch(srv, enabled: bool):
+    rules.ENABLED = enabled
+    with db._tx() as conn:
+        conn.execute('DELETE FROM processed')
+    before = srv.requests
+    start = time.perf_counter()
+    progress = batch.run_batch(concurrency=8, use_cache=False, combined=False)
+    return srv.requests - before, time.perf_counter() - start, progress
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--copies', type=int, default=20)
+    args = parser.parse_args()
+    srv = FakeOpenAIServer(latency=0.02).start()
+    llm_client.BASE_URL = srv.base_url
+    llm_client.close()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            db.init_db()
+            emails, expected = _corpus(args.copies)
+            db.save_emails(emails)
+
+            for e in db.get_unprocessed_emails():
+                got = rules.classify(e)
+                assert (got and got['categories'][0]) == expected[e['id']], (e['subject'], got, rules.score(e))
+            for e in PERSONAL:
+                assert not set(rules.score(e)) & set(rules._BULK_CATEGORIES), (e['subject'], rules.score(e))
+            print(f'{len(emails)} emails: every bulk email classified as expected, every other one forwarded '
+                  f'(requests to the reader veto bulk categories)')
+
+            requests_off, elapsed_off, _ = _batch(srv, enabled=False)
+            requests_on, elapsed_on, progress = _batch(srv, enabled=True)
+            assert progress['failed'] == 0 and progress['saved'] == len(emails)
+            print(f'rules off  {requests_off:5d} API requests  {elapsed_off:5.2f}s')
+            print(f'rules on   {requests_on:5d} API requests  {elapsed_on:5.2f}s   '
+                  f'({1 - requests_on / requests_off:.0%} of requests avoided)')
+            stats = rules.stats()
+            print(f"stats: {stats['classified']} classified / {stats['forwarded']} forwarded, by category {stats['by_category']}")
+
+            rule = rules.add_rule('sender', '*@clientco.example', 'Newsletter')
+            assert rules.classify(PERSONAL[1])['notes'].startswith(f"User rule #{rule['id']}")
+            rules.delete_rule(rule['id'])
+            assert rules.classify(PERSONAL[1]) is None
+            print('user rules: added rule applies at once, deleted rule stops applying')
+
+            start = time.perf_counter()
+            for e in emails * 5:
+                rules.score(e)
+            print(f'classifier: {(time.perf_counter() - start) / (len(emails) * 5) * 1e6:.1f} us/email')
+    finally:
+        srv.stop()
+        llm_client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark: time to first token versus time to full response for chat and
+draft generation, streaming (llm.chat_with_email_stream /
+llm.generate_draft_stream) against the blocking calls, over data/mock_emails.json.
+Run: `python benchmarks/bench_streaming.py [--limit 5]`
+Requires OPENAI_API_KEY; the draft cache is bypassed.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import llm
+
+BASE = os.path.join(os.path.dirname(__file__), '..')
+
+
+def _timed_stream(chunks):
+    start = time.perf_counter()
+    first = None
+    for _ in chunks:
+        if first is None:
+            first = time.perf_counter() - start
+    return first or 0.0, time.perf_counter() - start
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+    if llm.IS_MOCK:
+        print('OPENAI_API_KEY not set: nothing to measure.')
+        return
+    with open(os.path.join(BASE, 'data', 'mock_emails.json'), 'r', encoding='utf-8') as f:
+        emails = json.load(f)[:args.limit]
+    with open(os.path.join(BASE, 'prompts', 'default_prompts.json'), 'r', encoding='utf-8') as f:
+        prompts = json.load(f)
+
+    query = 'Summarize this email and list anything I need to do.'
+    rows = {
+        'chat': ([_timed(lambda: llm.chat_with_email(e['body'], prompts, query)) for e in emails],
+                 [_timed_stream(llm.chat_with_email_stream(e['body'], prompts, query)) for e in emails]),
+        'draft': ([_timed(lambda: llm.generate_draft(e['body'], prompts['auto_reply_prompt'], use_cache=False)) for e in emails],
+                  [_timed_stream(llm.generate_draft_stream(e['body'], prompts['auto_reply_prompt'], use_cache=False))
+                   for e in emails]),
+    }
+    for name, (blocking, streamed) in rows.items():
+        print(f'{name:<6} blocking median {statistics.median(blocking):5.2f}s   streaming first token '
+              f'{statistics.median(s[0] for s in streamed):5.2f}s, complete {statistics.median(s[1] for s in streamed):5.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Check + benchmark: structured outputs (response_format) for categorize,
+extract_actions, analyze and generate_draft, against the local fake API.
+
+Verifies each request carries the task's strict JSON schema, that a model
+refusing json_schema falls back to JSON mode and then to free text (and the
+refusal is remembered), that free-text calls are unchanged, and that an empty
+reply or a refusal raises LLMError instead of returning mock output. Then compares
+parsing a structured reply (one json.loads) with fishing the same value out of
+a chatty reply, and the completion size of both (words, as the fake API counts
+tokens).
+Run: `python benchmarks/bench_structured_outputs.py [--repeat 2000]`
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# must be set before llm creates its clients
+os.environ['OPENAI_API_KEY'] = 'test-key'
+os.environ['OPENAI_MODEL'] = 'gpt-4o-mini'
+os.environ.pop('LLM_RESPONSE_FORMAT', None)
+
+sys.path.insert(0, os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_openai_server import FakeOpenAIServer
+
+import db
+import llm
+import llm_async
+import llm_client
+
+EMAIL = 'Hi Sam, can you send the Q3 deck to Bob by Friday? Thanks, Alice'
+DRAFT = {'subject': 'Re: Q3 deck', 'body': 'Hi Alice,\n\nSending it to Bob today.\n\nBest,\nSam', 'followups': []}
+CHATTY = ('Sure! Here is the draft reply you asked for, written in a friendly tone:\n\n```json\n'
+          + json.dumps(DRAFT, indent=2) + '\n```\n\nLet me know if you would like me to adjust the tone or add details.')
+
+
+def _format(srv):
+    fmt = (srv.last_request or {}).get('response_format')
+    return fmt['json_schema']['name'] if fmt and fmt['type'] == 'json_schema' else (fmt or {}).get('type')
+
+
+def _timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+    srv = FakeOpenAIServer(reply=json.dumps(DRAFT)).start()
+    llm_client.BASE_URL = srv.base_url
+    llm_client.close()
+    prompts = json.load(open(os.path.join(os.path.dirname(__file__), '..', 'prompts', 'default_prompts.json')))
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            db.DB_PATH = os.path.join(tmp, 'bench.db')
+            db.init_db()
+            print(f'{llm.OPENAI_MODEL}: mode {llm.response_format_mode()}')
+
+            assert llm.generate_draft(EMAIL, prompts['auto_reply_prompt'], use_cache=False) == DRAFT
+            assert _format(srv) == 'draft'
+            srv.reply = json.dumps({'categories': ['Action Required'], 'confidence': 0.9, 'notes': 'Asks for the deck.'})
+            assert llm.categorize(EMAIL, prompts['categorization_prompt'], use_cache=False)['categories'] == ['Action Required']
+            assert _format(srv) == 'categorize'
+            srv.reply = json.dumps({'tasks': [{'task': 'Send the Q3 deck to Bob', 'assignee': 'Sam', 'due': '', 'context': ''}]})
+            assert asyncio.run(llm_async.extract_actions(EMAIL, prompts['action_item_prompt'], use_cache=False))[0]['assignee'] == 'Sam'
+            assert _format(srv) == 'extract'
+            srv.reply = 'Sending it today.'
+            llm.chat_with_email(EMAIL, prompts, 'Reply briefly')
+            assert 'response_format' not in srv.last_request
+            print('json_schema sent for categorize/extract/draft, not for chat')
+
+            srv.reply = json.dumps(DRAFT)
+            srv.unsupported_formats = {'json_schema', 'json_object'}
+            before = srv.requests
+            assert llm.generate_draft(EMAIL, prompts['auto_reply_prompt'], use_cache=False) == DRAFT
+            assert srv.requests - before == 3 and _format(srv) is None
+            assert llm.response_format_mode() == 'off'
+            before = srv.requests
+            assert ''.join(llm.generate_draft_stream(EMAIL, prompts['auto_reply_prompt'], use_cache=False)) == json.dumps(DRAFT)
+            assert srv.requests - before == 1
+            print('model without structured outputs: json_schema -> json_object -> off, remembered')
+            llm._rejected_formats.clear()
+            srv.unsupported_formats = set()
+
+            srv.reply = ''
+            for call in (lambda: llm.categorize(EMAIL, prompts['categorization_prompt'], use_cache=False),
+                         lambda: asyncio.run(llm_async.analyze_email(EMAIL, prompts, use_cache=False, combined=True))):
+                try:
+                    call()
+                    raise AssertionError('empty reply parsed')
+                except llm.LLMError as exc:
+                    assert 'Empty response' in str(exc)
+            srv.refusal = "I'm sorry, I can't help with that."
+            for call in (lambda: llm.generate_draft(EMAIL, prompts['auto_reply_prompt'], use_cache=False),
+                         lambda: asyncio.run(llm_async.categorize(EMAIL, prompts['categorization_prompt'], use_cache=False)),
+                         lambda: ''.join(llm.generate_draft_stream(EMAIL, prompts['auto_reply_prompt'], use_cache=False))):
+                try:
+                    call()
+                    raise AssertionError('refusal parsed')
+                except llm.LLMError as exc:
+                    assert "can't help" in str(exc), exc
+            srv.refusal = ''
+            print('empty reply and refusal: LLMError, no mock output')
+
+            structured = json.dumps(DRAFT)
+            fast = _timed(lambda: llm._parse_json_response(structured, 'draft', lambda t: None), args.repeat)
+            slow = _timed(lambda: llm._parse_json_response(CHATTY, 'draft', lambda t: None), args.repeat)
+            assert llm._parse_json_response(CHATTY, 'draft', lambda t: None) == DRAFT
+            print(f'parse structured reply   {fast:6.1f} us   ({len(structured.split())} words)')
+            print(f'parse chatty reply       {slow:6.1f} us   ({len(CHATTY.split())} words)')
+    finally:
+        srv.stop()
+        llm_client.close()
+
+
+if __name__ == '__main__':
+    main()
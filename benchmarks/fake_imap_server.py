@@ -0,0 +1,321 @@
+"""
+Minimal IMAP4rev1 stand-in used by the IMAP benchmarks.
+
+Serves in-memory mailboxes over plaintext TCP (run the client with
+IMAP_SSL=0) and can add a fixed delay per command to simulate a
+high-latency server. Only the commands imap_ingest and imap_watch use are
+implemented (including IDLE). `bytes_sent` counts everything written to
+clients, drop_connections() simulates a network failure and `fail_fetches`
+answers that many of the next UID FETCH commands with NO. `idle_notice`
+(e.g. '* OK still here\\r\\n') is sent in the same write as each IDLE EXISTS.
+
+Usage:
+    srv = FakeIMAPServer(latency=0.02).start()
+    srv.mailboxes['INBOX'].append(make_message(1))
+    ... connect to srv.address ...
+    srv.stop()
+"""
+import re
+import select
+import socketserver
+import threading
+import time
+import email
+from email.message import EmailMessage
+from typing import Dict, List, Optional
+
+
+def make_message(i: int, body_size: int = 500, attachment_size: int = 0) -> bytes:
+    msg = EmailMessage()
+    msg['From'] = f'sender{i % 50}@example.com'
+    msg['To'] = 'me@example.com'
+    msg['Subject'] = f'Message {i}'
+    msg['Date'] = f'Mon, {i % 28 + 1:02d} Sep 2025 10:{i % 60:02d}:00 +0000'
+    msg['Message-ID'] = f'<{i}@example.com>'
+    msg.set_content(f'Body of message {i}\n' + 'lorem ipsum ' * (body_size // 12))
+    if attachment_size:
+        msg.add_attachment(b'%PDF' + b'x' * attachment_size, maintype='application', subtype='pdf', filename=f'doc{i}.pdf')
+    return msg.as_bytes()
+
+
+class Mailbox:
+    def __init__(self, uidvalidity: int = 1):
+        self.uidvalidity = uidvalidity
+        self.messages: Dict[int, bytes] = {}
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def append(self, raw: bytes) -> int:
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = raw
+            self.changed.notify_all()
+            return uid
+
+    def uids(self) -> List[int]:
+        with self.lock:
+            return sorted(self.messages)
+
+
+def _parse_set(spec: str, all_ids: List[int]) -> List[int]:
+    top = max(all_ids) if all_ids else 0
+    out = set()
+    for part in spec.split(','):
+        if ':' in part:
+            a, b = part.split(':')
+            a = top if a == '*' else int(a)
+            b = top if b == '*' else int(b)
+            lo, hi = min(a, b), max(a, b)
+            out.update(i for i in all_ids if lo <= i <= hi)
+        else:
+            n = top if part == '*' else int(part)
+            if n in all_ids:
+                out.add(n)
+    return sorted(out)
+
+
+def _quote(value) -> str:
+    if value is None:
+        return 'NIL'
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _bodystructure(part) -> str:
+    """BODYSTRUCTURE for an email.message.Message (basic fields plus disposition)."""
+    if part.is_multipart():
+        children = ''.join(_bodystructure(p) for p in part.get_payload())
+        return f'({children} {_quote(part.get_content_subtype().upper())})'
+    maintype, subtype = part.get_content_maintype().upper(), part.get_content_subtype().upper()
+    charset = part.get_param('charset')
+    params = f'("CHARSET" {_quote(charset)})' if charset else 'NIL'
+    payload = part.get_payload().encode()
+    encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper()
+    fields = f'{_quote(maintype)} {_quote(subtype)} {params} NIL NIL {_quote(encoding)} {len(payload)}'
+    if maintype == 'TEXT':
+        fields += ' %d' % payload.count(b'\n')
+    disposition = 'NIL'
+    if part.get_content_disposition():
+        filename = part.get_filename()
+        disp_params = f'("FILENAME" {_quote(filename)})' if filename else 'NIL'
+        disposition = f'({_quote(part.get_content_disposition().upper())} {disp_params})'
+    return f'({fields} NIL {disposition} NIL NIL)'
+
+
+def _part(msg, section: str):
+    for n in section.split('.'):
+        if not msg.is_multipart():
+            if n != '1':
+                raise ValueError(section)
+            continue
+        msg = msg.get_payload()[int(n) - 1]
+    return msg
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.selected: Optional[Mailbox] = None
+        with self.server.clients_lock:
+            self.server.clients.add(self)
+
+    def finish(self):
+        with self.server.clients_lock:
+            self.server.clients.discard(self)
+        try:
+            super().finish()
+        except OSError:
+            pass  # dropped by FakeIMAPServer.drop_connections
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        self.send('* OK fake IMAP4rev1 ready\r\n')
+        while True:
+            try:
+                line = self.rfile.readline()
+            except OSError:
+                return
+            if not line:
+                return
+            if server.latency:
+                time.sleep(server.latency)  # one simulated RTT per command
+            line = line.decode().rstrip('\r\n')
+            tag, _, rest = line.partition(' ')
+            cmd, _, args = rest.partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'UID':
+                sub, _, args = args.partition(' ')
+                cmd = 'UID ' + sub.upper()
+            method = getattr(self, 'do_' + cmd.replace(' ', '_'), None)
+            if method is None:
+                self.send(f'{tag} BAD unknown command\r\n')
+                continue
+            try:
+                if method(tag, args) is False:
+                    return
+            except OSError:
+                return  # client went away mid-command
+
+    def do_CAPABILITY(self, tag, args):
+        self.send('* CAPABILITY IMAP4rev1 IDLE\r\n' + f'{tag} OK done\r\n')
+
+    def do_NOOP(self, tag, args):
+        self.send(f'{tag} OK done\r\n')
+
+    def do_LOGIN(self, tag, args):
+        self.server.logins += 1
+        self.send(f'{tag} OK logged in\r\n')
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE\r\n' + f'{tag} OK bye\r\n')
+        return False
+
+    def do_IDLE(self, tag, args):
+        # report "* N EXISTS" whenever the selected mailbox grows, until DONE
+        mb = self.selected
+        seen = len(mb.uids())
+        self.send('+ idling\r\n')
+        while True:
+            with mb.changed:
+                mb.changed.wait(0.05)
+            count = len(mb.uids())
+            if count != seen:
+                seen = count
+                self.send(f'{self.server.idle_notice}* {count} EXISTS\r\n')
+            try:
+                readable, _, _ = select.select([self.connection], [], [], 0)
+            except (OSError, ValueError):
+                return False
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b'DONE':
+                    self.send(f'{tag} OK IDLE terminated\r\n')
+                    return
+
+    def _mailbox(self, name):
+        return self.server.mailboxes.get(name.strip('"'))
+
+    def do_SELECT(self, tag, args):
+        mb = self._mailbox(args)
+        if mb is None:
+            self.send(f'{tag} NO no such mailbox\r\n')
+            return
+        self.selected = mb
+        self.send(f'* {len(mb.uids())} EXISTS\r\n* OK [UIDVALIDITY {mb.uidvalidity}] ok\r\n'
+                  f'* OK [UIDNEXT {mb.next_uid}] ok\r\n{tag} OK [READ-WRITE] selected\r\n')
+
+    do_EXAMINE = do_SELECT
+
+    def do_STATUS(self, tag, args):
+        name = args.split(' (')[0]
+        mb = self._mailbox(name)
+        self.send(f'* STATUS {name} (UIDVALIDITY {mb.uidvalidity} UIDNEXT {mb.next_uid})\r\n{tag} OK done\r\n')
+
+    def do_UID_SEARCH(self, tag, args):
+        uids = self.selected.uids()
+        m = re.search(r'UID (\S+)', args)
+        if m:
+            uids = _parse_set(m.group(1), uids)
+        self.send(f'* SEARCH {" ".join(map(str, uids))}\r\n{tag} OK done\r\n')
+
+    def _section(self, raw: bytes, item: str) -> bytes:
+        if item in ('RFC822', 'BODY[]', 'BODY.PEEK[]'):
+            return raw
+        m = re.fullmatch(r'BODY(?:\.PEEK)?\[(.*)\]', item)
+        if not m:
+            raise ValueError(item)
+        spec = m.group(1)
+        header, _, _ = raw.partition(b'\r\n\r\n') if b'\r\n\r\n' in raw else raw.partition(b'\n\n')
+        if spec == 'HEADER':
+            return header + b'\r\n\r\n'
+        fields = re.fullmatch(r'HEADER\.FIELDS \((.*)\)', spec)
+        if fields:
+            wanted = set(fields.group(1).split())
+            msg = email.message_from_bytes(header)
+            lines = [f'{k}: {v}\r\n' for k, v in msg.items() if k.upper() in wanted]
+            return ''.join(lines).encode() + b'\r\n'
+        return _part(email.message_from_bytes(raw), spec).get_payload().encode()
+
+    def do_UID_FETCH(self, tag, args):
+        if self.server.fail_fetches:
+            self.server.fail_fetches -= 1
+            self.send(f'{tag} NO [UNAVAILABLE] fetch failed\r\n')
+            return
+        spec, _, items = args.partition(' ')
+        # data items, keeping bracketed sections such as BODY.PEEK[HEADER.FIELDS (FROM)] whole
+        names = [n for n in re.findall(r'[A-Z0-9.]+(?:\[[^\]]*\])?', items.strip('()').upper()) if n != 'UID']
+        mb = self.selected
+        out = []
+        all_uids = mb.uids()
+        seq = {uid: n for n, uid in enumerate(all_uids, start=1)}
+        for uid in _parse_set(spec, all_uids):
+            raw = mb.messages[uid]
+            chunks = [f'* {seq[uid]} FETCH (UID {uid}'.encode()]
+            for name in names:
+                structures = self.server.structures
+                if name == 'BODYSTRUCTURE':
+                    if raw not in structures:  # messages are immutable, so cache by content
+                        structures[raw] = _bodystructure(email.message_from_bytes(raw))
+                    chunks.append(f' BODYSTRUCTURE {structures[raw]}'.encode())
+                    continue
+                payload = self._section(raw, name)
+                label = name.replace('.PEEK', '')
+                chunks.append(f' {label} {{{len(payload)}}}\r\n'.encode() + payload)
+            chunks.append(b')\r\n')
+            out.append(b''.join(chunks))
+        self.send(b''.join(out) + f'{tag} OK done\r\n'.encode())
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.mailboxes: Dict[str, Mailbox] = {'INBOX': Mailbox()}
+        self.bytes_sent = 0
+        self.logins = 0
+        self.fail_fetches = 0
+        self.idle_notice = ''
+        self.structures: Dict[bytes, str] = {}
+        self.clients: set = set()
+        self.clients_lock = threading.Lock()
+        self._thread = None
+
+    def drop_connections(self):
+        """Close every client connection, as a server restart or network drop would."""
+        with self.clients_lock:
+            clients = list(self.clients)
+        for handler in clients:
+            try:
+                handler.connection.shutdown(2)
+            except OSError:
+                pass
+
+    @property
+    def address(self) -> str:
+        host, port = self.server_address
+        return f'{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.drop_connections()
@@ -0,0 +1,151 @@
+"""
+Minimal stand-in for the OpenAI chat completions endpoint, used by the LLM
+benchmarks and failure checks.
+
+Serves POST /v1/chat/completions (plain and stream=True) over HTTP/1.1 with
+keep-alive. Each request takes the next entry of `script`, falling back to a
+successful reply once it is empty:
+    'ok'                          the reply text
+    (429, retry_after)            rate limited, with a Retry-After header
+    (500, None) / (503, 2)        server error (optional Retry-After)
+    (400, None)                   rejected request
+    'disconnect'                  close the connection without answering
+`latency` delays every request, `requests` and `connections` count what the
+clients sent and `last_request` is the latest request body. Response formats
+listed in `unsupported_formats` (e.g. {'json_schema'}) are refused with a 400,
+like a model without structured outputs. A non-empty `refusal` answers every
+request with a refusal (content null, or refusal deltas when streaming).
+
+Usage:
+    srv = FakeOpenAIServer(latency=0.05).start()
+    srv.script.extend([(429, 1), (500, None)])
+    ... OPENAI_BASE_URL=srv.base_url, OPENAI_API_KEY=anything ...
+    srv.stop()
+"""
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, payload, headers: Optional[dict] = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        srv = self.server
+        with srv.lock:
+            srv.requests += 1
+            srv.last_request = request
+            action = srv.script.popleft() if srv.script else 'ok'
+        if srv.latency:
+            time.sleep(srv.latency)
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+            return
+        if action == 'disconnect':
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+        if action != 'ok':
+            status, retry_after = action
+            headers = {'retry-after': str(retry_after)} if retry_after is not None else None
+            kind = 'rate_limit_exceeded' if status == 429 else 'server_error' if status >= 500 else 'invalid_request_error'
+            self._send_json(status, {'error': {'message': f'scripted {status}', 'type': kind, 'code': kind}}, headers)
+            return
+        fmt = (request.get('response_format') or {}).get('type')
+        if fmt in srv.unsupported_formats:
+            self._send_json(400, {'error': {'message': f"Invalid parameter: 'response_format' of type '{fmt}' is not supported with this model.",
+                                            'type': 'invalid_request_error', 'param': 'response_format', 'code': None}})
+            return
+        model = request.get('model', 'fake')
+        reply = srv.reply
+        message = {'role': 'assistant', 'content': reply}
+        if srv.refusal:
+            reply, message = '', {'role': 'assistant', 'content': None, 'refusal': srv.refusal}
+        if not request.get('stream'):
+            self._send_json(200, {
+                'id': f'chatcmpl-{srv.requests}', 'object': 'chat.completion', 'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'message': message, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 10, 'completion_tokens': len(reply.split()), 'total_tokens': 10 + len(reply.split())},
+            })
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        words = (srv.refusal or reply).split(' ')
+        for n, word in enumerate(words):
+            text = word + (' ' if n < len(words) - 1 else '')
+            chunk = {'id': f'chatcmpl-{srv.requests}', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': model, 'choices': [{'index': 0, 'delta': {'refusal': text} if srv.refusal else {'content': text},
+                                                 'finish_reason': None}]}
+            self._chunk(b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\n')
+            if srv.chunk_delay:
+                time.sleep(srv.chunk_delay)
+        if (request.get('stream_options') or {}).get('include_usage'):
+            usage = {'id': f'chatcmpl-{srv.requests}', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                     'model': model, 'choices': [],
+                     'usage': {'prompt_tokens': 10, 'completion_tokens': len(words), 'total_tokens': 10 + len(words)}}
+            self._chunk(b'data: ' + json.dumps(usage).encode('utf-8') + b'\n\n')
+        self._chunk(b'data: [DONE]\n\n')
+        self._chunk(b'')
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency: float = 0.0, reply: str = '{"categories": ["Test"], "confidence": 0.9}',
+                 chunk_delay: float = 0.0, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.reply = reply
+        self.refusal = ''
+        self.chunk_delay = chunk_delay
+        self.script: deque = deque()
+        self.unsupported_formats: set = set()
+        self.last_request: Optional[dict] = None
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,139 +1,676 @@
 import sqlite3
 import json
 import os
-from typing import List, Dict, Any
+import base64
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+import db_pool
 
 DB_PATH = os.path.join(os.path.dirname(__file__), 'data', 'email_agent.db')
 
+# Ordered schema migrations, applied once per database on first connection.
+# Append new (version, steps) entries; never edit or reorder applied ones.
+# A step is either an SQL statement or a callable taking the connection.
+MIGRATIONS = [
+    (1, (
+        'CREATE TABLE IF NOT EXISTS emails (id INTEGER PRIMARY KEY, sender TEXT, subject TEXT, timestamp TEXT, body TEXT)',
+        'CREATE TABLE IF NOT EXISTS processed (email_id INTEGER PRIMARY KEY, categories TEXT, tasks TEXT)',
+        'CREATE TABLE IF NOT EXISTS prompts (name TEXT PRIMARY KEY, content TEXT)',
+        'CREATE TABLE IF NOT EXISTS drafts (id INTEGER PRIMARY KEY AUTOINCREMENT, email_id INTEGER, subject TEXT, body TEXT, metadata TEXT)',
+    )),
+    (2, (
+        'CREATE INDEX IF NOT EXISTS idx_emails_timestamp ON emails(timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_emails_sender ON emails(sender)',
+        'CREATE INDEX IF NOT EXISTS idx_drafts_email_id ON drafts(email_id)',
+    )),
+    # full-text index over emails, kept in sync by triggers (external content
+    # table, so bodies are not stored twice)
+    (3, (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS emails_fts USING fts5(sender, subject, body, content='emails', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        '''CREATE TRIGGER IF NOT EXISTS emails_fts_ai AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts(rowid, sender, subject, body) VALUES (new.id, new.sender, new.subject, new.body);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS emails_fts_ad AFTER DELETE ON emails BEGIN
+            INSERT INTO emails_fts(emails_fts, rowid, sender, subject, body) VALUES ('delete', old.id, old.sender, old.subject, old.body);
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS emails_fts_au AFTER UPDATE ON emails BEGIN
+            INSERT INTO emails_fts(emails_fts, rowid, sender, subject, body) VALUES ('delete', old.id, old.sender, old.subject, old.body);
+            INSERT INTO emails_fts(rowid, sender, subject, body) VALUES (new.id, new.sender, new.subject, new.body);
+        END''',
+        "INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')",
+    )),
+    (4, (
+        'CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, task TEXT, model TEXT, response TEXT, created_at REAL, last_used REAL)',
+        'CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache(last_used)',
+    )),
+    # stable IMAP identity (account, mailbox, uidvalidity, uid) for synced
+    # emails, plus per-mailbox incremental sync state
+    (5, (
+        'ALTER TABLE emails ADD COLUMN account TEXT',
+        'ALTER TABLE emails ADD COLUMN mailbox TEXT',
+        'ALTER TABLE emails ADD COLUMN uidvalidity INTEGER',
+        'ALTER TABLE emails ADD COLUMN uid INTEGER',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_imap_identity ON emails(account, mailbox, uidvalidity, uid)',
+        'CREATE TABLE IF NOT EXISTS imap_sync_state (account TEXT, mailbox TEXT, uidvalidity INTEGER, last_uid INTEGER, updated_at TEXT, PRIMARY KEY (account, mailbox))',
+    )),
+    # header-first IMAP ingestion: where to find the text body on the server
+    # for emails whose body has not been downloaded yet
+    (6, (
+        'ALTER TABLE emails ADD COLUMN body_fetched INTEGER NOT NULL DEFAULT 1',
+        'ALTER TABLE emails ADD COLUMN body_section TEXT',
+        'ALTER TABLE emails ADD COLUMN body_encoding TEXT',
+        'ALTER TABLE emails ADD COLUMN body_charset TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_emails_body_pending ON emails(account, mailbox) WHERE body_fetched = 0',
+    )),
+    # background jobs run by jobs.JobWorkerPool
+    (7, (
+        '''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress TEXT,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            updated_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)',
+    )),
+    # one row per LLM call, written by llm_metrics
+    (8, (
+        '''CREATE TABLE IF NOT EXISTS llm_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at REAL NOT NULL,
+            task TEXT NOT NULL,
+            model TEXT,
+            status TEXT NOT NULL,
+            cache TEXT,
+            parse TEXT,
+            latency_ms REAL,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cost_usd REAL,
+            error TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_llm_calls_created ON llm_calls(created_at)',
+    )),
+    # bulk-mail headers and user-defined rules for the pre-LLM classifier (rules.py)
+    (9, (
+        'ALTER TABLE emails ADD COLUMN list_unsubscribe TEXT',
+        'ALTER TABLE emails ADD COLUMN precedence TEXT',
+        'ALTER TABLE emails ADD COLUMN auto_submitted TEXT',
+        '''CREATE TABLE IF NOT EXISTS classifier_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            field TEXT NOT NULL,
+            pattern TEXT NOT NULL,
+            category TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )''',
+    )),
+    # running LLM call totals for /metrics: never pruned, so its counters only go up
+    (10, (
+        '''CREATE TABLE IF NOT EXISTS llm_call_totals (
+            task TEXT NOT NULL,
+            model TEXT NOT NULL,
+            status TEXT NOT NULL,
+            cache TEXT NOT NULL,
+            parse TEXT NOT NULL,
+            calls INTEGER NOT NULL,
+            latency_ms REAL NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            cost_usd REAL NOT NULL,
+            PRIMARY KEY (task, model, status, cache, parse)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS llm_latency_totals (
+            task TEXT NOT NULL,
+            le_ms REAL NOT NULL,
+            calls INTEGER NOT NULL,
+            PRIMARY KEY (task, le_ms)
+        )''',
+    )),
+]
+
+def _schema_version(conn: sqlite3.Connection) -> int:
+    r = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    return r[0] or 0
+
+def _migrate(conn: sqlite3.Connection):
+    """Bring the database up to the latest entry in MIGRATIONS."""
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT)')
+    if _schema_version(conn) >= MIGRATIONS[-1][0]:
+        return
+    # IMMEDIATE takes the write lock up front so concurrent processes
+    # starting together don't apply the same migration twice
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = _schema_version(conn)
+        for version, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute("INSERT INTO schema_version(version, applied_at) VALUES (?, datetime('now'))", (version,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def _conn() -> sqlite3.Connection:
+    """Pooled connection for DB_PATH; pending migrations run on first use."""
+    return db_pool.get_connection(DB_PATH, init=_migrate)
+
+def _tx():
+    """Pooled connection wrapped in a commit/rollback transaction."""
+    return db_pool.transaction(DB_PATH, init=_migrate)
+
 def init_db():
-    os.makedirs(os.path.join(os.path.dirname(__file__), 'data'), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS emails (id INTEGER PRIMARY KEY, sender TEXT, subject TEXT, timestamp TEXT, body TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS processed (email_id INTEGER PRIMARY KEY, categories TEXT, tasks TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS prompts (name TEXT PRIMARY KEY, content TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS drafts (id INTEGER PRIMARY KEY AUTOINCREMENT, email_id INTEGER, subject TEXT, body TEXT, metadata TEXT)''')
-    conn.commit()
-    conn.close()
-
-def load_mock_emails(json_path: str):
-    init_db()
+    _conn()
+
+def close_db():
+    db_pool.close_all()
+
+def load_mock_emails(json_path: str) -> Dict[str, int]:
     with open(json_path, 'r', encoding='utf-8') as f:
         emails = json.load(f)
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    for e in emails:
-        c.execute('SELECT 1 FROM emails WHERE id=?', (e['id'],))
-        if c.fetchone():
-            continue
-        c.execute('INSERT INTO emails(id, sender, subject, timestamp, body) VALUES (?, ?, ?, ?, ?)',
-                  (e['id'], e['sender'], e['subject'], e['timestamp'], e['body']))
-    conn.commit()
-    conn.close()
-
-def save_emails(emails: List[Dict[str, Any]]):
-    """Insert emails if they don't already exist (by id)."""
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    for e in emails:
-        if not e or 'id' not in e:
-            continue
-        c.execute('SELECT 1 FROM emails WHERE id=?', (e['id'],))
-        if c.fetchone():
-            continue
-        c.execute(
-            'INSERT INTO emails(id, sender, subject, timestamp, body) VALUES (?, ?, ?, ?, ?)',
-            (e.get('id'), e.get('sender', ''), e.get('subject', ''), e.get('timestamp', ''), e.get('body', ''))
-        )
-    conn.commit()
-    conn.close()
-
-def get_emails() -> List[Dict[str, Any]]:
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    rows = c.execute('SELECT id, sender, subject, timestamp FROM emails ORDER BY timestamp DESC').fetchall()
-    conn.close()
+    return save_emails(emails)
+
+def _existing_ids(conn: sqlite3.Connection, ids: List[int], chunk: int = 500) -> set:
+    existing = set()
+    for i in range(0, len(ids), chunk):
+        part = ids[i:i + chunk]
+        existing.update(r[0] for r in conn.execute(f'SELECT id FROM emails WHERE id IN ({",".join("?" * len(part))})', part))
+    return existing
+
+# bound only when some email in the batch sets them
+_EMAIL_OPTIONAL_COLUMNS = ('account', 'mailbox', 'uidvalidity', 'uid', 'body_fetched', 'body_section', 'body_encoding',
+                           'body_charset', 'list_unsubscribe', 'precedence', 'auto_submitted')
+
+def _insert_emails(conn: sqlite3.Connection, emails: List[Dict[str, Any]]) -> Dict[str, int]:
+    # re-ingesting is mostly duplicates: look their ids up in one pass instead
+    # of building and binding a full row for each only to have it ignored
+    existing = _existing_ids(conn, [e['id'] for e in emails if e and e.get('id') is not None])
+    # IMAP messages carry no id: SQLite assigns one and the unique
+    # (account, mailbox, uidvalidity, uid) index drops duplicates instead
+    new = [e for e in emails
+           if e and (e.get('id') is not None or e.get('uid') is not None) and e.get('id') not in existing]
+    # columns nobody in the batch sets keep their defaults: binding NULL into
+    # them (the IMAP identity above all) made first inserts ~15% slower
+    optional = [c for c in _EMAIL_OPTIONAL_COLUMNS if any(e.get(c) is not None for e in new)]
+    rows = [
+        # timestamp is part of the pagination key, so never store NULL there
+        (e.get('id'), e.get('sender', ''), e.get('subject', ''), e.get('timestamp') or '', e.get('body', ''),
+         *[int(e.get(c, True)) if c == 'body_fetched' else e.get(c) for c in optional])
+        for e in new
+    ]
+    inserted = 0
+    if rows:
+        columns = ', '.join(['id', 'sender', 'subject', 'timestamp', 'body', *optional])
+        # rowcount (unlike total_changes) ignores rows written by the FTS triggers
+        inserted = conn.executemany(f'INSERT OR IGNORE INTO emails({columns}) VALUES ({", ".join("?" * len(rows[0]))})',
+                                    rows).rowcount
+    return {'inserted': inserted, 'skipped': len(emails) - inserted}
+
+def save_emails(emails: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Bulk-insert emails in one transaction, skipping ones that already exist
+    (same id, or same IMAP identity).
+
+    Returns {'inserted': n, 'skipped': m}; entries without an id or uid count as skipped.
+    """
+    with _tx() as conn:
+        return _insert_emails(conn, emails)
+
+def get_sync_state(account: str, mailbox: str) -> Optional[Dict[str, int]]:
+    r = _conn().execute('SELECT uidvalidity, last_uid FROM imap_sync_state WHERE account=? AND mailbox=?',
+                        (account, mailbox)).fetchone()
+    if not r:
+        return None
+    return {'uidvalidity': r[0], 'last_uid': r[1]}
+
+def save_synced_emails(emails: List[Dict[str, Any]], account: str, mailbox: str,
+                       uidvalidity: int, last_uid: int) -> Dict[str, int]:
+    """Insert a batch of synced emails and advance the mailbox's sync state
+    in the same transaction, so an interrupted sync never skips messages."""
+    with _tx() as conn:
+        counts = _insert_emails(conn, emails)
+        conn.execute("REPLACE INTO imap_sync_state(account, mailbox, uidvalidity, last_uid, updated_at) "
+                     "VALUES (?, ?, ?, ?, datetime('now'))", (account, mailbox, uidvalidity, last_uid))
+    return counts
+
+def get_synced_email_ids(account: str, mailbox: str, uidvalidity: int, after_uid: int = 0) -> List[int]:
+    """Ids of emails synced from `mailbox` with a UID above `after_uid`."""
+    rows = _conn().execute('SELECT id FROM emails WHERE account=? AND mailbox=? AND uidvalidity=? AND uid>? ORDER BY uid',
+                           (account, mailbox, uidvalidity, after_uid)).fetchall()
+    return [r[0] for r in rows]
+
+def encode_cursor(*key) -> str:
+    """Opaque pagination cursor for a sort key such as (timestamp, id)."""
+    raw = json.dumps(list(key)).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor: str, types: Tuple[type, ...] = (str, int)) -> Tuple[Any, ...]:
+    """Inverse of encode_cursor, coercing each part to `types`; raises
+    ValueError for malformed cursors."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if len(key) != len(types):
+            raise ValueError('wrong cursor length')
+        return tuple(t(v) for t, v in zip(types, key))
+    except Exception as e:
+        raise ValueError(f'invalid cursor: {cursor!r}') from e
+
+def get_emails(limit: Optional[int] = None, cursor: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Emails newest first. With `limit`/`cursor`, returns one keyset page
+    starting after the position encoded in `cursor`."""
+    sql = 'SELECT id, sender, subject, timestamp FROM emails'
+    params: list = []
+    if cursor:
+        sql += ' WHERE (timestamp, id) < (?, ?)'
+        params.extend(decode_cursor(cursor))
+    sql += ' ORDER BY timestamp DESC, id DESC'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    rows = _conn().execute(sql, params).fetchall()
     return [{'id': r[0], 'sender': r[1], 'subject': r[2], 'timestamp': r[3]} for r in rows]
 
+def get_email_page(limit: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """One page of get_emails plus the cursor for the next page (None at the end)."""
+    rows = get_emails(limit + 1, cursor)
+    items = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last['timestamp'], last['id'])
+    return {'items': items, 'next_cursor': next_cursor}
+
+# bm25 has to score every match before it can sort, which gets slow for terms
+# that appear in most of a large mailbox. Ranking is therefore limited to the
+# newest SEARCH_RANK_WINDOW matches (by id), which keeps queries in the tens of
+# milliseconds while leaving selective searches unaffected. Older matches
+# follow the ranked ones, newest first.
+SEARCH_RANK_WINDOW = int(os.getenv('SEARCH_RANK_WINDOW', '5000'))
+
+_SEARCH_COLUMNS = '''SELECT e.id, e.sender, e.subject, e.timestamp,
+               snippet(emails_fts, -1, '[', ']', '…', 12), f.rank
+        FROM emails_fts f JOIN emails e ON e.id = f.rowid
+        WHERE emails_fts MATCH ?'''
+
+def _fts_query(query: str) -> str:
+    """Turn free text into an FTS5 query where every word must match.
+    Quoting each term keeps FTS5 operators in user input inert."""
+    return ' '.join('"' + t.replace('"', '""') + '"' for t in query.split())
+
+def search_emails(query: str, limit: int = 20, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """Full-text search over sender, subject and body.
+
+    Returns {'items': [...], 'next_cursor': ...}; each item carries a
+    highlighted `snippet` and its bm25 `score` (lower is better). The newest
+    SEARCH_RANK_WINDOW matches come first, best first; following next_cursor
+    then continues through the older matches, newest first.
+    """
+    match = _fts_query(query)
+    if not match:
+        return {'items': [], 'next_cursor': None}
+    conn = _conn()
+    if cursor:
+        # phase 0: inside the ranked window, after (rank, id); phase 1: older
+        # matches, below id
+        phase, after_rank, after_id, floor = decode_cursor(cursor, (int, float, int, int))
+    else:
+        phase, after_rank, after_id = 0, None, None
+        # lowest id inside the ranking window; the cursor pins it so later
+        # pages rank the same candidate set
+        r = conn.execute('SELECT rowid FROM emails_fts WHERE emails_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?',
+                         (match, SEARCH_RANK_WINDOW - 1)).fetchone()
+        floor = r[0] if r else 0
+    rows = []
+    if phase == 0:
+        sql = _SEARCH_COLUMNS + ' AND f.rowid >= ?'
+        params: list = [match, floor]
+        if after_id is not None:
+            sql += ' AND (f.rank, f.rowid) > (?, ?)'
+            params.extend((after_rank, after_id))
+        rows = conn.execute(sql + ' ORDER BY f.rank, f.rowid LIMIT ?', params + [limit + 1]).fetchall()
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            return {'items': [_search_item(r) for r in rows[:limit]],
+                    'next_cursor': encode_cursor(0, last[5], last[0], floor)}
+        after_id = floor
+    ranked = len(rows)
+    if floor:
+        rows += conn.execute(_SEARCH_COLUMNS + ' AND f.rowid < ? ORDER BY f.rowid DESC LIMIT ?',
+                             (match, after_id, limit - len(rows) + 1)).fetchall()
+    items = [_search_item(r) for r in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        # a page that ends inside the ranked window continues below it
+        next_cursor = encode_cursor(1, 0.0, floor if ranked >= limit else items[-1]['id'], floor)
+    return {'items': items, 'next_cursor': next_cursor}
+
+def _search_item(r) -> Dict[str, Any]:
+    return {'id': r[0], 'sender': r[1], 'subject': r[2], 'timestamp': r[3], 'snippet': r[4], 'score': r[5]}
+
+# Called by get_email for emails stored without a body (header-first IMAP
+# ingestion). imap_ingest registers a loader that downloads the text part.
+_body_loader = None
+
+def set_body_loader(loader):
+    """Register `loader(email) -> Optional[str]`, used to fill missing bodies lazily."""
+    global _body_loader
+    _body_loader = loader
+
 def get_email(email_id: int) -> Dict[str, Any]:
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    r = c.execute('SELECT id, sender, subject, timestamp, body FROM emails WHERE id=?', (email_id,)).fetchone()
-    conn.close()
+    r = _conn().execute('''SELECT id, sender, subject, timestamp, body, body_fetched, account, mailbox,
+                                 uidvalidity, uid, body_section, body_encoding, body_charset,
+                                 list_unsubscribe, precedence, auto_submitted
+                          FROM emails WHERE id=?''', (email_id,)).fetchone()
     if not r:
         return {}
-    return {'id': r[0], 'sender': r[1], 'subject': r[2], 'timestamp': r[3], 'body': r[4]}
+    email = {'id': r[0], 'sender': r[1], 'subject': r[2], 'timestamp': r[3], 'body': r[4], 'body_fetched': bool(r[5]),
+             'list_unsubscribe': r[13], 'precedence': r[14], 'auto_submitted': r[15]}
+    if not r[5] and _body_loader is not None:
+        pending = dict(email, account=r[6], mailbox=r[7], uidvalidity=r[8], uid=r[9],
+                       body_section=r[10], body_encoding=r[11], body_charset=r[12])
+        try:
+            body = _body_loader(pending)
+        except Exception:
+            body = None
+        if body is not None:
+            save_bodies([(email_id, body)])
+            email.update(body=body, body_fetched=True)
+    return email
+
+def save_bodies(bodies: List[Tuple[int, str]]):
+    """Store lazily downloaded bodies as (email_id, body) pairs."""
+    with _tx() as conn:
+        conn.executemany('UPDATE emails SET body=?, body_fetched=1 WHERE id=?', [(b, i) for i, b in bodies])
+
+def get_pending_bodies(account: str, mailbox: str, limit: Optional[int] = None,
+                       email_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """Emails from `account`/`mailbox` (optionally only `email_ids`) whose body
+    has not been downloaded yet."""
+    sql = '''SELECT id, uidvalidity, uid, body_section, body_encoding, body_charset FROM emails
+             WHERE account=? AND mailbox=? AND body_fetched=0'''
+    params: list = [account, mailbox]
+    if email_ids:
+        sql += f' AND id IN ({",".join("?" * len(email_ids))})'
+        params.extend(email_ids)
+    sql += ' ORDER BY uid DESC'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    rows = _conn().execute(sql, params).fetchall()
+    return [{'id': r[0], 'uidvalidity': r[1], 'uid': r[2], 'body_section': r[3], 'body_encoding': r[4],
+             'body_charset': r[5]} for r in rows]
+
+def get_inbox_stats() -> Dict[str, int]:
+    """Dashboard counters in a single query, independent of mailbox size."""
+    r = _conn().execute('''
+        SELECT
+            (SELECT COUNT(*) FROM emails),
+            (SELECT COUNT(*) FROM processed p WHERE EXISTS (SELECT 1 FROM emails e WHERE e.id = p.email_id)),
+            (SELECT COUNT(*) FROM drafts d WHERE EXISTS (SELECT 1 FROM emails e WHERE e.id = d.email_id))
+    ''').fetchone()
+    return {'total': r[0], 'processed': r[1], 'drafts': r[2]}
 
 def save_processed(email_id: int, categories: Dict[str, Any], tasks: List[Dict[str, Any]]):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('REPLACE INTO processed(email_id, categories, tasks) VALUES (?, ?, ?)',
-              (email_id, json.dumps(categories), json.dumps(tasks)))
-    conn.commit()
-    conn.close()
+    with _tx() as conn:
+        conn.execute('REPLACE INTO processed(email_id, categories, tasks) VALUES (?, ?, ?)',
+                     (email_id, json.dumps(categories), json.dumps(tasks)))
+
+def save_processed_many(results: List[Tuple[int, Any, Any]]):
+    """Persist several (email_id, categories, tasks) results in one transaction."""
+    rows = [(email_id, json.dumps(categories), json.dumps(tasks)) for email_id, categories, tasks in results]
+    with _tx() as conn:
+        conn.executemany('REPLACE INTO processed(email_id, categories, tasks) VALUES (?, ?, ?)', rows)
+
+def get_unprocessed_emails(limit: Optional[int] = None, sender: Optional[str] = None,
+                           email_ids: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """Emails with no row in `processed`, newest first, optionally filtered by
+    sender (substring match) or an explicit id list."""
+    sql = '''SELECT e.id, e.sender, e.subject, e.timestamp, e.body, e.body_fetched,
+                    e.list_unsubscribe, e.precedence, e.auto_submitted, e.account, e.mailbox FROM emails e
+             WHERE NOT EXISTS (SELECT 1 FROM processed p WHERE p.email_id = e.id)'''
+    params: list = []
+    if sender:
+        sql += ' AND e.sender LIKE ?'
+        params.append(f'%{sender}%')
+    if email_ids:
+        sql += f' AND e.id IN ({",".join("?" * len(email_ids))})'
+        params.extend(email_ids)
+    sql += ' ORDER BY e.timestamp DESC, e.id DESC'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    rows = _conn().execute(sql, params).fetchall()
+    return [{'id': r[0], 'sender': r[1], 'subject': r[2], 'timestamp': r[3], 'body': r[4], 'body_fetched': bool(r[5]),
+             'list_unsubscribe': r[6], 'precedence': r[7], 'auto_submitted': r[8], 'account': r[9], 'mailbox': r[10]}
+            for r in rows]
 
 def get_processed(email_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    r = c.execute('SELECT categories, tasks FROM processed WHERE email_id=?', (email_id,)).fetchone()
-    conn.close()
+    r = _conn().execute('SELECT categories, tasks FROM processed WHERE email_id=?', (email_id,)).fetchone()
     if not r:
         return None
     return {'categories': json.loads(r[0]), 'tasks': json.loads(r[1])}
 
+def _default_prompts() -> Dict[str, str]:
+    try:
+        base = os.path.join(os.path.dirname(__file__), 'prompts', 'default_prompts.json')
+        with open(base, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except Exception:
+        return {}
+    # ensure we store a string
+    return {k: (v if isinstance(v, str) else json.dumps(v)) for k, v in data.items()}
+
 def get_prompts():
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    rows = c.execute('SELECT name, content FROM prompts').fetchall()
-    conn.close()
-    if not rows:
-        # load defaults from prompts/default_prompts.json if present
-        try:
-            base = os.path.join(os.path.dirname(__file__), 'prompts', 'default_prompts.json')
-            with open(base, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            # seed DB with raw string content
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            for k, v in data.items():
-                # ensure we store a string
-                content = v if isinstance(v, str) else json.dumps(v)
-                c.execute('INSERT OR REPLACE INTO prompts(name, content) VALUES (?, ?)', (k, content))
-            conn.commit()
-            conn.close()
-            return {k: (v if isinstance(v, str) else json.dumps(v)) for k, v in data.items()}
-        except Exception:
-            return {}
-    result = {}
-    for r in rows:
-        # return content as raw string
-        result[r[0]] = r[1]
+    rows = _conn().execute('SELECT name, content FROM prompts').fetchall()
+    # return content as raw string
+    result = {r[0]: r[1] for r in rows}
+    # seed the DB with defaults from prompts/default_prompts.json, including
+    # prompts added to that file after this database was first created
+    missing = {k: v for k, v in _default_prompts().items() if k not in result}
+    if missing:
+        with _tx() as conn:
+            conn.executemany('INSERT OR IGNORE INTO prompts(name, content) VALUES (?, ?)', list(missing.items()))
+        result.update(missing)
     return result
 
 def save_prompt(name: str, content: str):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('REPLACE INTO prompts(name, content) VALUES (?, ?)', (name, content))
-    conn.commit()
-    conn.close()
+    with _tx() as conn:
+        conn.execute('REPLACE INTO prompts(name, content) VALUES (?, ?)', (name, content))
 
 def save_draft(email_id: int, subject: str, body: str, metadata: Dict[str, Any]=None):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('INSERT INTO drafts(email_id, subject, body, metadata) VALUES (?, ?, ?, ?)',
-              (email_id, subject, body, json.dumps(metadata or {})))
-    conn.commit()
-    conn.close()
+    with _tx() as conn:
+        conn.execute('INSERT INTO drafts(email_id, subject, body, metadata) VALUES (?, ?, ?, ?)',
+                     (email_id, subject, body, json.dumps(metadata or {})))
 
 def get_drafts(email_id: int):
-    init_db()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    rows = c.execute('SELECT id, subject, body, metadata FROM drafts WHERE email_id=? ORDER BY id DESC', (email_id,)).fetchall()
-    conn.close()
+    rows = _conn().execute('SELECT id, subject, body, metadata FROM drafts WHERE email_id=? ORDER BY id DESC', (email_id,)).fetchall()
     return [{'id': r[0], 'subject': r[1], 'body': r[2], 'metadata': json.loads(r[3])} for r in rows]
+
+def get_cached_response(key: str, ttl: float):
+    """Cached LLM response text for `key`, or None if missing or older than `ttl` seconds."""
+    now = time.time()
+    r = _conn().execute('SELECT response, created_at FROM llm_cache WHERE key=?', (key,)).fetchone()
+    if not r:
+        return None
+    with _tx() as conn:
+        if now - r[1] > ttl:
+            conn.execute('DELETE FROM llm_cache WHERE key=?', (key,))
+            return None
+        conn.execute('UPDATE llm_cache SET last_used=? WHERE key=?', (now, key))
+    return r[0]
+
+def save_cached_response(key: str, task: str, model: str, response: str, max_entries: int):
+    """Store an LLM response and evict least-recently-used entries beyond `max_entries`."""
+    now = time.time()
+    with _tx() as conn:
+        conn.execute('REPLACE INTO llm_cache(key, task, model, response, created_at, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                     (key, task, model, response, now, now))
+        conn.execute('DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                     (max_entries,))
+
+def clear_llm_cache() -> int:
+    with _tx() as conn:
+        return conn.execute('DELETE FROM llm_cache').rowcount
+
+def _job_row(r) -> Dict[str, Any]:
+    return {'id': r[0], 'kind': r[1], 'params': json.loads(r[2]), 'status': r[3],
+            'progress': json.loads(r[4]) if r[4] else None, 'result': json.loads(r[5]) if r[5] else None,
+            'error': r[6], 'attempts': r[7], 'created_at': r[8], 'started_at': r[9], 'finished_at': r[10],
+            'updated_at': r[11]}
+
+_JOB_COLUMNS = 'id, kind, params, status, progress, result, error, attempts, created_at, started_at, finished_at, updated_at'
+
+def create_job(job_id: str, kind: str, params: Dict[str, Any]):
+    now = time.time()
+    with _tx() as conn:
+        conn.execute('INSERT INTO jobs(id, kind, params, created_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+                     (job_id, kind, json.dumps(params), now, now))
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    r = _conn().execute(f'SELECT {_JOB_COLUMNS} FROM jobs WHERE id=?', (job_id,)).fetchone()
+    return _job_row(r) if r else None
+
+def list_jobs(status: Optional[str] = None, kind: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    sql = f'SELECT {_JOB_COLUMNS} FROM jobs WHERE 1=1'
+    params: list = []
+    if status:
+        sql += ' AND status=?'
+        params.append(status)
+    if kind:
+        sql += ' AND kind=?'
+        params.append(kind)
+    sql += ' ORDER BY created_at DESC LIMIT ?'
+    params.append(limit)
+    return [_job_row(r) for r in _conn().execute(sql, params).fetchall()]
+
+def claim_job() -> Optional[Dict[str, Any]]:
+    """Mark the oldest queued job as running and return it (None if the queue
+    is empty). Safe to call from several threads or processes."""
+    conn = _conn()
+    while True:
+        r = conn.execute("SELECT id FROM jobs WHERE status='queued' ORDER BY created_at LIMIT 1").fetchone()
+        if not r:
+            return None
+        now = time.time()
+        with _tx() as tx:
+            claimed = tx.execute("UPDATE jobs SET status='running', attempts=attempts+1, started_at=?, updated_at=? "
+                                 "WHERE id=? AND status='queued'", (now, now, r[0])).rowcount
+        if claimed:
+            return get_job(r[0])
+
+def update_jobs_progress(progress: Dict[str, Any]):
+    """Persist progress for running jobs ({job id: progress dict}); also acts as their heartbeat."""
+    now = time.time()
+    with _tx() as conn:
+        conn.executemany("UPDATE jobs SET progress=?, updated_at=? WHERE id=? AND status='running'",
+                         [(json.dumps(p), now, job_id) for job_id, p in progress.items()])
+
+def finish_job(job_id: str, result: Any = None, error: Optional[str] = None, progress: Optional[Dict[str, Any]] = None):
+    now = time.time()
+    with _tx() as conn:
+        conn.execute('UPDATE jobs SET status=?, result=?, error=?, progress=COALESCE(?, progress), finished_at=?, updated_at=? '
+                     'WHERE id=?', ('error' if error else 'finished', json.dumps(result), error,
+                                    json.dumps(progress) if progress is not None else None, now, now, job_id))
+
+def requeue_stale_jobs(stale_after: float, max_attempts: int) -> int:
+    """Requeue running jobs whose worker stopped heartbeating (e.g. the process
+    was restarted); jobs that already used `max_attempts` are failed instead."""
+    cutoff = time.time() - stale_after
+    with _tx() as conn:
+        conn.execute("UPDATE jobs SET status='error', error='worker lost too many times', finished_at=? "
+                     "WHERE status='running' AND updated_at<? AND attempts>=?", (time.time(), cutoff, max_attempts))
+        return conn.execute("UPDATE jobs SET status='queued' WHERE status='running' AND updated_at<?", (cutoff,)).rowcount
+
+
+_LLM_CALL_COLUMNS = ('created_at', 'task', 'model', 'status', 'cache', 'parse', 'latency_ms', 'prompt_tokens',
+                     'completion_tokens', 'cost_usd', 'error')
+
+_LLM_TOTAL_KEYS = ('task', 'model', 'status', 'cache', 'parse')
+
+def save_llm_calls(calls: List[Dict[str, Any]], latency_buckets: Tuple[float, ...] = ()):
+    """Store call records and add them to the running totals (see
+    get_llm_call_totals), counting each call under every latency bucket
+    (milliseconds) it fits in."""
+    totals: Dict[tuple, List[float]] = {}
+    latency: Dict[tuple, int] = {}
+    for c in calls:
+        key = tuple(c.get(k) or '' for k in _LLM_TOTAL_KEYS)
+        t = totals.setdefault(key, [0, 0.0, 0, 0, 0.0])
+        t[0] += 1
+        t[1] += c.get('latency_ms') or 0
+        t[2] += c.get('prompt_tokens') or 0
+        t[3] += c.get('completion_tokens') or 0
+        t[4] += c.get('cost_usd') or 0
+        for b in latency_buckets:
+            if c.get('latency_ms') is not None and c['latency_ms'] <= b:
+                latency[(key[0], float(b))] = latency.get((key[0], float(b)), 0) + 1
+    with _tx() as conn:
+        conn.executemany(f"INSERT INTO llm_calls({', '.join(_LLM_CALL_COLUMNS)}) VALUES ({', '.join('?' * len(_LLM_CALL_COLUMNS))})",
+                         [tuple(c.get(k) for k in _LLM_CALL_COLUMNS) for c in calls])
+        conn.executemany(
+            'INSERT INTO llm_call_totals(task, model, status, cache, parse, calls, latency_ms, prompt_tokens, '
+            'completion_tokens, cost_usd) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(task, model, status, cache, parse) DO UPDATE SET calls = calls + excluded.calls, '
+            'latency_ms = latency_ms + excluded.latency_ms, prompt_tokens = prompt_tokens + excluded.prompt_tokens, '
+            'completion_tokens = completion_tokens + excluded.completion_tokens, cost_usd = cost_usd + excluded.cost_usd',
+            [key + tuple(t) for key, t in totals.items()])
+        conn.executemany('INSERT INTO llm_latency_totals(task, le_ms, calls) VALUES (?, ?, ?) '
+                         'ON CONFLICT(task, le_ms) DO UPDATE SET calls = calls + excluded.calls',
+                         [key + (n,) for key, n in latency.items()])
+
+def get_llm_call_stats(since: Optional[float] = None, latency_buckets: Tuple[float, ...] = ()) -> List[Dict[str, Any]]:
+    """LLM call totals grouped by (task, model, status, cache, parse); each row
+    also counts calls at or under every latency bucket (milliseconds)."""
+    buckets = ''.join(f', SUM(latency_ms <= {float(b)})' for b in latency_buckets)
+    rows = _conn().execute(
+        'SELECT task, model, status, cache, parse, COUNT(*), COALESCE(SUM(latency_ms), 0), '
+        'COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(cost_usd), 0)'
+        f'{buckets} FROM llm_calls WHERE created_at >= ? GROUP BY task, model, status, cache, parse',
+        (since or 0,)).fetchall()
+    return [{'task': r[0], 'model': r[1], 'status': r[2], 'cache': r[3], 'parse': r[4], 'calls': r[5],
+             'latency_ms': r[6], 'prompt_tokens': r[7], 'completion_tokens': r[8], 'cost_usd': r[9],
+             'latency_buckets': list(r[10:])} for r in rows]
+
+def get_llm_call_totals() -> List[Dict[str, Any]]:
+    """Running totals of every LLM call recorded, grouped by (task, model,
+    status, cache, parse); unlike llm_calls they are never pruned."""
+    rows = _conn().execute('SELECT task, model, status, cache, parse, calls, latency_ms, prompt_tokens, '
+                           'completion_tokens, cost_usd FROM llm_call_totals').fetchall()
+    return [{'task': r[0], 'model': r[1], 'status': r[2], 'cache': r[3], 'parse': r[4], 'calls': r[5],
+             'latency_ms': r[6], 'prompt_tokens': r[7], 'completion_tokens': r[8], 'cost_usd': r[9]} for r in rows]
+
+def get_llm_latency_totals(latency_buckets: Tuple[float, ...]) -> Dict[str, List[int]]:
+    """Running count of calls per task at or under each latency bucket (milliseconds)."""
+    counts: Dict[tuple, int] = {(r[0], r[1]): r[2] for r in
+                                _conn().execute('SELECT task, le_ms, calls FROM llm_latency_totals').fetchall()}
+    tasks = {task for task, _ in counts}
+    return {task: [counts.get((task, float(b)), 0) for b in latency_buckets] for task in tasks}
+
+def prune_llm_calls(older_than: float) -> int:
+    with _tx() as conn:
+        return conn.execute('DELETE FROM llm_calls WHERE created_at < ?', (older_than,)).rowcount
+
+def get_classifier_rules() -> List[Dict[str, Any]]:
+    rows = _conn().execute('SELECT id, field, pattern, category, created_at FROM classifier_rules ORDER BY id').fetchall()
+    return [{'id': r[0], 'field': r[1], 'pattern': r[2], 'category': r[3], 'created_at': r[4]} for r in rows]
+
+def add_classifier_rule(field: str, pattern: str, category: str) -> int:
+    with _tx() as conn:
+        return conn.execute("INSERT INTO classifier_rules(field, pattern, category, created_at) VALUES (?, ?, ?, datetime('now'))",
+                            (field, pattern, category)).lastrowid
+
+def delete_classifier_rule(rule_id: int) -> bool:
+    with _tx() as conn:
+        return conn.execute('DELETE FROM classifier_rules WHERE id=?', (rule_id,)).rowcount > 0
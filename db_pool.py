@@ -0,0 +1,116 @@
+"""
+SQLite connection manager used by db.py.
+
+sqlite3 connections are cheap to reuse but comparatively expensive to open, so
+instead of connecting on every call we keep one long-lived connection per
+(thread, database path). Each connection is configured once with WAL
+journaling and a few tuned pragmas, and the schema callback registered for a
+path runs only the first time that path is opened in this process. A
+thread's connections are closed when the thread exits, so short-lived
+threads (executors, asyncio.run's default executor) do not leak them.
+
+Functions:
+- get_connection(path, init=None)
+- transaction(path, init=None)
+- close_all()
+"""
+import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+# Applied to every new connection. WAL lets readers proceed while a writer is
+# active; synchronous=NORMAL is durable under WAL except on power loss.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=134217728',
+)
+
+BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5.0'))
+
+_local = threading.local()
+_lock = threading.Lock()
+_initialized: set = set()
+_generation = 0
+
+
+def _close_conns(conns: Dict[str, sqlite3.Connection]):
+    for conn in conns.values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    conns.clear()
+
+
+class _ThreadConns:
+    """One thread's connections by path. Held only by the thread-local, so
+    it is collected when the thread exits and the finalizer closes them."""
+
+    def __init__(self):
+        self.conns: Dict[str, sqlite3.Connection] = {}
+        self.generation = _generation
+        weakref.finalize(self, _close_conns, self.conns)
+
+
+_threads: 'weakref.WeakSet[_ThreadConns]' = weakref.WeakSet()
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # each connection is only used by the thread that opened it, but
+    # close_all() may close it from another thread at shutdown
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection(path: str, init: Optional[Callable[[sqlite3.Connection], None]] = None) -> sqlite3.Connection:
+    """Return this thread's connection to `path`, opening it on first use.
+
+    `init` is called with the connection the first time `path` is opened in the
+    process (e.g. to create tables) and skipped on every later call.
+    """
+    held: Optional[_ThreadConns] = getattr(_local, 'held', None)
+    if held is None or held.generation != _generation:
+        # first use on this thread, or close_all() ran since we last connected
+        held = _local.held = _ThreadConns()
+        with _lock:
+            _threads.add(held)
+    conn = held.conns.get(path)
+    if conn is None:
+        conn = held.conns[path] = _connect(path)
+    if init is not None and path not in _initialized:
+        with _lock:
+            if path not in _initialized:
+                init(conn)
+                conn.commit()
+                _initialized.add(path)
+    return conn
+
+
+@contextmanager
+def transaction(path: str, init: Optional[Callable[[sqlite3.Connection], None]] = None) -> Iterator[sqlite3.Connection]:
+    """Yield the pooled connection; commit on success, roll back on error."""
+    conn = get_connection(path, init)
+    with conn:
+        yield conn
+
+
+def close_all():
+    """Close every connection opened by this module (e.g. on app shutdown)."""
+    global _generation
+    with _lock:
+        for held in list(_threads):
+            _close_conns(held.conns)
+        _threads.clear()
+        _initialized.clear()
+        _generation += 1
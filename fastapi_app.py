@@ -1,21 +1,34 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
+import asyncio
+import json
 import os
 
 from db import (
     init_db,
-    get_emails,
+    close_db,
+    get_email_page,
+    search_emails,
     get_email,
+    get_inbox_stats,
     save_processed,
     get_processed,
     get_prompts,
     save_draft,
     get_drafts,
-    save_emails,
+    clear_llm_cache,
 )
-from imap_ingest import fetch_imap_emails
+from imap_ingest import sync_imap, remember_credentials, close_body_connections
 import llm
+import llm_async
+import llm_client
+import llm_metrics
+import llm_resilience
+import imap_sync
+import jobs
+import rules
 
 app = FastAPI(title="Email Productivity Agent API", version="1.0.0")
 
@@ -25,7 +38,17 @@ class ImapIngestRequest(BaseModel):
     username: Optional[str] = None
     password: Optional[str] = None
     mailbox: Optional[str] = "INBOX"
-    limit: Optional[int] = Field(default=50, ge=1, le=500)
+    limit: Optional[int] = Field(default=50, ge=1, le=10000)
+    # store headers now and download text bodies in the background
+    headers_only: Optional[bool] = None
+    # run the sync in the request instead of as a background job
+    wait: bool = False
+
+
+class SourcesIngestRequest(BaseModel):
+    limit: int = Field(default=50, ge=1, le=10000)
+    max_workers: Optional[int] = Field(default=None, ge=1, le=32)
+    headers_only: Optional[bool] = None
 
 
 class ChatRequest(BaseModel):
@@ -36,9 +59,56 @@ class DraftRequest(BaseModel):
     tone: str = Field(default="friendly")
 
 
+class RuleRequest(BaseModel):
+    # sender: glob such as "*@spammy.io"; subject/body: case-insensitive substring
+    field: str = Field(..., pattern="^(sender|subject|body)$")
+    pattern: str = Field(..., min_length=1, max_length=500)
+    category: str = Field(..., min_length=1, max_length=100)
+
+
+class BatchProcessRequest(BaseModel):
+    email_ids: Optional[List[int]] = Field(default=None, max_length=5000)
+    sender: Optional[str] = None
+    limit: Optional[int] = Field(default=None, ge=1, le=20000)
+    concurrency: int = Field(default=4, ge=1, le=32)
+    requests_per_minute: Optional[float] = Field(default=None, gt=0)
+    refresh: bool = False
+    combined: Optional[bool] = None
+
+
+# started on startup; runs queued jobs (see jobs.py)
+_job_pool: Optional[jobs.JobWorkerPool] = None
+
+
 @app.on_event("startup")
 def _startup():
+    global _job_pool
     init_db()
+    _job_pool = jobs.JobWorkerPool().start()
+
+
+@app.on_event("shutdown")
+def _shutdown():
+    if _job_pool is not None:
+        # unfinished jobs stay 'running' and are requeued by the next process
+        _job_pool.stop(timeout=5)
+    llm_metrics.flush()
+    llm_client.close()
+    close_body_connections()
+    close_db()
+
+
+@app.exception_handler(llm.LLMError)
+def _llm_error(request, exc: llm.LLMError):
+    # 429 when rate limited, 503 while the API is failing, 502 for rejected requests
+    if isinstance(exc, llm.RateLimitError):
+        status = 429
+    elif exc.retryable or isinstance(exc, llm.CircuitOpenError):
+        status = 503
+    else:
+        status = 502
+    headers = {"Retry-After": str(max(1, round(exc.retry_after)))} if exc.retry_after is not None else None
+    return JSONResponse(status_code=status, content={"detail": f"LLM request failed: {exc}"}, headers=headers)
 
 
 def _imap_config_from_env():
@@ -58,10 +128,68 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """LLM call counts, tokens, cost and latency in the Prometheus text format."""
+    return PlainTextResponse(llm_metrics.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/llm/cache")
+def llm_cache_stats():
+    return llm.cache_stats()
+
+
+@app.get("/llm/preprocess")
+def llm_preprocess_stats():
+    return llm.preprocess_stats()
+
+
+@app.get("/llm/status")
+def llm_status():
+    return llm_resilience.status()
+
+
+@app.delete("/llm/cache")
+def llm_cache_clear():
+    return {"deleted": clear_llm_cache()}
+
+
+@app.get("/rules")
+def list_rules():
+    """User-defined classifier rules, and how many emails the rules answered without the LLM."""
+    return {"rules": rules.list_rules(), "stats": rules.stats()}
+
+
+@app.post("/rules")
+def add_rule(payload: RuleRequest):
+    try:
+        return rules.add_rule(payload.field, payload.pattern, payload.category)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.delete("/rules/{rule_id}")
+def delete_rule(rule_id: int):
+    if not rules.delete_rule(rule_id):
+        raise HTTPException(status_code=404, detail="Rule not found")
+    return {"deleted": rule_id}
+
+
+def _job_response(job_id: str, **extra):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job_id, **extra, **job}
+
+
 @app.post("/ingest/gmail")
-def ingest_gmail(payload: Optional[ImapIngestRequest] = None):
+async def ingest_gmail(payload: Optional[ImapIngestRequest] = None):
     server, username, password, mailbox, limit = _imap_config_from_env()
+    headers_only = None
+    wait = False
     if payload:
+        headers_only = payload.headers_only
+        wait = payload.wait
         server = payload.server or server
         username = payload.username or username
         password = payload.password or password
@@ -71,18 +199,71 @@ def ingest_gmail(payload: Optional[ImapIngestRequest] = None):
     if not username or not password:
         raise HTTPException(status_code=400, detail="IMAP_USERNAME and IMAP_PASSWORD must be set (Gmail app password recommended).")
 
+    if not wait:
+        # the password stays in memory; the job row only names the account
+        account = remember_credentials(server, username, password)
+        job_id = await asyncio.to_thread(jobs.submit, "ingest_gmail", {"account": account, "mailbox": mailbox,
+                                                                       "limit": limit, "headers_only": headers_only})
+        return _job_response(job_id)
+
     try:
-        emails = fetch_imap_emails(server, username, password, mailbox=mailbox, limit=limit)
+        result = await asyncio.to_thread(sync_imap, server, username, password, mailbox=mailbox, limit=limit,
+                                         headers_only=headers_only)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"IMAP fetch failed: {e}")
 
-    save_emails(emails)
-    return {"ingested": len(emails), "mailbox": mailbox}
+    if result["headers_only"] and result["inserted"]:
+        await asyncio.to_thread(jobs.submit, "fill_bodies", {"account": result["account"], "mailbox": mailbox})
+
+    return {"ingested": result["fetched"], **result}
+
+
+@app.post("/ingest/sources")
+def ingest_sources(payload: Optional[SourcesIngestRequest] = None):
+    payload = payload or SourcesIngestRequest()
+    try:
+        sources = imap_sync.load_sources()
+    except (OSError, ValueError) as e:
+        raise HTTPException(status_code=500, detail=f"Cannot read IMAP sources: {e}")
+    if not sources:
+        raise HTTPException(status_code=400, detail="No IMAP sources configured (set IMAP_SOURCES_FILE or IMAP_USERNAME/IMAP_PASSWORD).")
+    return _job_response(jobs.submit("ingest_sources", payload.model_dump()))
+
+
+@app.get("/ingest/{job_id}")
+def ingest_status(job_id: str):
+    return _job_response(job_id)
+
+
+@app.get("/jobs")
+def list_jobs(status: Optional[str] = None, kind: Optional[str] = None, limit: int = Query(default=50, ge=1, le=500)):
+    return jobs.list_jobs(status=status, kind=kind, limit=limit)
+
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    return _job_response(job_id)
+
+
+@app.get("/stats")
+def inbox_stats():
+    return get_inbox_stats()
 
 
 @app.get("/emails")
-def list_emails():
-    return get_emails()
+def list_emails(limit: int = Query(default=50, ge=1, le=500), cursor: Optional[str] = None):
+    try:
+        return get_email_page(limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/search")
+def search(q: str = Query(..., min_length=1), limit: int = Query(default=20, ge=1, le=100), cursor: Optional[str] = None):
+    try:
+        return search_emails(q, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/emails/{email_id}")
@@ -102,43 +283,143 @@ def read_processed(email_id: int):
 
 
 @app.post("/emails/{email_id}/process")
-def process_email(email_id: int):
-    email_data = get_email(email_id)
+async def process_email(email_id: int, refresh: bool = False, combined: Optional[bool] = None, background: bool = False):
+    email_data = await asyncio.to_thread(get_email, email_id)
     if not email_data:
         raise HTTPException(status_code=404, detail="Email not found")
-    prompts = get_prompts()
-    categorization_prompt = prompts.get("categorization_prompt") or ""
-    action_item_prompt = prompts.get("action_item_prompt") or ""
-    categories = llm.categorize(email_data.get("body", ""), categorization_prompt)
-    tasks = llm.extract_actions(email_data.get("body", ""), action_item_prompt)
-    save_processed(email_id, categories, tasks)
+    if background:
+        job_id = await asyncio.to_thread(jobs.submit, "process_email",
+                                         {"email_id": email_id, "refresh": refresh, "combined": combined})
+        return _job_response(job_id)
+    prompts = await asyncio.to_thread(get_prompts)
+    categories, tasks = await llm_async.analyze_email(email_data.get("body", ""), prompts, use_cache=not refresh, combined=combined,
+                                                      email=email_data)
+    await asyncio.to_thread(save_processed, email_id, categories, tasks)
     return {"categories": categories, "tasks": tasks}
 
 
 @app.post("/emails/{email_id}/chat")
-def chat_email(email_id: int, payload: ChatRequest):
-    email_data = get_email(email_id)
+async def chat_email(email_id: int, payload: ChatRequest):
+    email_data = await asyncio.to_thread(get_email, email_id)
     if not email_data:
         raise HTTPException(status_code=404, detail="Email not found")
-    prompts = get_prompts()
-    reply = llm.chat_with_email(email_data.get("body", ""), prompts, payload.query)
+    prompts = await asyncio.to_thread(get_prompts)
+    reply = await llm_async.chat_with_email(email_data.get("body", ""), prompts, payload.query)
     return {"reply": reply}
 
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _sse_error(exc: llm.LLMError) -> str:
+    return _sse("error", {"detail": str(exc), "retryable": exc.retryable, "retry_after": exc.retry_after})
+
+
+def _event_stream(events):
+    # disable proxy buffering so chunks reach the client as they are produced
+    return StreamingResponse(events, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.api_route("/emails/{email_id}/chat/stream", methods=["GET", "POST"])
+async def chat_email_stream(email_id: int, q: Optional[str] = None, payload: Optional[ChatRequest] = None):
+    """Server-Sent Events: `delta` events with text chunks, then `done` with the full reply
+    (or `error` if the model call fails).
+    GET takes the question as ?q= (for EventSource); POST takes the ChatRequest body."""
+    query = payload.query if payload else q
+    if not query:
+        raise HTTPException(status_code=422, detail="query is required")
+    email_data = await asyncio.to_thread(get_email, email_id)
+    if not email_data:
+        raise HTTPException(status_code=404, detail="Email not found")
+    prompts = await asyncio.to_thread(get_prompts)
+
+    async def events():
+        parts = []
+        try:
+            async for delta in llm_async.chat_with_email_stream(email_data.get("body", ""), prompts, query):
+                parts.append(delta)
+                yield _sse("delta", {"text": delta})
+        except llm.LLMError as exc:
+            yield _sse_error(exc)
+            return
+        yield _sse("done", {"reply": "".join(parts)})
+
+    return _event_stream(events())
+
+
+@app.api_route("/emails/{email_id}/draft/stream", methods=["GET", "POST"])
+async def draft_email_stream(email_id: int, tone: str = "friendly", refresh: bool = False,
+                             payload: Optional[DraftRequest] = None):
+    """Server-Sent Events: `delta` events with raw text chunks, `body` events with
+    the new text of the reply body (the model answers in JSON), then `done` with
+    the parsed draft once it is saved; `error` ends a failed stream without saving."""
+    tone = payload.tone if payload else tone
+    email_data = await asyncio.to_thread(get_email, email_id)
+    if not email_data:
+        raise HTTPException(status_code=404, detail="Email not found")
+    prompts = await asyncio.to_thread(get_prompts)
+    auto_reply_prompt = prompts.get("auto_reply_prompt") or ""
+
+    async def events():
+        parts = []
+        shown = ""
+        try:
+            async for delta in llm_async.generate_draft_stream(email_data.get("body", ""), auto_reply_prompt, tone=tone,
+                                                               use_cache=not refresh):
+                parts.append(delta)
+                yield _sse("delta", {"text": delta})
+                preview = llm.draft_preview("".join(parts))
+                if preview != shown:
+                    if preview.startswith(shown):
+                        yield _sse("body", {"text": preview[len(shown):]})
+                    else:
+                        yield _sse("body", {"text": preview, "replace": True})
+                    shown = preview
+            draft = llm.parse_draft("".join(parts))
+        except llm.LLMError as exc:
+            # nothing is saved from a partial or empty reply
+            yield _sse_error(exc)
+            return
+        subject = draft.get("subject", "") if isinstance(draft, dict) else ""
+        body = draft.get("body", "") if isinstance(draft, dict) else str(draft)
+        await asyncio.to_thread(save_draft, email_id, subject, body, {"tone": tone})
+        yield _sse("done", {"draft": draft})
+
+    return _event_stream(events())
+
+
 @app.post("/emails/{email_id}/draft")
-def draft_email(email_id: int, payload: DraftRequest):
-    email_data = get_email(email_id)
+async def draft_email(email_id: int, payload: DraftRequest, refresh: bool = False, background: bool = False):
+    email_data = await asyncio.to_thread(get_email, email_id)
     if not email_data:
         raise HTTPException(status_code=404, detail="Email not found")
-    prompts = get_prompts()
+    if background:
+        job_id = await asyncio.to_thread(jobs.submit, "draft_email",
+                                         {"email_id": email_id, "tone": payload.tone, "refresh": refresh})
+        return _job_response(job_id)
+    prompts = await asyncio.to_thread(get_prompts)
     auto_reply_prompt = prompts.get("auto_reply_prompt") or ""
-    draft = llm.generate_draft(email_data.get("body", ""), auto_reply_prompt, tone=payload.tone)
+    draft = await llm_async.generate_draft(email_data.get("body", ""), auto_reply_prompt, tone=payload.tone, use_cache=not refresh)
     subject = draft.get("subject", "") if isinstance(draft, dict) else ""
     body = draft.get("body", "") if isinstance(draft, dict) else str(draft)
-    save_draft(email_id, subject, body, metadata={"tone": payload.tone})
+    await asyncio.to_thread(save_draft, email_id, subject, body, {"tone": payload.tone})
     return {"draft": draft}
 
 
+@app.post("/process/batch")
+def process_batch(payload: Optional[BatchProcessRequest] = None):
+    payload = payload or BatchProcessRequest()
+    job_id = jobs.submit("process_batch", payload.model_dump())
+    return _job_response(job_id, batch_id=job_id)
+
+
+@app.get("/process/batch/{batch_id}")
+def batch_status(batch_id: str):
+    return _job_response(batch_id, batch_id=batch_id)
+
+
 @app.get("/emails/{email_id}/drafts")
 def list_drafts(email_id: int):
     return get_drafts(email_id)
@@ -2,15 +2,56 @@
 Read-only IMAP ingestion helper. Use with caution — store credentials securely and prefer app passwords or OAuth.
 
 Functions:
-- fetch_imap_emails(server, username, password, mailbox='INBOX', limit=50)
+- fetch_imap_emails(server, username, password, mailbox='INBOX', limit=50, since_uid=None, batch_size=None, headers_only=False)
+- iter_imap_emails(...) (same arguments, generator)
+- sync_imap(server, username, password, mailbox='INBOX', limit=50, batch_size=None, headers_only=None, progress=None)
+- fill_bodies(server, username, password, mailbox='INBOX', limit=None, batch_size=None, email_ids=None)
+- load_body(email_row), close_body_connections()
+
+Messages are identified by (account, mailbox, UIDVALIDITY, UID), which stays
+stable across sessions and expunges, unlike message sequence numbers.
+sync_imap remembers the highest UID seen per account/mailbox so later syncs
+only download new messages. Messages are downloaded in pipelined UID FETCH
+batches (IMAP_FETCH_BATCH per round trip) rather than one request each, and
+each batch is persisted (with the sync position) before the next is fetched.
+
+With headers_only (IMAP_LAZY_BODIES=1) only BODYSTRUCTURE and the From,
+Subject, Date and bulk-mail (List-Unsubscribe, Precedence, Auto-Submitted)
+headers are downloaded, so attachments never cross the wire.
+The text/plain section is fetched later, either by fill_bodies or on demand
+when db.get_email() is called for a message without a body; on-demand
+downloads reuse one open connection per account instead of logging in for
+every message.
 
 This module uses Python's built-in imaplib and email packages.
 """
 import imaplib
 import email
+import os
+import email.utils
 from email.header import decode_header
-from typing import List, Dict
-import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import base64
+import quopri
+import re
+import threading
+import time
+
+import db
+
+# messages requested per UID FETCH round trip
+FETCH_BATCH_SIZE = int(os.getenv('IMAP_FETCH_BATCH', '100'))
+# download headers first and bodies lazily
+LAZY_BODIES = os.getenv('IMAP_LAZY_BODIES', '0').lower() in ('1', 'true', 'yes')
+HEADER_ITEMS = 'BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE LIST-UNSUBSCRIBE PRECEDENCE AUTO-SUBMITTED)]'
+
+# account -> (server, username, password) for lazy body downloads; filled by
+# sync runs in this process, with IMAP_SERVER/IMAP_USERNAME/IMAP_PASSWORD as fallback
+_credentials: Dict[str, Tuple[str, str, str]] = {}
+_credentials_lock = threading.Lock()
+# account -> {'lock', 'M', 'mailbox', 'uidvalidity'}: the connection load_body
+# keeps open; the lock serializes commands on it (imaplib is not thread-safe)
+_body_connections: Dict[str, Dict[str, Any]] = {}
 
 
 def _decode_header(hdr):
@@ -29,48 +70,423 @@ def _decode_header(hdr):
     return out
 
 
-def fetch_imap_emails(server: str, username: str, password: str, mailbox: str = 'INBOX', limit: int = 50) -> List[Dict]:
-    """Connect to IMAP server and fetch the most recent `limit` messages from `mailbox`.
-    Returns a list of dicts: {id, sender, subject, timestamp, body}
-    """
-    M = imaplib.IMAP4_SSL(server)
-    M.login(username, password)
-    M.select(mailbox)
-    typ, data = M.search(None, 'ALL')
-    ids = data[0].split()
-    ids = ids[-limit:]
-    results = []
-    for num in reversed(ids):
-        typ, msg_data = M.fetch(num, '(RFC822)')
-        if typ != 'OK':
-            continue
-        raw = msg_data[0][1]
-        msg = email.message_from_bytes(raw)
-        sender = _decode_header(msg.get('From'))
-        subject = _decode_header(msg.get('Subject'))
-        date_raw = msg.get('Date')
+def account_id(server: str, username: str) -> str:
+    return f'{username}@{server}'
+
+
+def _parse_headers(msg) -> Dict:
+    sender = _decode_header(msg.get('From'))
+    subject = _decode_header(msg.get('Subject'))
+    date_raw = msg.get('Date')
+    try:
+        parsed_date = email.utils.parsedate_to_datetime(date_raw)
+        timestamp = parsed_date.isoformat()
+    except Exception:
+        timestamp = date_raw or ''
+    # bulk-mail markers used by the pre-LLM rules classifier
+    return {'sender': sender, 'subject': subject, 'timestamp': timestamp,
+            'list_unsubscribe': msg.get('List-Unsubscribe'), 'precedence': msg.get('Precedence'),
+            'auto_submitted': msg.get('Auto-Submitted')}
+
+
+def _parse_message(raw: bytes) -> Dict:
+    msg = email.message_from_bytes(raw)
+    item = _parse_headers(msg)
+    # extract body (prefer text/plain)
+    body = ''
+    if msg.is_multipart():
+        for part in msg.walk():
+            ctype = part.get_content_type()
+            disp = str(part.get('Content-Disposition'))
+            if ctype == 'text/plain' and 'attachment' not in disp:
+                try:
+                    body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='ignore')
+                except Exception:
+                    body = str(part.get_payload())
+                break
+    else:
         try:
-            parsed_date = email.utils.parsedate_to_datetime(date_raw)
-            timestamp = parsed_date.isoformat()
+            body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8', errors='ignore')
         except Exception:
-            timestamp = date_raw or ''
-        # extract body (prefer text/plain)
-        body = ''
-        if msg.is_multipart():
-            for part in msg.walk():
-                ctype = part.get_content_type()
-                disp = str(part.get('Content-Disposition'))
-                if ctype == 'text/plain' and 'attachment' not in disp:
-                    try:
-                        body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', errors='ignore')
-                    except Exception:
-                        body = str(part.get_payload())
-                    break
+            body = str(msg.get_payload())
+    item['body'] = body
+    return item
+
+
+def _parse_sexp(data: bytes):
+    """Parse an IMAP parenthesized list (e.g. a BODYSTRUCTURE) into nested
+    Python lists of str/None."""
+    tokens = re.findall(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+', data)
+    stack: list = [[]]
+    for tok in tokens:
+        if tok == b'(':
+            stack.append([])
+        elif tok == b')':
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        elif tok.startswith(b'"'):
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', tok[1:-1]).decode('utf-8', errors='ignore'))
+        elif tok.upper() == b'NIL':
+            stack[-1].append(None)
         else:
-            try:
-                body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8', errors='ignore')
-            except Exception:
-                body = str(msg.get_payload())
-        results.append({'id': int(num), 'sender': sender, 'subject': subject, 'timestamp': timestamp, 'body': body})
-    M.logout()
+            stack[-1].append(tok.decode('ascii', errors='ignore'))
+    return stack[0]
+
+
+def _params(value) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    return {str(k).lower(): v for k, v in zip(value[::2], value[1::2])}
+
+
+def _find_text_part(structure, section: str = '') -> Optional[Tuple[str, str, str]]:
+    """(section, transfer encoding, charset) of the first non-attachment
+    text/plain part in a parsed BODYSTRUCTURE, or None."""
+    if not isinstance(structure, list) or not structure:
+        return None
+    if isinstance(structure[0], list):  # multipart: child parts, then the subtype
+        for n, child in enumerate(structure, start=1):
+            if not isinstance(child, list):
+                break  # subtype; extension data such as the boundary follows
+            found = _find_text_part(child, f'{section}.{n}' if section else str(n))
+            if found:
+                return found
+        return None
+    if len(structure) < 7 or str(structure[0]).lower() != 'text' or str(structure[1]).lower() != 'plain':
+        return None
+    # text parts carry a line count at index 7, so the disposition is at index 9
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and str(disposition[0]).lower() == 'attachment':
+        return None
+    charset = _params(structure[2]).get('charset') or 'utf-8'
+    return section or '1', (structure[5] or '7bit').lower(), charset
+
+
+def _decode_section(payload: bytes, encoding: Optional[str], charset: Optional[str]) -> str:
+    try:
+        if encoding == 'base64':
+            payload = base64.b64decode(payload)
+        elif encoding == 'quoted-printable':
+            payload = quopri.decodestring(payload)
+    except Exception:
+        pass
+    try:
+        return payload.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+
+def _quote_mailbox(mailbox: str) -> str:
+    # imaplib sends names verbatim; labels such as "[Gmail]/Sent Mail" need quoting
+    if mailbox.startswith('"') or not re.search(r'[\s"\\]', mailbox):
+        return mailbox
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _select(M, mailbox: str) -> int:
+    """Select `mailbox` read-only and return its UIDVALIDITY."""
+    mailbox = _quote_mailbox(mailbox)
+    typ, _ = M.select(mailbox, readonly=True)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f'cannot select mailbox {mailbox!r}')
+    typ, data = M.response('UIDVALIDITY')
+    if not data or data[0] is None:
+        typ, data = M.status(mailbox, '(UIDVALIDITY)')
+        m = re.search(rb'UIDVALIDITY (\d+)', data[0] or b'')
+        return int(m.group(1)) if m else 0
+    return int(data[0])
+
+
+def _new_uids(M, since_uid: Optional[int], limit: int) -> List[int]:
+    """UIDs to download: the newest `limit` on a first sync, otherwise the
+    oldest `limit` UIDs above `since_uid` (the rest arrive on the next sync)."""
+    if since_uid:
+        typ, data = M.uid('SEARCH', None, f'UID {since_uid + 1}:*')
+    else:
+        typ, data = M.uid('SEARCH', None, 'ALL')
+    if typ != 'OK':
+        return []
+    # "n:*" always matches the highest UID, even when it is <= since_uid
+    uids = sorted(int(u) for u in data[0].split() if int(u) > (since_uid or 0))
+    return uids[:limit] if since_uid else uids[-limit:]
+
+
+def _uid_set(uids: List[int]) -> str:
+    """Compact IMAP set syntax for sorted UIDs, e.g. [1, 2, 3, 7] -> "1:3,7"."""
+    parts = []
+    start = prev = uids[0]
+    for uid in uids[1:]:
+        if uid != prev + 1:
+            parts.append(f'{start}:{prev}' if prev != start else str(start))
+            start = uid
+        prev = uid
+    parts.append(f'{start}:{prev}' if prev != start else str(start))
+    return ','.join(parts)
+
+
+def _fetch_batches(M, uids: List[int], items: str, batch_size: int):
+    """Yield (uid, non-literal response text, {item name: literal bytes}) for
+    every message, requesting `batch_size` UIDs per FETCH round trip instead of one.
+    A batch the server answers with NO or BAD raises instead of being skipped."""
+    uids = sorted(uids)
+    for i in range(0, len(uids), batch_size):
+        batch = _uid_set(uids[i:i + batch_size])
+        typ, data = M.uid('FETCH', batch, f'(UID {items})')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f'UID FETCH {batch} failed: {(data[0] or b"").decode(errors="replace")}')
+        # each message is a b'N (UID u ... {len}' piece, one (text, literal) tuple per
+        # further literal, and a closing b')' piece; items can come in any order
+        current = None
+        for part in data:
+            text = part[0] if isinstance(part, tuple) else part
+            if text is None:
+                continue
+            if re.match(rb'\d+ \(', text):
+                if current and current[0] is not None:
+                    yield current
+                m = re.search(rb'UID (\d+)', text)
+                current = [int(m.group(1)) if m else None, b'', {}]
+            if current is None:
+                continue
+            if isinstance(part, tuple):
+                name = re.search(rb'([A-Z0-9.]+(?:\[[^\]]*\])?) \{\d+\}$', text)
+                current[1] += text[:name.start()] if name else text
+                if name:
+                    current[2][name.group(1).decode()] = part[1]
+            else:
+                current[1] += text
+            if current[0] is None:
+                m = re.search(rb'UID (\d+)', current[1])
+                current[0] = int(m.group(1)) if m else None
+        if current and current[0] is not None:
+            yield current
+
+
+def _fetch_uids(M, uids: List[int], account: str, mailbox: str, uidvalidity: int,
+                batch_size: Optional[int] = None) -> Iterator[Dict]:
+    for uid, _, literals in _fetch_batches(M, uids, 'RFC822', batch_size or FETCH_BATCH_SIZE):
+        raw = literals.get('RFC822') or next(iter(literals.values()), b'')
+        item = _parse_message(raw)
+        item.update({'account': account, 'mailbox': mailbox, 'uidvalidity': uidvalidity, 'uid': uid})
+        yield item
+
+
+def _fetch_headers(M, uids: List[int], account: str, mailbox: str, uidvalidity: int,
+                   batch_size: Optional[int] = None) -> Iterator[Dict]:
+    """Phase one of header-first ingestion: headers plus the location of the
+    text/plain section, with the body left to fill_bodies / db.get_email."""
+    for uid, meta, literals in _fetch_batches(M, uids, HEADER_ITEMS, batch_size or FETCH_BATCH_SIZE):
+        header = next((v for k, v in literals.items() if k.startswith('BODY[HEADER')), b'')
+        item = _parse_headers(email.message_from_bytes(header))
+        m = re.search(rb'BODYSTRUCTURE (\(.*\))', meta, re.S)
+        text_part = _find_text_part(_parse_sexp(m.group(1))[0]) if m else None
+        item.update({'account': account, 'mailbox': mailbox, 'uidvalidity': uidvalidity, 'uid': uid, 'body': ''})
+        if text_part:
+            item.update({'body_fetched': False, 'body_section': text_part[0], 'body_encoding': text_part[1],
+                         'body_charset': text_part[2]})
+        yield item
+
+
+def _fetch_sections(M, pending: List[Dict], batch_size: Optional[int] = None) -> Dict[int, str]:
+    """Download the text section of each pending email; returns {email id: body}."""
+    by_section: Dict[str, Dict[int, Dict]] = {}
+    for e in pending:
+        by_section.setdefault(e['body_section'] or '1', {})[e['uid']] = e
+    bodies = {}
+    for section, by_uid in by_section.items():
+        for uid, _, literals in _fetch_batches(M, list(by_uid), f'BODY.PEEK[{section}]', batch_size or FETCH_BATCH_SIZE):
+            e = by_uid.get(uid)
+            if e is not None:
+                raw = literals.get(f'BODY[{section}]', b'')
+                bodies[e['id']] = _decode_section(raw, e['body_encoding'], e['body_charset'])
+    return bodies
+
+
+def _login(server: str, username: str, password: str):
+    """Open and authenticate a connection. `server` may be "host" or
+    "host:port"; set IMAP_SSL=0 for plaintext servers (e.g. local test servers)."""
+    host, _, port = server.partition(':')
+    if os.getenv('IMAP_SSL', '1').lower() in ('0', 'false', 'no'):
+        M = imaplib.IMAP4(host, int(port or imaplib.IMAP4_PORT))
+    else:
+        M = imaplib.IMAP4_SSL(host, int(port or imaplib.IMAP4_SSL_PORT))
+    M.login(username, password)
+    return M
+
+
+def remember_credentials(server: str, username: str, password: str) -> str:
+    account = account_id(server, username)
+    with _credentials_lock:
+        _credentials[account] = (server, username, password)
+    return account
+
+
+def credentials_for(account: str) -> Optional[Tuple[str, str, str]]:
+    with _credentials_lock:
+        if account in _credentials:
+            return _credentials[account]
+    server, username, password = os.getenv('IMAP_SERVER', ''), os.getenv('IMAP_USERNAME', ''), os.getenv('IMAP_PASSWORD', '')
+    if username and password and account_id(server, username) == account:
+        return server, username, password
+    return None
+
+
+def iter_imap_emails(server: str, username: str, password: str, mailbox: str = 'INBOX', limit: int = 50,
+                     since_uid: Optional[int] = None, batch_size: Optional[int] = None,
+                     headers_only: bool = False) -> Iterator[Dict]:
+    """Generator form of fetch_imap_emails: yields messages oldest first as
+    each FETCH batch arrives, so only one batch is held in memory."""
+    M = _login(server, username, password)
+    try:
+        uidvalidity = _select(M, mailbox)
+        uids = _new_uids(M, since_uid, limit)
+        fetch = _fetch_headers if headers_only else _fetch_uids
+        yield from fetch(M, uids, account_id(server, username), mailbox, uidvalidity, batch_size)
+    finally:
+        M.logout()
+
+
+def fetch_imap_emails(server: str, username: str, password: str, mailbox: str = 'INBOX', limit: int = 50,
+                      since_uid: Optional[int] = None, batch_size: Optional[int] = None,
+                      headers_only: bool = False) -> List[Dict]:
+    """Connect to IMAP server and fetch up to `limit` messages from `mailbox`:
+    the most recent ones, or only those with a UID above `since_uid`.
+    Returns a list of dicts: {sender, subject, timestamp, body, account, mailbox, uidvalidity, uid}
+    With `headers_only` the body is empty and body_fetched/body_section say where to get it.
+    """
+    results = list(iter_imap_emails(server, username, password, mailbox, limit, since_uid, batch_size, headers_only))
+    results.reverse()  # newest first
     return results
+
+
+def new_progress() -> Dict[str, Any]:
+    return {'status': 'running', 'total': None, 'fetched': 0, 'inserted': 0, 'skipped': 0, 'last_uid': None,
+            'started_at': time.time(), 'finished_at': None}
+
+
+def sync_imap(server: str, username: str, password: str, mailbox: str = 'INBOX', limit: int = 50,
+              batch_size: Optional[int] = None, headers_only: Optional[bool] = None,
+              progress: Optional[Dict[str, Any]] = None, connection=None) -> Dict:
+    """Incrementally sync `mailbox` into the database.
+
+    Only UIDs above the last synced one are downloaded; if the server's
+    UIDVALIDITY changed, the stored position is discarded and the mailbox is
+    synced as if for the first time. Returns counts and the new sync position.
+    `headers_only` (default IMAP_LAZY_BODIES) stores messages without bodies.
+
+    Each FETCH batch is saved in its own transaction together with the sync
+    position, so an interrupted sync resumes after the last saved batch; a
+    batch the server refuses raises before its position is saved.
+    `progress` is updated in place after every batch so callers can poll it.
+    `connection` reuses an open, logged-in IMAP connection (left open).
+    """
+    if headers_only is None:
+        headers_only = LAZY_BODIES
+    progress = progress if progress is not None else new_progress()
+    batch_size = batch_size or FETCH_BATCH_SIZE
+    account = remember_credentials(server, username, password)
+    state = db.get_sync_state(account, mailbox)
+    try:
+        M = connection or _login(server, username, password)
+        try:
+            uidvalidity = _select(M, mailbox)
+            since_uid = state['last_uid'] if state and state['uidvalidity'] == uidvalidity else None
+            uids = _new_uids(M, since_uid, limit)
+            progress.update(total=len(uids), last_uid=since_uid or 0, headers_only=headers_only)
+            fetch = _fetch_headers if headers_only else _fetch_uids
+            if not uids:
+                db.save_synced_emails([], account, mailbox, uidvalidity, since_uid or 0)
+            for i in range(0, len(uids), batch_size):
+                chunk = uids[i:i + batch_size]
+                emails = list(fetch(M, chunk, account, mailbox, uidvalidity, batch_size))
+                # the checkpoint covers the whole requested range, including UIDs expunged
+                # meanwhile; a refused FETCH has already raised, so nothing is skipped over
+                counts = db.save_synced_emails(emails, account, mailbox, uidvalidity, chunk[-1])
+                progress['fetched'] += len(emails)
+                progress['inserted'] += counts['inserted']
+                progress['skipped'] += counts['skipped']
+                progress['last_uid'] = chunk[-1]
+        finally:
+            if connection is None:
+                M.logout()
+        progress['status'] = 'finished'
+    except Exception as exc:
+        progress['status'] = 'error'
+        progress['error'] = str(exc)
+        raise
+    finally:
+        progress['finished_at'] = time.time()
+    return {'account': account, 'mailbox': mailbox, 'fetched': progress['fetched'], 'uidvalidity': uidvalidity,
+            'since_uid': since_uid or 0, 'last_uid': progress['last_uid'], 'headers_only': headers_only,
+            'inserted': progress['inserted'], 'skipped': progress['skipped']}
+
+
+def fill_bodies(server: str, username: str, password: str, mailbox: str = 'INBOX', limit: Optional[int] = None,
+                batch_size: Optional[int] = None, email_ids: Optional[List[int]] = None) -> Dict:
+    """Background pass for header-first syncs: download the text section of
+    every stored email in `mailbox` (or only `email_ids`) that has no body yet
+    (newest first)."""
+    account = remember_credentials(server, username, password)
+    pending = db.get_pending_bodies(account, mailbox, limit, email_ids)
+    if not pending:
+        return {'account': account, 'mailbox': mailbox, 'filled': 0}
+    M = _login(server, username, password)
+    try:
+        uidvalidity = _select(M, mailbox)
+        # bodies from an older UIDVALIDITY cannot be addressed any more
+        bodies = _fetch_sections(M, [e for e in pending if e['uidvalidity'] == uidvalidity], batch_size)
+    finally:
+        M.logout()
+    db.save_bodies(list(bodies.items()))
+    return {'account': account, 'mailbox': mailbox, 'filled': len(bodies)}
+
+
+def load_body(email_row: Dict) -> Optional[str]:
+    """db body loader: download one email's text section on demand. Returns
+    None when the account's credentials are unknown or the UID is gone."""
+    account = email_row.get('account') or ''
+    creds = credentials_for(account)
+    if creds is None:
+        return None
+    with _credentials_lock:
+        conn = _body_connections.setdefault(account, {'lock': threading.Lock(), 'M': None})
+    with conn['lock']:
+        for attempt in range(2):
+            try:
+                if conn['M'] is None:
+                    conn.update(M=_login(*creds), mailbox=None)
+                if conn['mailbox'] != email_row['mailbox']:
+                    conn['mailbox'] = None
+                    conn['uidvalidity'] = _select(conn['M'], email_row['mailbox'])
+                    conn['mailbox'] = email_row['mailbox']
+                if conn['uidvalidity'] != email_row['uidvalidity']:
+                    return None
+                return _fetch_sections(conn['M'], [email_row], 1).get(email_row['id'])
+            except (imaplib.IMAP4.abort, OSError):
+                # dropped by the server (idle timeout, restart): reconnect once
+                _logout(conn)
+                if attempt:
+                    raise
+
+
+def _logout(conn: Dict[str, Any]):
+    M, conn['M'] = conn['M'], None
+    if M is not None:
+        try:
+            M.logout()
+        except Exception:
+            pass
+
+
+def close_body_connections():
+    """Log out the connections kept open by load_body."""
+    with _credentials_lock:
+        conns = list(_body_connections.values())
+        _body_connections.clear()
+    for conn in conns:
+        with conn['lock']:
+            _logout(conn)
+
+
+db.set_body_loader(load_body)
@@ -0,0 +1,113 @@
+"""
+Concurrent IMAP ingestion across several accounts and mailboxes.
+
+Sources come from a JSON file (IMAP_SOURCES_FILE, see
+imap_sources.example.json) or, without one, from the IMAP_* environment
+variables with IMAP_MAILBOXES listing several mailboxes. Each (account,
+mailbox) source is synced by imap_ingest.sync_imap on a thread-pool worker
+with its own IMAP connection; a failing source is recorded and does not stop
+the others.
+
+Functions:
+- load_sources(path=None)
+- sync_sources(sources, max_workers=None, limit=50, headers_only=None, progress=None)
+"""
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import imap_ingest
+
+MAX_WORKERS = int(os.getenv('IMAP_MAX_WORKERS', '4'))
+# servers cap simultaneous logins per user (Gmail allows 15)
+MAX_CONNECTIONS_PER_ACCOUNT = int(os.getenv('IMAP_MAX_CONNECTIONS_PER_ACCOUNT', '4'))
+
+
+def _mailboxes(value) -> List[str]:
+    if isinstance(value, str):
+        value = value.split(',')
+    return [m.strip() for m in value or [] if m and m.strip()]
+
+
+def load_sources(path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Expand the configured accounts into one dict per (account, mailbox):
+    {server, username, password, mailbox, limit}.
+
+    The file holds {"accounts": [{"server", "username", "password" or
+    "password_env", "mailboxes": [...], "limit"}]}.
+    """
+    path = path or os.getenv('IMAP_SOURCES_FILE')
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            accounts = json.load(f).get('accounts', [])
+    else:
+        accounts = [{
+            'server': os.getenv('IMAP_SERVER', 'imap.gmail.com'),
+            'username': os.getenv('IMAP_USERNAME'),
+            'password': os.getenv('IMAP_PASSWORD'),
+            'mailboxes': os.getenv('IMAP_MAILBOXES') or os.getenv('IMAP_MAILBOX', 'INBOX'),
+        }]
+    sources = []
+    for acc in accounts:
+        password = acc.get('password') or os.getenv(acc.get('password_env') or '', '')
+        if not acc.get('username') or not password:
+            continue
+        for mailbox in _mailboxes(acc.get('mailboxes') or 'INBOX'):
+            sources.append({'server': acc.get('server') or 'imap.gmail.com', 'username': acc['username'],
+                            'password': password, 'mailbox': mailbox, 'limit': acc.get('limit')})
+    return sources
+
+
+def new_progress(sources: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'status': 'running',
+        'sources': [{'account': imap_ingest.account_id(s['server'], s['username']), 'mailbox': s['mailbox'],
+                     **imap_ingest.new_progress(), 'status': 'queued', 'started_at': None, 'msgs_per_sec': None}
+                    for s in sources],
+        'fetched': 0, 'inserted': 0, 'failed_sources': 0,
+        'started_at': time.time(), 'finished_at': None,
+    }
+
+
+def sync_sources(sources: List[Dict[str, Any]], max_workers: Optional[int] = None, limit: int = 50,
+                 headers_only: Optional[bool] = None, progress: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Sync every source concurrently; returns the progress dict, which is
+    updated in place (per source and in total) so callers can poll it."""
+    progress = progress if progress is not None else new_progress(sources)
+    accounts: Dict[str, threading.BoundedSemaphore] = {}
+    for entry in progress['sources']:
+        accounts.setdefault(entry['account'], threading.BoundedSemaphore(max(1, MAX_CONNECTIONS_PER_ACCOUNT)))
+    lock = threading.Lock()
+
+    def run(source, entry):
+        with accounts[entry['account']]:
+            entry['started_at'] = time.time()
+            entry['status'] = 'running'
+            try:
+                imap_ingest.sync_imap(source['server'], source['username'], source['password'],
+                                      mailbox=source['mailbox'], limit=source.get('limit') or limit,
+                                      headers_only=headers_only, progress=entry)
+            except Exception:
+                # sync_imap recorded the error in `entry`; keep the other sources going
+                with lock:
+                    progress['failed_sources'] += 1
+            elapsed = (entry['finished_at'] or time.time()) - entry['started_at']
+            entry['msgs_per_sec'] = round(entry['fetched'] / elapsed, 1) if elapsed > 0 else None
+            with lock:
+                progress['fetched'] += entry['fetched']
+                progress['inserted'] += entry['inserted']
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers or MAX_WORKERS)) as pool:
+            list(pool.map(run, sources, progress['sources']))
+        progress['status'] = 'finished'
+    except Exception as exc:
+        progress['status'] = 'error'
+        progress['error'] = str(exc)
+        raise
+    finally:
+        progress['finished_at'] = time.time()
+    return progress
@@ -0,0 +1,216 @@
+"""
+Long-running IMAP IDLE watcher: ingests new mail as soon as the server
+announces it instead of waiting for a manual fetch.
+
+The watcher keeps one connection per mailbox in IDLE. When the server sends
+EXISTS it leaves IDLE, runs an incremental imap_ingest.sync_imap over the same
+connection (so only new UIDs are downloaded) and idles again. IDLE is renewed
+every IMAP_IDLE_TIMEOUT seconds with a catch-up sync, servers without IDLE are
+polled every IMAP_POLL_INTERVAL seconds, and dropped connections are retried
+with exponential backoff and jitter. With `categorize` the new emails are
+queued for batch.process_emails on a background thread.
+
+Run: `python imap_watch.py [--mailbox INBOX] [--categorize]` (uses the IMAP_* env vars)
+"""
+import argparse
+import imaplib
+import logging
+import os
+import queue
+import random
+import re
+import select
+import ssl
+import threading
+import time
+from typing import Callable, List, Optional
+
+import batch
+import db
+import imap_ingest
+
+log = logging.getLogger(__name__)
+
+# RFC 2177: clients should re-issue IDLE at least every 29 minutes
+IDLE_TIMEOUT = float(os.getenv('IMAP_IDLE_TIMEOUT', '600'))
+POLL_INTERVAL = float(os.getenv('IMAP_POLL_INTERVAL', '60'))
+MAX_BACKOFF = float(os.getenv('IMAP_WATCH_MAX_BACKOFF', '300'))
+
+
+# untagged responses announcing new mail
+_NEW_MAIL = re.compile(rb'\* \d+ (EXISTS|RECENT)')
+
+
+def _buffered(M) -> bool:
+    """Whether a response is already waiting to be read: in imaplib's read
+    buffer, as decrypted TLS data, or on the socket. Never blocks."""
+    timeout = M.sock.gettimeout()
+    M.sock.settimeout(0)
+    try:
+        return bool(M.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        M.sock.settimeout(timeout)
+
+
+def _idle(M, timeout: float, stop: threading.Event) -> bool:
+    """Wait in IDLE for up to `timeout` seconds; True if new mail was announced."""
+    tag = M._new_tag()
+    M.send(tag + b' IDLE\r\n')
+    line = M.readline()
+    if not line.startswith(b'+'):
+        raise imaplib.IMAP4.error(f'IDLE rejected: {line.strip()!r}')
+    deadline = time.monotonic() + timeout
+    new_mail = False
+    while not (new_mail or stop.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        # readline() reads imaplib's buffered file, which can hold lines the socket no longer shows
+        if not _buffered(M):
+            readable, _, _ = select.select([M.sock], [], [], min(remaining, 1.0))
+            if not readable:
+                continue
+        line = M.readline()
+        if not line or line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort('connection closed during IDLE')
+        if _NEW_MAIL.match(line):
+            new_mail = True
+    M.send(b'DONE\r\n')
+    while True:
+        line = M.readline()
+        if not line:
+            raise imaplib.IMAP4.abort('connection closed after IDLE')
+        if line.startswith(tag):
+            return new_mail
+        if _NEW_MAIL.match(line):
+            new_mail = True
+
+
+class ImapWatcher:
+    """Keeps `mailbox` synced via IDLE until stop() is called.
+
+    `on_new(email_ids)` is called after each sync that stored new emails;
+    with `categorize` those ids are also analyzed in the background.
+    """
+
+    def __init__(self, server: str, username: str, password: str, mailbox: str = 'INBOX', limit: int = 500,
+                 categorize: bool = False, on_new: Optional[Callable[[List[int]], None]] = None,
+                 idle_timeout: Optional[float] = None, poll_interval: Optional[float] = None,
+                 max_backoff: Optional[float] = None):
+        self.server, self.username, self.password = server, username, password
+        self.mailbox = mailbox
+        self.limit = limit
+        self.on_new = on_new
+        self.idle_timeout = idle_timeout or IDLE_TIMEOUT
+        self.poll_interval = poll_interval or POLL_INTERVAL
+        self.max_backoff = max_backoff or MAX_BACKOFF
+        self.stats = {'syncs': 0, 'ingested': 0, 'reconnects': 0, 'categorized': 0, 'last_error': None}
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._queue: Optional[queue.Queue] = queue.Queue() if categorize else None
+
+    def _sync(self, M) -> List[int]:
+        result = imap_ingest.sync_imap(self.server, self.username, self.password, mailbox=self.mailbox,
+                                       limit=self.limit, connection=M)
+        self.stats['syncs'] += 1
+        if not result['inserted']:
+            return []
+        ids = db.get_synced_email_ids(result['account'], self.mailbox, result['uidvalidity'], result['since_uid'])
+        self.stats['ingested'] += len(ids)
+        if self.on_new:
+            self.on_new(ids)
+        if self._queue is not None:
+            self._queue.put(ids)
+        return ids
+
+    def _watch_once(self, on_connected: Callable[[], None]):
+        M = imap_ingest._login(self.server, self.username, self.password)
+        try:
+            self._sync(M)  # catch up on anything that arrived while disconnected
+            on_connected()
+            supports_idle = 'IDLE' in M.capabilities
+            while not self._stop.is_set():
+                if supports_idle:
+                    _idle(M, self.idle_timeout, self._stop)
+                else:
+                    self._stop.wait(self.poll_interval)
+                if not self._stop.is_set():
+                    # also runs on IDLE renewal, in case a notification was missed
+                    self._sync(M)
+        finally:
+            try:
+                M.logout()
+            except Exception:
+                pass
+
+    def run(self):
+        """Watch until stop(), reconnecting with exponential backoff on errors."""
+        attempt = 0
+
+        def connected():
+            nonlocal attempt
+            attempt = 0
+
+        while not self._stop.is_set():
+            try:
+                self._watch_once(connected)
+            except Exception as exc:
+                if self._stop.is_set():
+                    break
+                self.stats['reconnects'] += 1
+                self.stats['last_error'] = str(exc)
+                delay = min(self.max_backoff, 2 ** attempt) * random.uniform(0.5, 1.0)
+                attempt += 1
+                log.warning('IMAP watch of %s failed (%s); reconnecting in %.1fs', self.mailbox, exc, delay)
+                self._stop.wait(delay)
+
+    def _categorize_loop(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                ids = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            try:
+                progress = batch.run_batch(email_ids=ids)
+                self.stats['categorized'] += progress['done'] - progress['failed']
+            except Exception as exc:
+                log.warning('categorizing %d new emails failed: %s', len(ids), exc)
+
+    def start(self) -> 'ImapWatcher':
+        """Run the watcher (and the categorizer, if enabled) on daemon threads."""
+        targets = [self.run] + ([self._categorize_loop] if self._queue is not None else [])
+        self._threads = [threading.Thread(target=t, daemon=True) for t in targets]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mailbox', default=os.getenv('IMAP_MAILBOX', 'INBOX'))
+    parser.add_argument('--categorize', action='store_true', help='analyze new emails as they arrive')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    username, password = os.getenv('IMAP_USERNAME'), os.getenv('IMAP_PASSWORD')
+    if not username or not password:
+        raise SystemExit('IMAP_USERNAME and IMAP_PASSWORD must be set')
+    watcher = ImapWatcher(os.getenv('IMAP_SERVER', 'imap.gmail.com'), username, password, mailbox=args.mailbox,
+                          categorize=args.categorize,
+                          on_new=lambda ids: log.info('ingested %d new emails', len(ids)))
+    watcher.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        watcher.stop(timeout=10)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+Persistent background jobs for slow API work (IMAP syncs, LLM analysis,
+drafts, batch processing).
+
+Jobs are rows in the `jobs` table. A JobWorkerPool runs them on worker
+threads; handlers update a progress dict in place, which the pool writes back
+every JOB_FLUSH_INTERVAL seconds together with a heartbeat. Jobs whose worker
+stops heartbeating (process restarted or killed) are requeued, up to
+JOB_MAX_ATTEMPTS runs, so every handler is written to be safe to re-run.
+
+Functions:
+- submit(kind, params) -> job id
+- get_job(job_id), list_jobs(...)
+- JobWorkerPool(workers).start() / .stop()
+"""
+import logging
+import os
+import threading
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+import batch
+import db
+import imap_ingest
+import imap_sync
+import llm_async
+import llm_client
+
+log = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+JOB_FLUSH_INTERVAL = float(os.getenv('JOB_FLUSH_INTERVAL', '1'))
+JOB_STALE_AFTER = float(os.getenv('JOB_STALE_AFTER', '60'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+
+_wakeup = threading.Event()
+
+
+def _ingest_gmail(params: Dict[str, Any], progress: Dict[str, Any]):
+    # passwords are never written to the jobs table; they come from the
+    # in-process credential registry or the IMAP_* environment
+    creds = imap_ingest.credentials_for(params['account'])
+    if creds is None:
+        raise RuntimeError(f"no IMAP credentials available for {params['account']}")
+    progress.update(imap_ingest.new_progress())
+    result = imap_ingest.sync_imap(*creds, mailbox=params['mailbox'], limit=params['limit'],
+                                   headers_only=params.get('headers_only'), progress=progress)
+    if result['headers_only'] and result['inserted']:
+        imap_ingest.fill_bodies(*creds, mailbox=params['mailbox'])
+    return result
+
+
+def _fill_bodies(params: Dict[str, Any], progress: Dict[str, Any]):
+    creds = imap_ingest.credentials_for(params['account'])
+    if creds is None:
+        raise RuntimeError(f"no IMAP credentials available for {params['account']}")
+    return imap_ingest.fill_bodies(*creds, mailbox=params['mailbox'])
+
+
+def _ingest_sources(params: Dict[str, Any], progress: Dict[str, Any]):
+    sources = imap_sync.load_sources()
+    progress.update(imap_sync.new_progress(sources))
+    imap_sync.sync_sources(sources, params.get('max_workers'), params.get('limit') or 50,
+                           params.get('headers_only'), progress)
+    for source, entry in zip(sources, progress['sources']):
+        if entry.get('headers_only') and entry['inserted']:
+            imap_ingest.fill_bodies(source['server'], source['username'], source['password'], mailbox=source['mailbox'])
+    return {'fetched': progress['fetched'], 'inserted': progress['inserted'], 'failed_sources': progress['failed_sources']}
+
+
+def _process_email(params: Dict[str, Any], progress: Dict[str, Any]):
+    email = db.get_email(params['email_id'])
+    if not email:
+        raise LookupError('Email not found')
+    categories, tasks = llm_client.run(llm_async.analyze_email(
+        email['body'], db.get_prompts(), use_cache=not params.get('refresh'), combined=params.get('combined'), email=email))
+    db.save_processed(params['email_id'], categories, tasks)
+    return {'email_id': params['email_id'], 'categories': categories, 'tasks': tasks}
+
+
+def _draft_email(params: Dict[str, Any], progress: Dict[str, Any]):
+    email = db.get_email(params['email_id'])
+    if not email:
+        raise LookupError('Email not found')
+    tone = params.get('tone') or 'friendly'
+    prompt = db.get_prompts().get('auto_reply_prompt') or ''
+    draft = llm_client.run(llm_async.generate_draft(email['body'], prompt, tone=tone, use_cache=not params.get('refresh')))
+    subject = draft.get('subject', '') if isinstance(draft, dict) else ''
+    body = draft.get('body', '') if isinstance(draft, dict) else str(draft)
+    db.save_draft(params['email_id'], subject, body, metadata={'tone': tone})
+    return {'email_id': params['email_id'], 'draft': draft}
+
+
+def _process_batch(params: Dict[str, Any], progress: Dict[str, Any]):
+    # resolved at run time, so a requeued job only picks up what is still unprocessed
+    emails = db.get_unprocessed_emails(limit=params.get('limit'), sender=params.get('sender'),
+                                       email_ids=params.get('email_ids'))
+    progress.update(batch.new_progress(len(emails)))
+    llm_client.run(batch.process_emails(
+        emails, db.get_prompts(), concurrency=params.get('concurrency') or 4,
+        requests_per_minute=params.get('requests_per_minute'), use_cache=not params.get('refresh'),
+        combined=params.get('combined'), progress=progress))
+    return {'total': progress['total'], 'done': progress['done'], 'failed': progress['failed']}
+
+
+# kind -> handler(params, progress) returning a JSON-serializable result
+HANDLERS: Dict[str, Callable[[Dict[str, Any], Dict[str, Any]], Any]] = {
+    'ingest_gmail': _ingest_gmail,
+    'fill_bodies': _fill_bodies,
+    'ingest_sources': _ingest_sources,
+    'process_email': _process_email,
+    'draft_email': _draft_email,
+    'process_batch': _process_batch,
+}
+
+
+def submit(kind: str, params: Dict[str, Any]) -> str:
+    if kind not in HANDLERS:
+        raise ValueError(f'unknown job kind {kind!r}')
+    job_id = uuid.uuid4().hex
+    db.create_job(job_id, kind, params)
+    _wakeup.set()
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    return db.get_job(job_id)
+
+
+def list_jobs(status: Optional[str] = None, kind: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    return db.list_jobs(status=status, kind=kind, limit=limit)
+
+
+class JobWorkerPool:
+    """`workers` threads that claim queued jobs, plus one thread that flushes
+    progress/heartbeats and requeues jobs abandoned by dead workers."""
+
+    def __init__(self, workers: Optional[int] = None, poll_interval: float = 1.0):
+        self.workers = max(1, workers or JOB_WORKERS)
+        self.poll_interval = poll_interval
+        self._running: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _run(self, job: Dict[str, Any]):
+        progress: Dict[str, Any] = job['progress'] or {}
+        with self._lock:
+            self._running[job['id']] = progress
+        try:
+            result = HANDLERS[job['kind']](job['params'], progress)
+        except Exception as exc:
+            log.warning('job %s (%s) failed: %s', job['id'], job['kind'], exc)
+            db.finish_job(job['id'], error=str(exc) or type(exc).__name__, progress=progress)
+        else:
+            db.finish_job(job['id'], result=result, progress=progress)
+        finally:
+            with self._lock:
+                self._running.pop(job['id'], None)
+
+    def _work(self):
+        while not self._stop.is_set():
+            job = db.claim_job()
+            if job is None:
+                _wakeup.wait(self.poll_interval)
+                _wakeup.clear()
+                continue
+            if job['kind'] not in HANDLERS:
+                db.finish_job(job['id'], error=f"unknown job kind {job['kind']!r}")
+                continue
+            self._run(job)
+
+    def _monitor(self):
+        while not self._stop.wait(JOB_FLUSH_INTERVAL):
+            with self._lock:
+                snapshot = {job_id: dict(p) for job_id, p in self._running.items()}
+            try:
+                if snapshot:
+                    db.update_jobs_progress(snapshot)
+                if db.requeue_stale_jobs(JOB_STALE_AFTER, JOB_MAX_ATTEMPTS):
+                    _wakeup.set()
+            except Exception as exc:
+                log.warning('job monitor: %s', exc)
+
+    def start(self) -> 'JobWorkerPool':
+        # jobs left running by a previous process are picked up again once stale
+        targets = [self._work] * self.workers + [self._monitor]
+        self._threads = [threading.Thread(target=t, daemon=True, name=f'job-worker-{n}') for n, t in enumerate(targets)]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop claiming new jobs and wait up to `timeout` for running ones."""
+        self._stop.set()
+        _wakeup.set()
+        for t in self._threads:
+            t.join(timeout)
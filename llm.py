@@ -1,7 +1,17 @@
 import os
 import json
 import re
-from typing import Any, Dict, List
+import ast
+import hashlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import db
+import llm_client
+import llm_metrics
+import llm_schemas
+from llm_resilience import LLMError, RateLimitError, TransientError, PermanentError, CircuitOpenError
+import llm_resilience
 
 OPENAI_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4')
@@ -24,18 +34,50 @@ try:
         # For openai<1.0
         if hasattr(openai, 'api_key'):
             openai.api_key = OPENAI_KEY
+        if llm_client.BASE_URL and hasattr(openai, 'api_base'):
+            openai.api_base = llm_client.BASE_URL
 except Exception:
     openai = None
 
-# For openai>=1.0
+# Convenience flag used throughout the module to detect mock-mode
+IS_MOCK = (openai is None) or (not OPENAI_KEY)
+
+# Response cache: identical (model, task, prompt, input, sampling params)
+# requests are answered from SQLite instead of calling the API again.
+CACHE_ENABLED = os.getenv('LLM_CACHE_DISABLED', '').lower() not in ('1', 'true', 'yes')
+CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '5000'))
+
+# Categorize and extract action items with one combined request instead of two.
+COMBINED_ANALYSIS = os.getenv('LLM_COMBINED_ANALYSIS', '').lower() in ('1', 'true', 'yes')
+
+# Email text is cleaned (quoted replies, signatures, legal footers) and cut to
+# a per-task input token budget before it is sent; 0 disables the budget.
+PREPROCESS_ENABLED = os.getenv('LLM_PREPROCESS_DISABLED', '').lower() not in ('1', 'true', 'yes')
+INPUT_TOKEN_BUDGETS = {
+    task: int(os.getenv(f'LLM_INPUT_BUDGET_{task.upper()}', default))
+    for task, default in (('categorize', '1000'), ('extract', '3000'), ('analyze', '3000'),
+                          ('draft', '3000'), ('chat', '6000'))
+}
+
+# Structured outputs for categorize/extract/analyze/draft: 'json_schema' (the
+# reply must match llm_schemas.JSON_SCHEMAS), 'json_object' (JSON mode), 'off',
+# or 'auto' (by model name). A mode the model rejects is dropped for the
+# rest of the process.
+RESPONSE_FORMAT = os.getenv('LLM_RESPONSE_FORMAT', 'auto').lower()
+_JSON_SCHEMA_MODELS = ('gpt-4o', 'gpt-4.1', 'gpt-5', 'o1', 'o3', 'o4')
+_JSON_OBJECT_MODELS = ('gpt-4-turbo', 'gpt-4-1106', 'gpt-4-0125', 'gpt-3.5-turbo')
+_FORMAT_MODES = ('json_schema', 'json_object', 'off')
+_rejected_formats = set()
+
 try:
-    from openai import OpenAI
-    _openai_client = OpenAI(api_key=OPENAI_KEY) if OPENAI_KEY else None
+    import tiktoken
 except Exception:
-    _openai_client = None
+    tiktoken = None
 
-# Convenience flag used throughout the module to detect mock-mode
-IS_MOCK = (openai is None) or (not OPENAI_KEY)
+_cache_lock = threading.Lock()
+_cache_counters = {'hits': 0, 'misses': 0}
+_preprocess_counters = {'emails': 0, 'tokens_in': 0, 'tokens_sent': 0, 'truncated': 0}
 
 def _mock_response(task: str):
     if task == 'categorize':
@@ -47,134 +89,623 @@ def _mock_response(task: str):
     return {'result': 'mock'}
 
 
-def _extract_json_from_text(text: str):
-    # Try to find the first JSON object/array in the text using regex
-    json_match = re.search(r'({[\s\S]*}|\[[\s\S]*\])', text)
-    if not json_match:
-        return None
-    jtext = json_match.group(1)
+# a bracket that can start a JSON (or Python) value: skips prose like {name} or [sic]
+_JSON_OPEN = re.compile(r'\{(?=\s*["\'}])|\[(?=\s*["\'{\[\]\d.+-]|\s*(?:true|false|null|True|False|None)\b)')
+# inside a candidate: a whole double-quoted string (escape aware) or a bracket
+_JSON_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"?|[\[\]{}]')
+# the same with single-quoted strings too, for Python-style literals
+_LITERAL_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"?|\'(?:[^\'\\]|\\.)*\'?|[\[\]{}]')
+_CLOSERS = {'{': '}', '[': ']'}
+_JSON_DECODER = json.JSONDecoder()
+# deeper spans are skipped rather than decoded (the decoders recurse)
+_MAX_JSON_DEPTH = 100
+# candidates decoded in place before switching to delimit-then-decode: a failed
+# raw_decode costs O(position), so only a bounded number are allowed
+_DIRECT_ATTEMPTS = 4
+# Python-literal rescans and unclosed candidates looked past: each can cost
+# O(rest of the text), so these are bounded the same way
+_RESCANS = 4
+# left over where decoding stops in output cut off mid-number or mid-literal
+_CUT_TAIL = re.compile(r'[\w.+-]*\s*')
+
+
+def _balanced_end(text: str, start: int, token=_JSON_TOKEN) -> Tuple[Optional[int], int]:
+    """(end offset, maximum depth) of the bracketed span opening at `start`,
+    skipping brackets inside strings (as matched by `token`); a mismatched
+    closing bracket ends it early. The end is None if the text ends first."""
+    stack = []
+    depth = 0
+    for m in token.finditer(text, start):
+        tok = m.group()
+        if tok in _CLOSERS:
+            stack.append(_CLOSERS[tok])
+            depth = max(depth, len(stack))
+        elif tok in ('}', ']'):
+            if stack.pop() != tok or not stack:
+                return m.end(), depth
+    return None, depth
+
+
+def _cut_off(text: str, start: int) -> bool:
+    """Whether the unclosed value at `start` is JSON cut off by the end of the
+    text (max_tokens) rather than a stray bracket such as "[1) first"."""
     try:
-        return json.loads(jtext)
-    except Exception:
-        # try to fix common issues (replace single quotes)
-        try:
-            return json.loads(jtext.replace("'", '"'))
-        except Exception:
+        _JSON_DECODER.raw_decode(text, start)
+    except RecursionError:
+        return True
+    except ValueError as exc:
+        if text.startswith("'", exc.pos):
+            return _balanced_end(text, start, _LITERAL_TOKEN)[0] is None
+        # the error is at the end, in a half-written number or literal, or in an unclosed string
+        return bool(_CUT_TAIL.fullmatch(text, exc.pos)) or exc.msg.startswith('Unterminated string')
+    return False
+
+
+def _extract_json_from_text(text: str, accept=None):
+    """First JSON object or array embedded in `text` (prose, ``` fences and
+    trailing commentary around it are ignored) for which `accept(value)` is
+    true, or None.
+
+    A single left-to-right pass: each top-level bracketed span is decoded once
+    and the scan resumes after it, so the cost stays linear in the text. The
+    first few candidates are tried with JSONDecoder.raw_decode directly (the
+    usual reply is one JSON value). Python-style literals ({'a': 'b'}) are
+    accepted as a fallback, delimited with single-quoted strings skipped too.
+    A bracket that never closes is looked past unless it starts JSON cut off
+    mid-value (max_tokens), which gives None rather than a fragment of it.
+    """
+    if not text:
+        return None
+    pos = 0
+    attempts = 0
+    rescans = 0
+    while True:
+        m = _JSON_OPEN.search(text, pos)
+        if not m:
             return None
+        start = m.start()
+        if attempts < _DIRECT_ATTEMPTS:
+            attempts += 1
+            try:
+                value, end = _JSON_DECODER.raw_decode(text, start)
+            except (ValueError, RecursionError):
+                pass
+            else:
+                if accept is None or accept(value):
+                    return value
+                pos = end
+                continue
+        end, depth = _balanced_end(text, start)
+        value = None
+        if end is not None and depth <= _MAX_JSON_DEPTH:
+            try:
+                value = json.loads(text[start:end])
+            except ValueError:
+                pass
+        if value is None and text.find("'", start, end or len(text)) != -1:
+            # a quoted bracket ('it}s') can end the JSON span early or leave it unclosed
+            span_end, span_depth = end, depth
+            if rescans < _RESCANS:
+                rescans += 1
+                span_end, span_depth = _balanced_end(text, start, _LITERAL_TOKEN)
+            if span_end is not None and span_depth <= _MAX_JSON_DEPTH:
+                try:
+                    value = ast.literal_eval(text[start:span_end])
+                except (ValueError, SyntaxError, MemoryError, RecursionError):
+                    pass
+            end = None if span_end is None else max(end or 0, span_end)
+        if isinstance(value, (dict, list)) and (accept is None or accept(value)):
+            return value
+        if end is None:
+            if rescans >= _RESCANS or _cut_off(text, start):
+                return None
+            rescans += 1
+            end = m.end()
+        pos = end
+
+
+def response_format_mode() -> str:
+    """Structured output mode used for OPENAI_MODEL (see RESPONSE_FORMAT)."""
+    if RESPONSE_FORMAT in _FORMAT_MODES:
+        mode = RESPONSE_FORMAT
+    elif OPENAI_MODEL.startswith(_JSON_SCHEMA_MODELS):
+        mode = 'json_schema'
+    elif OPENAI_MODEL.startswith(_JSON_OBJECT_MODELS):
+        mode = 'json_object'
+    else:
+        mode = 'off'
+    # fall back to the next mode down when the model rejected this one
+    for candidate in _FORMAT_MODES[_FORMAT_MODES.index(mode):]:
+        if (OPENAI_MODEL, candidate) not in _rejected_formats:
+            return candidate
+    return 'off'
+
+
+def response_format(task: str) -> Optional[Dict[str, Any]]:
+    return llm_schemas.response_format(task, response_format_mode())
+
 
+def _request(messages: List[Dict[str, str]], temperature: float, max_tokens: int,
+             response_format: Optional[Dict[str, Any]] = None, **extra) -> Dict[str, Any]:
+    """Keyword arguments for chat.completions.create."""
+    kwargs = dict(model=OPENAI_MODEL, messages=messages, temperature=temperature, max_tokens=max_tokens, **extra)
+    if response_format is not None:
+        kwargs['response_format'] = response_format
+        # JSON mode is refused unless the prompt itself asks for JSON
+        if response_format['type'] == 'json_object' and not any('json' in m['content'].lower() for m in messages):
+            kwargs['messages'] = [{'role': 'system', 'content': 'Respond with a JSON object.'}] + messages
+    return kwargs
 
-def _call_openai(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 400) -> str:
+
+def _format_rejected(error: LLMError, response_format: Optional[Dict[str, Any]]) -> bool:
+    """True (and the mode is remembered) when a 400 says the model does not
+    support `response_format`; the caller then retries with the next mode."""
+    if response_format is None or not isinstance(error, PermanentError) or error.status_code != 400:
+        return False
+    if 'response_format' not in str(error) and 'json_schema' not in str(error):
+        return False
+    _rejected_formats.add((OPENAI_MODEL, response_format['type']))
+    return True
+
+
+def _next_format(response_format: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The format to retry with after `response_format` was rejected."""
+    if response_format['type'] == 'json_schema' and (OPENAI_MODEL, 'json_object') not in _rejected_formats:
+        return {'type': 'json_object'}
+    return None
+
+
+def _message_text(message) -> Optional[str]:
+    """Content of a completion message; a refusal (structured outputs put it
+    in `refusal`, not the content) raises LLMError instead of reading as empty."""
+    if isinstance(message, dict):
+        content, refusal = message.get('content'), message.get('refusal')
+    else:
+        content, refusal = message.content, getattr(message, 'refusal', None)
+    if not content and refusal:
+        raise LLMError(f'The model refused the request: {refusal}')
+    return content
+
+
+def _call_openai(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 400,
+                 response_format: Optional[Dict[str, Any]] = None) -> str:
+    """Completion text for `messages`; raises LLMError once retries are
+    exhausted (see llm_resilience)."""
     if not OPENAI_KEY:
         return None
-    # openai>=1.0 client path
-    if _openai_client is not None:
+    tokens = llm_resilience.estimate_tokens(messages, max_tokens)
+    kwargs = _request(messages, temperature, max_tokens, response_format)
+    # openai>=1.0 client path: the pooled client, looked up per call since close() replaces it
+    client = llm_client.sync_client(OPENAI_KEY)
+    if client is not None:
         try:
-            resp = _openai_client.chat.completions.create(
-                model=OPENAI_MODEL,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-            )
-            return resp.choices[0].message.content
-        except Exception as e:
-            return f"[OPENAI_ERROR] {e}"
+            resp = llm_resilience.call(lambda: client.chat.completions.create(**kwargs), tokens)
+        except PermanentError as e:
+            if not _format_rejected(e, response_format):
+                raise
+            return _call_openai(messages, temperature, max_tokens, _next_format(response_format))
+        if resp.usage is not None:
+            llm_metrics.note(prompt_tokens=resp.usage.prompt_tokens, completion_tokens=resp.usage.completion_tokens)
+        return _message_text(resp.choices[0].message)
     # openai<1.0 legacy path
     if not openai:
         return None
     try:
-        resp = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            temperature=temperature,
-            max_tokens=max_tokens,
-        )
-        return resp['choices'][0]['message']['content']
+        resp = llm_resilience.call(lambda: openai.ChatCompletion.create(request_timeout=llm_client.TIMEOUT, **kwargs), tokens)
+    except PermanentError as e:
+        if not _format_rejected(e, response_format):
+            raise
+        return _call_openai(messages, temperature, max_tokens, _next_format(response_format))
+    usage = resp.get('usage') or {}
+    llm_metrics.note(prompt_tokens=usage.get('prompt_tokens'), completion_tokens=usage.get('completion_tokens'))
+    return _message_text(resp['choices'][0]['message'])
+
+
+def _stream_openai(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 400,
+                   response_format: Optional[Dict[str, Any]] = None) -> Iterator[str]:
+    """Streaming variant of _call_openai (stream=True): yields text deltas as
+    they arrive. Opening the stream is retried; a failure after the first
+    chunk raises LLMError, since the caller has already shown partial text."""
+    if not OPENAI_KEY:
+        return
+    client = llm_client.sync_client(OPENAI_KEY)
+    if client is None:
+        # legacy SDK: no streaming support here, return the whole completion
+        text = _call_openai(messages, temperature=temperature, max_tokens=max_tokens, response_format=response_format)
+        if text:
+            yield text
+        return
+    kwargs = _request(messages, temperature, max_tokens, response_format,
+                      stream=True, stream_options={'include_usage': True})
+    try:
+        stream = llm_resilience.call(lambda: client.chat.completions.create(**kwargs),
+                                     llm_resilience.estimate_tokens(messages, max_tokens))
+    except PermanentError as e:
+        if not _format_rejected(e, response_format):
+            raise
+        yield from _stream_openai(messages, temperature, max_tokens, _next_format(response_format))
+        return
+    refusal = ''
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                llm_metrics.note(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+            delta = chunk.choices[0].delta if chunk.choices else None
+            refusal += getattr(delta, 'refusal', None) or ''
+            if delta is not None and delta.content:
+                yield delta.content
     except Exception as e:
-        # Return error message as string for higher-level handling
-        return f"[OPENAI_ERROR] {e}"
+        raise llm_resilience.classify(e) from e
+    if refusal:
+        raise LLMError(f'The model refused the request: {refusal}')
 
 
-def categorize(email_text: str, prompt: str) -> Dict[str, Any]:
-    if IS_MOCK:
-        return _mock_response('categorize')
-    system_prompt = prompt or 'Classify the email into categories.'
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": email_text}
-    ]
-    text = _call_openai(messages, temperature=0.0, max_tokens=300)
+def cache_key(task: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+    request = [OPENAI_MODEL, task, messages, temperature, max_tokens]
+    # structured and free-text replies to the same prompt are cached apart
+    fmt = response_format(task)
+    if fmt is not None:
+        request.append(fmt)
+    payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def cache_stats() -> Dict[str, int]:
+    with _cache_lock:
+        return dict(_cache_counters)
+
+
+def _count(counter: str):
+    with _cache_lock:
+        _cache_counters[counter] += 1
+
+
+def _cache_lookup(key: str):
+    try:
+        cached = db.get_cached_response(key, CACHE_TTL)
+    except Exception:
+        cached = None
+    _count('hits' if cached is not None else 'misses')
+    llm_metrics.note(cache='hit' if cached is not None else 'miss')
+    return cached
+
+
+def _cache_store(key: str, task: str, text: str):
+    # empty responses are never cached (errors raise before getting here)
     if not text:
-        return _mock_response('categorize')
-    parsed = _extract_json_from_text(text)
-    if parsed is not None:
-        return parsed
-    # fallback: try to parse whole text
+        return
     try:
-        return json.loads(text)
+        db.save_cached_response(key, task, OPENAI_MODEL, text, CACHE_MAX_ENTRIES)
     except Exception:
-        return {"raw": text}
+        pass
 
 
-def extract_actions(email_text: str, prompt: str) -> List[Dict[str, Any]]:
-    if IS_MOCK:
-        return _mock_response('extract')
-    messages = [
-        {"role": "system", "content": prompt or 'Extract action items.'},
-        {"role": "user", "content": email_text}
-    ]
-    text = _call_openai(messages, temperature=0.0, max_tokens=500)
+def _cached_call(task: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int, use_cache: bool = True) -> str:
+    """_call_openai behind the response cache; cache storage failures fall
+    back to a plain API call."""
+    if not (use_cache and CACHE_ENABLED):
+        llm_metrics.note(cache='off')
+        return _call_openai(messages, temperature=temperature, max_tokens=max_tokens, response_format=response_format(task))
+    key = cache_key(task, messages, temperature, max_tokens)
+    cached = _cache_lookup(key)
+    if cached is not None:
+        return cached
+    text = _call_openai(messages, temperature=temperature, max_tokens=max_tokens, response_format=response_format(task))
+    _cache_store(key, task, text)
+    return text
+
+
+# Pre-processing of email text before it goes into a prompt.
+
+# "On <date>, <name> wrote:" (Gmail wraps it over two lines) and Outlook's reply header
+_REPLY_HEADER = re.compile(
+    r'^(?:On\b[^\n]{0,300}(?:\n[^\n]{0,300})?\bwrote:[ \t]*'
+    r'|-{2,}[ \t]*Original Message[ \t]*-{2,}'
+    r'|From:[^\n]*\n(?:Sent|Date):[^\n]*)$',
+    re.I | re.M)
+_SIGNATURE = re.compile(r'^--[ \t]?$', re.M)
+_MOBILE_FOOTER = re.compile(r'^[ \t]*Sent from my [^\n]{1,40}$', re.I | re.M)
+_BOILERPLATE = re.compile(
+    r'intended (?:only )?(?:for the )?(?:named )?recipient|confidential(?:ity)? notice|privileged and confidential'
+    r'|to unsubscribe|unsubscribe from (?:this|these|our)|manage (?:your )?(?:email )?preferences'
+    r'|please consider the environment before printing|this (?:e-?mail|message) (?:and any attachments )?(?:is|may be) confidential',
+    re.I)
+# a dropped unsubscribe footer is a strong Newsletter/Promo signal: leave a note in its place
+_UNSUBSCRIBE = re.compile(r'unsubscribe|manage (?:your )?(?:email )?preferences', re.I)
+UNSUBSCRIBE_MARKER = '[unsubscribe footer removed]'
+
+
+def clean_email_text(text: str, strip_quotes: bool = True) -> str:
+    """`text` without quoted earlier messages (with `strip_quotes`), the
+    signature block, "Sent from my ..." lines and legal/unsubscribe footers
+    (an unsubscribe footer is replaced by UNSUBSCRIBE_MARKER).
+    Text none of the rules apply to is returned unchanged."""
     if not text:
-        return _mock_response('extract')
-    parsed = _extract_json_from_text(text)
-    if parsed is not None:
-        return parsed
+        return text
+    cleaned = text.replace('\r\n', '\n')
+    history = ''
+    m = _REPLY_HEADER.search(cleaned)
+    if m and m.start() > 0:
+        cleaned, history = cleaned[:m.start()], cleaned[m.start():]
+    if strip_quotes:
+        cleaned = '\n'.join(line for line in cleaned.split('\n') if not line.lstrip().startswith('>'))
+    m = _SIGNATURE.search(cleaned)
+    if m and m.start() > 0:
+        cleaned = cleaned[:m.start()]
+    cleaned = _MOBILE_FOOTER.sub('', cleaned)
+    paragraphs = re.split(r'\n[ \t]*\n', cleaned)
+    # the first paragraph is always the message itself
+    kept = paragraphs[:1]
+    unsubscribe = False
+    for p in paragraphs[1:]:
+        if not _BOILERPLATE.search(p):
+            kept.append(p)
+        elif _UNSUBSCRIBE.search(p):
+            unsubscribe = True
+    cleaned = '\n\n'.join(kept + [UNSUBSCRIBE_MARKER] * unsubscribe)
+    cleaned = re.sub(r'\n{3,}', '\n\n', cleaned).strip()
+    if history and not strip_quotes:
+        cleaned = f'{cleaned}\n\n{history.strip()}'
+    if not cleaned:
+        return text
+    return text if cleaned == text.replace('\r\n', '\n').strip() else cleaned
+
+
+def _encoding():
+    if tiktoken is None:
+        return None
     try:
-        return json.loads(text)
+        return tiktoken.encoding_for_model(OPENAI_MODEL)
     except Exception:
-        return [{"raw": text}]
+        return tiktoken.get_encoding('cl100k_base')
 
 
-def chat_with_email(email_text: str, prompts: Dict[str, Any], user_query: str) -> str:
-    if IS_MOCK:
-        # Professional, clear mock-mode response so the UI looks polished
-        return (
-            "MOCK MODE — no OpenAI API key configured.\n"
-            f"Example response for query: {user_query}\n\n"
-            "To enable real LLM answers set the environment variable `OPENAI_API_KEY` or add it to Streamlit secrets."
-        )
+def count_tokens(text: str) -> int:
+    """Tokens of `text` for OPENAI_MODEL (tiktoken), or an estimate of
+    4 characters per token when tiktoken is not installed."""
+    if not text:
+        return 0
+    enc = _encoding()
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, budget: int) -> Tuple[str, bool]:
+    """(text, truncated): the start and end of `text` within `budget` tokens,
+    dropping the middle; the opening states the request, the end often the deadline."""
+    if budget <= 0 or count_tokens(text) <= budget:
+        return text, False
+    head, tail = budget * 2 // 3, budget // 3
+    enc = _encoding()
+    if enc is None:
+        return f'{text[:head * 4]}\n[...]\n{text[-tail * 4:]}', True
+    tokens = enc.encode(text, disallowed_special=())
+    return f'{enc.decode(tokens[:head])}\n[...]\n{enc.decode(tokens[-tail:])}', True
+
+
+def prepare_email(email_text: str, task: str) -> str:
+    """Email text as sent to the model for `task`: cleaned and within the
+    task's INPUT_TOKEN_BUDGETS. Chat keeps quoted history, which users ask about."""
+    if not PREPROCESS_ENABLED or not email_text:
+        return email_text
+    text = clean_email_text(email_text, strip_quotes=task != 'chat')
+    text, truncated = truncate_to_tokens(text, INPUT_TOKEN_BUDGETS.get(task, 0))
+    tokens_in, tokens_sent = count_tokens(email_text), count_tokens(text)
+    with _cache_lock:
+        _preprocess_counters['emails'] += 1
+        _preprocess_counters['tokens_in'] += tokens_in
+        _preprocess_counters['tokens_sent'] += tokens_sent
+        _preprocess_counters['truncated'] += truncated
+    return text
+
+
+def preprocess_stats() -> Dict[str, int]:
+    with _cache_lock:
+        stats = dict(_preprocess_counters)
+    stats['tokens_saved'] = stats['tokens_in'] - stats['tokens_sent']
+    return stats
+
+
+# Message builders and response parsers shared by the sync functions below
+# and the async variants in llm_async.py.
+
+def _categorize_messages(email_text: str, prompt: str) -> List[Dict[str, str]]:
+    system_prompt = prompt or 'Classify the email into categories.'
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prepare_email(email_text, 'categorize')}
+    ]
+
+
+def _extract_messages(email_text: str, prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": prompt or 'Extract action items.'},
+        {"role": "user", "content": prepare_email(email_text, 'extract')}
+    ]
+
+
+def _analysis_messages(email_text: str, prompt: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": prompt or 'Categorize the email and extract action items as JSON.'},
+        {"role": "user", "content": prepare_email(email_text, 'analyze')}
+    ]
+
+
+def _chat_messages(email_text: str, prompts: Dict[str, Any], user_query: str) -> List[Dict[str, str]]:
     system = prompts.get('chat_system_instructions') if prompts else 'You are the user\'s helpful email assistant.'
     # keep prompt context concise
-    context_message = f"Email content:\n{email_text}\n\nUser query: {user_query}"
-    messages = [
+    context_message = f"Email content:\n{prepare_email(email_text, 'chat')}\n\nUser query: {user_query}"
+    return [
         {"role": "system", "content": system},
         {"role": "user", "content": context_message}
     ]
-    text = _call_openai(messages, temperature=0.3, max_tokens=500)
-    if not text:
-        return '[OPENAI_ERROR] No response.'
-    return text
 
 
-def generate_draft(email_text: str, prompt: str, tone: str = 'friendly') -> Dict[str, Any]:
-    if IS_MOCK:
-        return _mock_response('draft')
+def _draft_messages(email_text: str, prompt: str, tone: str) -> List[Dict[str, str]]:
     # replace placeholder for tone when present
     try:
         prompt_text = prompt.replace('{{tone}}', tone) if prompt else f'Write a reply in a {tone} tone.'
     except Exception:
         prompt_text = prompt or f'Write a reply in a {tone} tone.'
-    messages = [
+    return [
         {"role": "system", "content": prompt_text},
-        {"role": "user", "content": email_text}
+        {"role": "user", "content": prepare_email(email_text, 'draft')}
     ]
-    text = _call_openai(messages, temperature=0.4, max_tokens=700)
+
+
+def _parse_json_response(text: str, task: str, fallback):
+    """The JSON value in `text`, validated and normalized for `task` (see
+    llm_schemas); `fallback(text)` when there is none or it has the wrong shape.
+    An empty reply raises LLMError: mock output only comes from mock mode."""
     if not text:
-        return _mock_response('draft')
-    parsed = _extract_json_from_text(text)
-    if parsed is not None:
-        return parsed
+        llm_metrics.note(parse='empty')
+        raise LLMError('Empty response from the model.')
+    # structured outputs: the reply is the JSON value, decoded by the first
+    # raw_decode in _extract_json_from_text
+    valid = []
+
+    def accept(value):
+        valid.append(llm_schemas.validate(task, value))
+        return valid[-1] is not None
+
+    if _extract_json_from_text(text, accept) is None:
+        # JSON of the wrong shape is reported separately from no JSON at all
+        llm_metrics.note(parse='invalid' if valid else 'fallback')
+        return fallback(text)
+    llm_metrics.note(parse='json')
+    return valid[-1]
+
+
+def _split_analysis(parsed: Any, text: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Split a combined analysis response into the (categories, tasks) pair
+    stored by save_processed."""
+    if not isinstance(parsed, dict):
+        return {"raw": text}, []
+    categories = {k: v for k, v in parsed.items() if k != 'tasks'}
+    tasks = parsed.get('tasks')
+    if not isinstance(tasks, list):
+        tasks = []
+    return categories, tasks
+
+
+def _parse_analysis(text: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    parsed = _parse_json_response(text, 'analyze', lambda t: None)
+    return _split_analysis(parsed, text)
+
+
+def _mock_stream(text: str) -> Iterator[str]:
+    # word-sized chunks so mock mode exercises the same rendering path
+    for word in re.findall(r'\S+\s*|\s+', text):
+        yield word
+
+
+def parse_draft(text: str) -> Dict[str, Any]:
+    """Draft dict ({subject, body, ...}) from a complete draft response."""
+    return _parse_json_response(text, 'draft', lambda t: {"body": t})
+
+
+def draft_preview(partial: str) -> str:
+    """Readable text of a draft response still being streamed: the (possibly
+    unfinished) "body" value when the model is writing JSON, else the text."""
+    if not partial.lstrip().startswith(('{', '```')):
+        return partial
+    m = re.search(r'"body"\s*:\s*"((?:[^"\\]|\\.)*)', partial)
+    if not m:
+        return ''
+    # drop an escape sequence cut off by the chunk boundary (e.g. "\\u00")
+    value = re.sub(r'(?<!\\)((?:\\\\)*)\\(?:u[0-9a-fA-F]{0,3})?$', r'\1', m.group(1))
     try:
-        return json.loads(text)
+        return json.loads(f'"{value}"')
     except Exception:
-        return {"body": text}
+        return value.replace('\\n', '\n').replace('\\"', '"')
+
+
+def _mock_chat(user_query: str) -> str:
+    # Professional, clear mock-mode response so the UI looks polished
+    return (
+        "MOCK MODE — no OpenAI API key configured.\n"
+        f"Example response for query: {user_query}\n\n"
+        "To enable real LLM answers set the environment variable `OPENAI_API_KEY` or add it to Streamlit secrets."
+    )
+
+
+def categorize(email_text: str, prompt: str, use_cache: bool = True) -> Dict[str, Any]:
+    if IS_MOCK:
+        return _mock_response('categorize')
+    with llm_metrics.track('categorize', OPENAI_MODEL):
+        text = _cached_call('categorize', _categorize_messages(email_text, prompt), 0.0, 300, use_cache)
+        return _parse_json_response(text, 'categorize', lambda t: {"raw": t})
+
+
+def extract_actions(email_text: str, prompt: str, use_cache: bool = True) -> List[Dict[str, Any]]:
+    if IS_MOCK:
+        return _mock_response('extract')
+    with llm_metrics.track('extract', OPENAI_MODEL):
+        text = _cached_call('extract', _extract_messages(email_text, prompt), 0.0, 500, use_cache)
+        return _parse_json_response(text, 'extract', lambda t: [{"raw": t}])
+
+
+def analyze(email_text: str, prompt: str, use_cache: bool = True) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Categorize and extract action items in a single request; returns
+    (categories, tasks) in the same shapes as categorize/extract_actions."""
+    if IS_MOCK:
+        return _mock_response('categorize'), _mock_response('extract')
+    with llm_metrics.track('analyze', OPENAI_MODEL):
+        text = _cached_call('analyze', _analysis_messages(email_text, prompt), 0.0, 800, use_cache)
+        return _parse_analysis(text)
+
+
+def chat_with_email(email_text: str, prompts: Dict[str, Any], user_query: str) -> str:
+    if IS_MOCK:
+        return _mock_chat(user_query)
+    with llm_metrics.track('chat', OPENAI_MODEL):
+        text = _call_openai(_chat_messages(email_text, prompts, user_query), temperature=0.3, max_tokens=500)
+        if not text:
+            raise LLMError('Empty response from the model.')
+        return text
+
 
+def generate_draft(email_text: str, prompt: str, tone: str = 'friendly', use_cache: bool = True) -> Dict[str, Any]:
+    if IS_MOCK:
+        return _mock_response('draft')
+    with llm_metrics.track('draft', OPENAI_MODEL):
+        text = _cached_call('draft', _draft_messages(email_text, prompt, tone), 0.4, 700, use_cache)
+        return parse_draft(text)
+
+
+def chat_with_email_stream(email_text: str, prompts: Dict[str, Any], user_query: str) -> Iterator[str]:
+    """chat_with_email, yielding the reply in chunks as it is generated."""
+    if IS_MOCK:
+        yield from _mock_stream(_mock_chat(user_query))
+        return
+    with llm_metrics.track('chat', OPENAI_MODEL):
+        empty = True
+        for delta in _stream_openai(_chat_messages(email_text, prompts, user_query), temperature=0.3, max_tokens=500):
+            empty = False
+            yield delta
+        if empty:
+            raise LLMError('Empty response from the model.')
+
+
+def generate_draft_stream(email_text: str, prompt: str, tone: str = 'friendly', use_cache: bool = True) -> Iterator[str]:
+    """generate_draft, yielding the raw response text in chunks; pass the
+    joined text to parse_draft (and partial text to draft_preview)."""
+    if IS_MOCK:
+        yield from _mock_stream(json.dumps(_mock_response('draft'), ensure_ascii=False))
+        return
+    with llm_metrics.track('draft', OPENAI_MODEL):
+        messages = _draft_messages(email_text, prompt, tone)
+        key: Optional[str] = None
+        if use_cache and CACHE_ENABLED:
+            key = cache_key('draft', messages, 0.4, 700)
+            cached = _cache_lookup(key)
+            if cached is not None:
+                yield cached
+                return
+        parts = []
+        for delta in _stream_openai(messages, temperature=0.4, max_tokens=700, response_format=response_format('draft')):
+            parts.append(delta)
+            yield delta
+        if key is not None:
+            _cache_store(key, 'draft', ''.join(parts))
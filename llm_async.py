@@ -0,0 +1,213 @@
+"""
+Async counterpart of llm.py built on openai.AsyncOpenAI.
+
+Prompts, parsing, mock mode and the response cache are shared with llm.py;
+only the network call differs, so FastAPI routes can await model round
+trips without holding a worker thread and run independent calls together.
+
+Functions:
+- categorize, extract_actions, chat_with_email, generate_draft (async)
+- analyze(email_text, prompt) (async, single combined request)
+- analyze_email(email_text, prompts, email=None) (rules first, then the model)
+- chat_with_email_stream, generate_draft_stream (async generators of text chunks)
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import llm
+import llm_client
+import llm_metrics
+import llm_resilience
+import rules
+
+
+def _get_client():
+    # one pooled client per event loop; sync callers use llm_client.run() so it is closed with the loop,
+    # or llm_client.submit() to keep reusing one loop
+    return llm_client.async_client(llm.OPENAI_KEY)
+
+
+async def _call_openai(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 400,
+                       response_format: Optional[Dict[str, Any]] = None) -> str:
+    client = _get_client()
+    if client is None:
+        # no async client (openai<1.0): run the sync path in a worker thread
+        return await asyncio.to_thread(llm._call_openai, messages, temperature, max_tokens, response_format)
+    kwargs = llm._request(messages, temperature, max_tokens, response_format)
+    try:
+        resp = await llm_resilience.acall(lambda: client.chat.completions.create(**kwargs),
+                                          llm_resilience.estimate_tokens(messages, max_tokens))
+    except llm.PermanentError as e:
+        if not llm._format_rejected(e, response_format):
+            raise
+        return await _call_openai(messages, temperature, max_tokens, llm._next_format(response_format))
+    if resp.usage is not None:
+        llm_metrics.note(prompt_tokens=resp.usage.prompt_tokens, completion_tokens=resp.usage.completion_tokens)
+    return llm._message_text(resp.choices[0].message)
+
+
+async def _iterate_in_thread(chunks: Iterator[str]) -> AsyncIterator[str]:
+    # drive a blocking generator from a worker thread, one chunk at a time
+    done = object()
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+async def _stream_openai(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 400,
+                         response_format: Optional[Dict[str, Any]] = None) -> AsyncIterator[str]:
+    client = _get_client()
+    if client is None:
+        async for chunk in _iterate_in_thread(llm._stream_openai(messages, temperature, max_tokens, response_format)):
+            yield chunk
+        return
+    kwargs = llm._request(messages, temperature, max_tokens, response_format,
+                          stream=True, stream_options={'include_usage': True})
+    try:
+        stream = await llm_resilience.acall(lambda: client.chat.completions.create(**kwargs),
+                                            llm_resilience.estimate_tokens(messages, max_tokens))
+    except llm.PermanentError as e:
+        if not llm._format_rejected(e, response_format):
+            raise
+        async for chunk in _stream_openai(messages, temperature, max_tokens, llm._next_format(response_format)):
+            yield chunk
+        return
+    refusal = ''
+    try:
+        async for chunk in stream:
+            if getattr(chunk, 'usage', None) is not None:
+                llm_metrics.note(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+            delta = chunk.choices[0].delta if chunk.choices else None
+            refusal += getattr(delta, 'refusal', None) or ''
+            if delta is not None and delta.content:
+                yield delta.content
+    except Exception as e:
+        raise llm_resilience.classify(e) from e
+    if refusal:
+        raise llm.LLMError(f'The model refused the request: {refusal}')
+
+
+async def _cached_call(task: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int, use_cache: bool = True) -> str:
+    if not (use_cache and llm.CACHE_ENABLED):
+        llm_metrics.note(cache='off')
+        return await _call_openai(messages, temperature=temperature, max_tokens=max_tokens,
+                                  response_format=llm.response_format(task))
+    key = llm.cache_key(task, messages, temperature, max_tokens)
+    # the cache lives in SQLite: keep it off the event loop
+    cached = await asyncio.to_thread(llm._cache_lookup, key)
+    if cached is not None:
+        return cached
+    text = await _call_openai(messages, temperature=temperature, max_tokens=max_tokens,
+                              response_format=llm.response_format(task))
+    await asyncio.to_thread(llm._cache_store, key, task, text)
+    return text
+
+
+async def categorize(email_text: str, prompt: str, use_cache: bool = True) -> Dict[str, Any]:
+    if llm.IS_MOCK:
+        return llm._mock_response('categorize')
+    with llm_metrics.track('categorize', llm.OPENAI_MODEL):
+        text = await _cached_call('categorize', llm._categorize_messages(email_text, prompt), 0.0, 300, use_cache)
+        return llm._parse_json_response(text, 'categorize', lambda t: {"raw": t})
+
+
+async def extract_actions(email_text: str, prompt: str, use_cache: bool = True) -> List[Dict[str, Any]]:
+    if llm.IS_MOCK:
+        return llm._mock_response('extract')
+    with llm_metrics.track('extract', llm.OPENAI_MODEL):
+        text = await _cached_call('extract', llm._extract_messages(email_text, prompt), 0.0, 500, use_cache)
+        return llm._parse_json_response(text, 'extract', lambda t: [{"raw": t}])
+
+
+async def chat_with_email(email_text: str, prompts: Dict[str, Any], user_query: str) -> str:
+    if llm.IS_MOCK:
+        return llm._mock_chat(user_query)
+    with llm_metrics.track('chat', llm.OPENAI_MODEL):
+        text = await _call_openai(llm._chat_messages(email_text, prompts, user_query), temperature=0.3, max_tokens=500)
+        if not text:
+            raise llm.LLMError('Empty response from the model.')
+        return text
+
+
+async def generate_draft(email_text: str, prompt: str, tone: str = 'friendly', use_cache: bool = True) -> Dict[str, Any]:
+    if llm.IS_MOCK:
+        return llm._mock_response('draft')
+    with llm_metrics.track('draft', llm.OPENAI_MODEL):
+        text = await _cached_call('draft', llm._draft_messages(email_text, prompt, tone), 0.4, 700, use_cache)
+        return llm._parse_json_response(text, 'draft', lambda t: {"body": t})
+
+
+async def analyze(email_text: str, prompt: str, use_cache: bool = True) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    if llm.IS_MOCK:
+        return llm._mock_response('categorize'), llm._mock_response('extract')
+    with llm_metrics.track('analyze', llm.OPENAI_MODEL):
+        text = await _cached_call('analyze', llm._analysis_messages(email_text, prompt), 0.0, 800, use_cache)
+        return llm._parse_analysis(text)
+
+
+async def analyze_email(email_text: str, prompts: Dict[str, str], use_cache: bool = True,
+                        combined: Optional[bool] = None,
+                        email: Optional[Dict[str, Any]] = None) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Categories and tasks for an email; returns (categories, tasks).
+
+    With `email` (the email dict: sender, subject, headers) the rules in
+    rules.py are tried first, and obvious bulk mail is answered without a
+    model call. With `combined` (default: llm.COMBINED_ANALYSIS) this is one
+    request using the analysis_prompt; otherwise categorize and
+    extract_actions run concurrently.
+    """
+    if combined is None:
+        combined = llm.COMBINED_ANALYSIS
+    combined = bool(combined and prompts.get('analysis_prompt'))
+    if email is not None:
+        categories = rules.classify({**email, 'body': email_text}, llm_calls=1 if combined else 2)
+        if categories is not None:
+            return categories, []
+    if combined:
+        return await analyze(email_text, prompts['analysis_prompt'], use_cache)
+    categories, tasks = await asyncio.gather(
+        categorize(email_text, prompts.get('categorization_prompt') or '', use_cache),
+        extract_actions(email_text, prompts.get('action_item_prompt') or '', use_cache),
+    )
+    return categories, tasks
+
+
+async def chat_with_email_stream(email_text: str, prompts: Dict[str, Any], user_query: str) -> AsyncIterator[str]:
+    if llm.IS_MOCK:
+        for chunk in llm._mock_stream(llm._mock_chat(user_query)):
+            yield chunk
+        return
+    with llm_metrics.track('chat', llm.OPENAI_MODEL):
+        empty = True
+        async for delta in _stream_openai(llm._chat_messages(email_text, prompts, user_query), temperature=0.3, max_tokens=500):
+            empty = False
+            yield delta
+        if empty:
+            raise llm.LLMError('Empty response from the model.')
+
+
+async def generate_draft_stream(email_text: str, prompt: str, tone: str = 'friendly', use_cache: bool = True) -> AsyncIterator[str]:
+    """Raw draft response text in chunks; see llm.parse_draft / llm.draft_preview."""
+    if llm.IS_MOCK:
+        for chunk in llm._mock_stream(json.dumps(llm._mock_response('draft'), ensure_ascii=False)):
+            yield chunk
+        return
+    with llm_metrics.track('draft', llm.OPENAI_MODEL):
+        messages = llm._draft_messages(email_text, prompt, tone)
+        key = None
+        if use_cache and llm.CACHE_ENABLED:
+            key = llm.cache_key('draft', messages, 0.4, 700)
+            cached = await asyncio.to_thread(llm._cache_lookup, key)
+            if cached is not None:
+                yield cached
+                return
+        parts = []
+        async for delta in _stream_openai(messages, temperature=0.4, max_tokens=700,
+                                          response_format=llm.response_format('draft')):
+            parts.append(delta)
+            yield delta
+        if key is not None:
+            await asyncio.to_thread(llm._cache_store, key, 'draft', ''.join(parts))
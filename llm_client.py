@@ -0,0 +1,161 @@
+"""
+OpenAI client construction shared by llm.py and llm_async.py.
+
+Both paths get their HTTP settings from here, so connections are pooled and
+kept alive between requests instead of paying a TCP + TLS handshake per call,
+and a slow API cannot hold a worker forever:
+- OPENAI_BASE_URL: API root (e.g. a proxy or the local fake server in benchmarks/)
+- OPENAI_TIMEOUT / OPENAI_CONNECT_TIMEOUT: read and connect timeouts in seconds
+- OPENAI_MAX_CONNECTIONS / OPENAI_MAX_KEEPALIVE / OPENAI_KEEPALIVE_EXPIRY: pool size
+- OPENAI_HTTP2=1: multiplex requests over one connection (needs the `h2` package)
+
+The sync client is a process-wide singleton (httpx clients are thread-safe);
+async clients are bound to the event loop they were first used on, so there
+is one per loop. Sync code should call run(coro) instead of asyncio.run():
+it closes the loop's client (and its connection pool) before the loop goes
+away. Callers that run coroutines over and over (the Streamlit app, once per
+button click) use submit(coro) instead, which runs them on one background
+loop kept for the life of the process, so its client and pool are reused.
+
+Functions:
+- sync_client(api_key), async_client(api_key)
+- run(coro), submit(coro), aclose()
+- close()
+"""
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from typing import Any, Awaitable, Dict, Optional, TypeVar
+
+try:
+    import httpx
+    from openai import AsyncOpenAI, OpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient
+except Exception:
+    httpx = None
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '10'))
+MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '20'))
+MAX_KEEPALIVE = int(os.getenv('OPENAI_MAX_KEEPALIVE', '10'))
+KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30'))
+HTTP2 = os.getenv('OPENAI_HTTP2', '').lower() in ('1', 'true', 'yes')
+
+_lock = threading.Lock()
+_sync_client = None
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _http2() -> bool:
+    if not HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        log.warning('OPENAI_HTTP2 is set but the h2 package is not installed; using HTTP/1.1')
+        return False
+    return True
+
+
+def _http_options() -> Dict[str, Any]:
+    return {
+        'timeout': httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT),
+        'limits': httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE,
+                               keepalive_expiry=KEEPALIVE_EXPIRY),
+        'http2': _http2(),
+    }
+
+
+def _client_options(api_key: str) -> Dict[str, Any]:
+    # retries are handled by llm_resilience, not the SDK
+    return {'api_key': api_key, 'base_url': BASE_URL, 'max_retries': 0,
+            'timeout': httpx.Timeout(TIMEOUT, connect=CONNECT_TIMEOUT)}
+
+
+def sync_client(api_key: Optional[str]):
+    """The shared OpenAI client, or None without an API key or openai>=1.0."""
+    global _sync_client
+    if httpx is None or not api_key:
+        return None
+    with _lock:
+        if _sync_client is None:
+            _sync_client = OpenAI(**_client_options(api_key), http_client=DefaultHttpxClient(**_http_options()))
+        return _sync_client
+
+
+def async_client(api_key: Optional[str]):
+    """The AsyncOpenAI client for the running event loop."""
+    if httpx is None or not api_key:
+        return None
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _async_clients.get(loop)
+        if client is None:
+            client = _async_clients[loop] = AsyncOpenAI(**_client_options(api_key),
+                                                        http_client=DefaultAsyncHttpxClient(**_http_options()))
+    return client
+
+
+async def aclose():
+    """Close the running loop's async client, if it has one."""
+    with _lock:
+        client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def run(coro: Awaitable[T]) -> T:
+    """asyncio.run(coro), closing the loop's async client before the loop shuts down."""
+    async def main():
+        try:
+            return await coro
+        finally:
+            await aclose()
+    return asyncio.run(main())
+
+
+def submit(coro: Awaitable[T]) -> T:
+    """Run `coro` on the shared background event loop and wait for its result.
+    Unlike run(), the loop and its async client outlive the call."""
+    global _background_loop
+    with _lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name='llm-client-loop', daemon=True).start()
+        loop = _background_loop
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def close():
+    """Close the pooled sync connections and every async client whose loop is
+    still open; the next sync_client()/async_client() builds a new client."""
+    global _sync_client
+    with _lock:
+        client, _sync_client = _sync_client, None
+        async_clients = list(_async_clients.items())
+        _async_clients.clear()
+    if client is not None:
+        client.close()
+    try:
+        current = asyncio.get_running_loop()
+    except RuntimeError:
+        current = None
+    for loop, async_client in async_clients:
+        if loop.is_closed():
+            continue  # its transports went with the loop
+        if loop is current:
+            loop.create_task(async_client.close())
+        elif loop.is_running():
+            try:
+                asyncio.run_coroutine_threadsafe(async_client.close(), loop).result(timeout=5)
+            except Exception as e:
+                log.warning('Could not close async OpenAI client: %s', e)
+        else:
+            loop.run_until_complete(async_client.close())
@@ -0,0 +1,220 @@
+"""
+Per-call instrumentation for llm.py and llm_async.py.
+
+Each public LLM function runs inside track(task, model); the code below it
+adds what it learns with note() (cache hit or miss, token usage from the API
+response, whether the reply parsed as JSON). When the call ends the record
+gets its latency, status and estimated cost and is buffered, then written to
+the `llm_calls` table in batches (every FLUSH_EVERY records or FLUSH_INTERVAL
+seconds, and on flush()). Rows older than LLM_METRICS_RETENTION_DAYS are pruned;
+the same flush adds each call to running totals that are never pruned, which
+the Prometheus counters are read from.
+
+Functions:
+- track(task, model) (context manager), note(**fields)
+- flush(), summary(since=None), prometheus_text()
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import db
+import llm_resilience
+import rules
+
+log = logging.getLogger(__name__)
+
+ENABLED = os.getenv('LLM_METRICS_DISABLED', '').lower() not in ('1', 'true', 'yes')
+RETENTION_DAYS = float(os.getenv('LLM_METRICS_RETENTION_DAYS', '30'))
+FLUSH_EVERY = 20
+FLUSH_INTERVAL = 5.0
+LATENCY_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# USD per 1M (prompt, completion) tokens; LLM_PRICE_INPUT / LLM_PRICE_OUTPUT
+# override them for models not listed here
+MODEL_PRICES = {
+    'gpt-4': (30.0, 60.0),
+    'gpt-4-turbo': (10.0, 30.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4.1': (2.0, 8.0),
+    'gpt-4.1-mini': (0.4, 1.6),
+    'gpt-3.5-turbo': (0.5, 1.5),
+}
+
+_current: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('llm_call', default=None)
+_lock = threading.Lock()
+_pending: List[Dict[str, Any]] = []
+_last_flush = time.monotonic()
+_last_prune = 0.0
+
+
+def _price(model: Optional[str]):
+    if os.getenv('LLM_PRICE_INPUT') or os.getenv('LLM_PRICE_OUTPUT'):
+        return float(os.getenv('LLM_PRICE_INPUT') or 0), float(os.getenv('LLM_PRICE_OUTPUT') or 0)
+    # dated snapshots ("gpt-4o-2024-08-06") are priced like their base model
+    for name in sorted(MODEL_PRICES, key=len, reverse=True):
+        if model and model.startswith(name):
+            return MODEL_PRICES[name]
+    return None
+
+
+def _cost(call: Dict[str, Any]) -> Optional[float]:
+    price = _price(call.get('model'))
+    if price is None or call.get('prompt_tokens') is None:
+        return None
+    return (call['prompt_tokens'] * price[0] + (call.get('completion_tokens') or 0) * price[1]) / 1_000_000
+
+
+def note(**fields):
+    """Attach fields (cache, parse, prompt_tokens, completion_tokens) to the call being tracked."""
+    call = _current.get()
+    if call is not None:
+        call.update(fields)
+
+
+@contextmanager
+def track(task: str, model: str) -> Iterator[Dict[str, Any]]:
+    call: Dict[str, Any] = {'task': task, 'model': model, 'status': 'ok', 'created_at': time.time()}
+    token = _current.set(call)
+    start = time.perf_counter()
+    try:
+        yield call
+    except BaseException as exc:
+        # GeneratorExit: a stream the client stopped reading
+        call['status'] = 'cancelled' if isinstance(exc, GeneratorExit) else 'error'
+        call['error'] = type(exc).__name__
+        raise
+    finally:
+        call['latency_ms'] = (time.perf_counter() - start) * 1000
+        call['cost_usd'] = _cost(call)
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass  # generator finished in another context
+        if ENABLED:
+            _record(call)
+
+
+def _record(call: Dict[str, Any]):
+    global _last_flush
+    with _lock:
+        _pending.append(call)
+        due = len(_pending) >= FLUSH_EVERY or time.monotonic() - _last_flush >= FLUSH_INTERVAL
+    if due:
+        flush()
+
+
+def flush():
+    """Write buffered records to SQLite; recording never breaks an LLM call."""
+    global _last_flush, _last_prune
+    with _lock:
+        calls = list(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+    if not calls:
+        return
+    try:
+        db.save_llm_calls(calls, LATENCY_BUCKETS_MS)
+        if time.time() - _last_prune > 3600:
+            _last_prune = time.time()
+            db.prune_llm_calls(time.time() - RETENTION_DAYS * 86400)
+    except Exception as exc:
+        log.warning('could not save %d LLM call records: %s', len(calls), exc)
+
+
+def summary(since: Optional[float] = None) -> Dict[str, Any]:
+    """Totals for the sidebar: calls, errors, cache hits, tokens, cost, latency, parse fallbacks."""
+    flush()
+    rows = db.get_llm_call_stats(since)
+    api = [r for r in rows if r['cache'] != 'hit']
+    calls = sum(r['calls'] for r in rows)
+    api_calls = sum(r['calls'] for r in api)
+    return {
+        'calls': calls,
+        'errors': sum(r['calls'] for r in rows if r['status'] != 'ok'),
+        'cache_hits': calls - api_calls,
+        'prompt_tokens': sum(r['prompt_tokens'] for r in rows),
+        'completion_tokens': sum(r['completion_tokens'] for r in rows),
+        'cost_usd': sum(r['cost_usd'] for r in rows),
+        'avg_latency_ms': sum(r['latency_ms'] for r in api) / api_calls if api_calls else None,
+        'parse_fallbacks': sum(r['calls'] for r in rows if r['parse'] == 'fallback'),
+    }
+
+
+def _escape(value) -> str:
+    return str(value if value is not None else '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels) -> str:
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def prometheus_text() -> str:
+    """Metrics in the Prometheus text exposition format, from the running
+    LLM call totals (so counters never drop when llm_calls is pruned) plus
+    the live circuit breaker state."""
+    flush()
+    rows = db.get_llm_call_totals()
+    latency = db.get_llm_latency_totals(LATENCY_BUCKETS_MS)
+    out = []
+
+    def metric(name, kind, help_text, samples):
+        out.append(f'# HELP {name} {help_text}')
+        out.append(f'# TYPE {name} {kind}')
+        out.extend(f'{name}{labels} {value:g}' for labels, value in samples)
+
+    def grouped(keys, value, rows=rows):
+        totals: Dict[tuple, float] = {}
+        for r in rows:
+            k = tuple(r[key] for key in keys)
+            totals[k] = totals.get(k, 0) + value(r)
+        return [(_labels(**dict(zip(keys, k))), v) for k, v in sorted(totals.items(), key=lambda kv: str(kv[0]))]
+
+    metric('email_agent_llm_calls_total', 'counter', 'LLM calls by task, model, status and cache result.',
+           grouped(('task', 'model', 'status', 'cache'), lambda r: r['calls']))
+    metric('email_agent_llm_parse_total', 'counter', 'Parsed LLM responses by outcome (json, invalid shape, or fallback to raw text).',
+           grouped(('task', 'parse'), lambda r: r['calls'], [r for r in rows if r['parse']]))
+    metric('email_agent_llm_prompt_tokens_total', 'counter', 'Prompt tokens reported by the API.',
+           grouped(('task', 'model'), lambda r: r['prompt_tokens']))
+    metric('email_agent_llm_completion_tokens_total', 'counter', 'Completion tokens reported by the API.',
+           grouped(('task', 'model'), lambda r: r['completion_tokens']))
+    metric('email_agent_llm_cost_usd_total', 'counter', 'Estimated API cost in USD.',
+           grouped(('task', 'model'), lambda r: r['cost_usd']))
+
+    by_task: Dict[str, Dict[str, Any]] = {}
+    for r in rows:
+        h = by_task.setdefault(r['task'], {'count': 0, 'sum': 0.0,
+                                           'buckets': latency.get(r['task'], [0] * len(LATENCY_BUCKETS_MS))})
+        h['count'] += r['calls']
+        h['sum'] += r['latency_ms'] / 1000
+    samples = []
+    for task, h in sorted(by_task.items()):
+        for le, n in zip(LATENCY_BUCKETS_MS, h['buckets']):
+            samples.append((_labels(task=task, le=f'{le / 1000:g}'), n))
+        samples.append((_labels(task=task, le='+Inf'), h['count']))
+    out.append('# HELP email_agent_llm_latency_seconds LLM call latency, including cache lookups.')
+    out.append('# TYPE email_agent_llm_latency_seconds histogram')
+    out.extend(f'email_agent_llm_latency_seconds_bucket{labels} {value:g}' for labels, value in samples)
+    for task, h in sorted(by_task.items()):
+        out.append(f'email_agent_llm_latency_seconds_sum{_labels(task=task)} {h["sum"]:g}')
+        out.append(f'email_agent_llm_latency_seconds_count{_labels(task=task)} {h["count"]:g}')
+
+    status = llm_resilience.status()
+    metric('email_agent_llm_circuit_open', 'gauge', '1 while the OpenAI circuit breaker is open.',
+           [('', 1 if status['breaker'] == 'open' else 0)])
+    metric('email_agent_llm_retries_total', 'counter', 'OpenAI request retries since the process started.',
+           [('', status['retries'])])
+
+    classified = rules.stats()
+    metric('email_agent_rules_classified_total', 'counter', 'Emails categorized by the rules classifier without an LLM call.',
+           [(_labels(category=c), n) for c, n in sorted(classified['by_category'].items())])
+    metric('email_agent_rules_forwarded_total', 'counter', 'Emails the rules classifier left to the LLM.',
+           [('', classified['forwarded'])])
+    metric('email_agent_rules_llm_calls_avoided_total', 'counter', 'LLM calls avoided by the rules classifier.',
+           [('', classified['llm_calls_avoided'])])
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,246 @@
+"""
+Failure handling for OpenAI calls, shared by llm.py and llm_async.py.
+
+Every request goes through the same pipeline: the request and token buckets
+(LLM_RPM / LLM_TPM) pace it, the circuit breaker fails fast while the API is
+down, and failures are classified so only transient ones (rate limits, 5xx,
+timeouts, connection errors) are retried with exponential backoff, full
+jitter and any Retry-After the server sent. Errors surface as LLMError
+subclasses instead of text that could be mistaken for model output.
+
+Functions:
+- call(fn, tokens) / acall(fn, tokens) (async)
+- classify(exc) -> LLMError
+- status() (breaker state and counters)
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '4'))
+BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', '0.5'))
+BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', '30'))
+# 0 disables the limit
+REQUESTS_PER_MINUTE = float(os.getenv('LLM_RPM', '0'))
+TOKENS_PER_MINUTE = float(os.getenv('LLM_TPM', '0'))
+BREAKER_THRESHOLD = int(os.getenv('LLM_BREAKER_THRESHOLD', '5'))
+BREAKER_RESET = float(os.getenv('LLM_BREAKER_RESET', '30'))
+
+
+class LLMError(Exception):
+    """A model call that failed; `retryable` errors may succeed later."""
+    retryable = False
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class RateLimitError(LLMError):
+    retryable = True
+
+
+class TransientError(LLMError):
+    retryable = True
+
+
+class PermanentError(LLMError):
+    """Bad request, authentication or a missing model: retrying cannot help."""
+
+
+class CircuitOpenError(LLMError):
+    """Raised without calling the API while the breaker is open."""
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass  # HTTP-date form: fall back to our own backoff
+    return None
+
+
+def classify(exc: Exception) -> LLMError:
+    """Map an SDK/network exception to an LLMError subclass."""
+    if isinstance(exc, LLMError):
+        return exc
+    status = getattr(exc, 'status_code', None)
+    name = type(exc).__name__
+    message = f'{name}: {exc}'
+    if status == 429 or name == 'RateLimitError':
+        return RateLimitError(message, status or 429, _retry_after(exc))
+    if status is not None:
+        if status >= 500 or status in (408, 409):
+            return TransientError(message, status, _retry_after(exc))
+        return PermanentError(message, status)
+    if name in ('APITimeoutError', 'APIConnectionError') or isinstance(exc, (TimeoutError, ConnectionError, OSError)):
+        return TransientError(message)
+    return PermanentError(message)
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute with bursts up to one minute's worth.
+
+    reserve() debits immediately (the balance may go negative) and returns how
+    long the caller must wait, so sync and async callers can share a bucket.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self._tokens = per_minute
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # a single request larger than the bucket just waits for a full bucket
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive transient failures; after `reset_after`
+    seconds one trial call is let through (half-open) to probe the API."""
+
+    def __init__(self, threshold: int, reset_after: float):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.state = 'closed'
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_after:
+                self.state = 'half-open'
+                self._trial = False
+            if self.state == 'open' or (self.state == 'half-open' and self._trial):
+                retry_in = max(0.0, self.reset_after - (time.monotonic() - self._opened_at))
+                raise CircuitOpenError('OpenAI API unavailable (circuit open)', 503, retry_in)
+            if self.state == 'half-open':
+                self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.state = 'closed'
+
+    def record_failure(self, error: LLMError):
+        # rate limits and bad requests say nothing about the API being down
+        if not isinstance(error, TransientError):
+            with self._lock:
+                if self.state == 'half-open':
+                    self.state = 'closed'
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+
+
+requests_bucket = TokenBucket(REQUESTS_PER_MINUTE)
+tokens_bucket = TokenBucket(TOKENS_PER_MINUTE)
+breaker = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_RESET)
+
+_counters_lock = threading.Lock()
+_counters = {'calls': 0, 'retries': 0, 'failures': 0, 'rejected': 0}
+
+
+def _count(counter: str):
+    with _counters_lock:
+        _counters[counter] += 1
+
+
+def status() -> Dict[str, Any]:
+    with _counters_lock:
+        counters = dict(_counters)
+    return {'breaker': breaker.state, 'consecutive_failures': breaker.failures, **counters}
+
+
+def _backoff(attempt: int, error: LLMError) -> float:
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+    if error.retry_after is not None:
+        delay = max(delay, min(error.retry_after, BACKOFF_MAX))
+    return delay
+
+
+def _pace(tokens: int) -> float:
+    return max(requests_bucket.reserve(1), tokens_bucket.reserve(tokens))
+
+
+def _attempt_failed(exc: Exception, attempt: int) -> float:
+    """Record a failed attempt; returns the delay before retrying or raises."""
+    error = classify(exc)
+    breaker.record_failure(error)
+    if not error.retryable or attempt >= MAX_RETRIES:
+        _count('failures')
+        raise error from exc
+    _count('retries')
+    return _backoff(attempt, error)
+
+
+def call(fn: Callable[[], Any], tokens: int = 0) -> Any:
+    """Run `fn` (one API request) with pacing, circuit breaking and retries.
+    `tokens` is the estimated prompt + completion size for the TPM bucket."""
+    _count('calls')
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            _count('rejected')
+            raise
+        time.sleep(_pace(tokens))
+        try:
+            result = fn()
+        except Exception as exc:
+            time.sleep(_attempt_failed(exc, attempt))
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
+
+
+async def acall(fn: Callable[[], Awaitable[Any]], tokens: int = 0) -> Any:
+    """Async version of call(); `fn` returns a fresh awaitable per attempt."""
+    _count('calls')
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            _count('rejected')
+            raise
+        await asyncio.sleep(_pace(tokens))
+        try:
+            result = await fn()
+        except Exception as exc:
+            await asyncio.sleep(_attempt_failed(exc, attempt))
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
+
+
+def estimate_tokens(messages, max_tokens: int) -> int:
+    # about 4 characters per token, plus the completion budget
+    return sum(len(m.get('content') or '') for m in messages) // 4 + max_tokens
@@ -0,0 +1,154 @@
+"""
+Expected shapes of parsed LLM responses, per task.
+
+validate(task, value) returns the value normalized to the shape the rest of
+the app stores and renders, or None when it cannot be (the caller then falls
+back to keeping the raw text). Normalization covers the usual near misses:
+a bare list of categories, a single task object, a tasks list wrapped in an
+object, numbers sent as strings, missing optional fields.
+
+    categorize  {"categories": [str], "confidence": float 0-1, "notes": str}
+    extract     [{"task": str, "assignee": str, "due": str, "context": str}]
+    analyze     categorize fields + "tasks": extract list
+    draft       {"subject": str, "body": str, "followups": [str]}
+
+The same shapes as TypedDicts (Categories, Task, Analysis, Draft) and as JSON
+Schemas for the API's structured outputs mode (response_format(task, mode));
+the extract schema wraps the list in {"tasks": [...]}, since a schema's top
+level must be an object.
+"""
+from typing import Any, Dict, List, Optional, TypedDict
+
+TASK_FIELDS = ('assignee', 'due', 'context')
+
+
+class Categories(TypedDict, total=False):
+    categories: List[str]
+    confidence: Optional[float]
+    notes: str
+
+
+class Task(TypedDict):
+    task: str
+    assignee: str
+    due: str
+    context: str
+
+
+class Analysis(Categories, total=False):
+    tasks: List[Task]
+
+
+class Draft(TypedDict):
+    subject: str
+    body: str
+    followups: List[str]
+
+
+def _object(**properties) -> Dict[str, Any]:
+    # strict structured outputs: every property required, nothing else allowed
+    return {'type': 'object', 'properties': properties, 'required': list(properties), 'additionalProperties': False}
+
+
+_STRING = {'type': 'string'}
+_STRINGS = {'type': 'array', 'items': _STRING}
+_TASK_SCHEMA = _object(task=_STRING, assignee=_STRING, due=_STRING, context=_STRING)
+_CATEGORY_FIELDS = {'categories': _STRINGS, 'confidence': {'type': 'number'}, 'notes': _STRING}
+_TASKS = {'type': 'array', 'items': _TASK_SCHEMA}
+
+JSON_SCHEMAS = {
+    'categorize': _object(**_CATEGORY_FIELDS),
+    'extract': _object(tasks=_TASKS),
+    'analyze': _object(**_CATEGORY_FIELDS, tasks=_TASKS),
+    'draft': _object(subject=_STRING, body=_STRING, followups=_STRINGS),
+}
+
+
+def _text(value) -> str:
+    return value.strip() if isinstance(value, str) else ('' if value is None else str(value))
+
+
+def categories(value: Any) -> Optional[Categories]:
+    if isinstance(value, list):
+        value = {'categories': value}
+    if not isinstance(value, dict):
+        return None
+    cats = value.get('categories', value.get('category'))
+    if isinstance(cats, str):
+        cats = [cats]
+    if not isinstance(cats, list) or not all(isinstance(c, str) for c in cats):
+        return None
+    out = {k: v for k, v in value.items() if k != 'category'}
+    out['categories'] = [c.strip() for c in cats if c.strip()]
+    if 'confidence' in value:
+        try:
+            out['confidence'] = min(1.0, max(0.0, float(value['confidence'])))
+        except (TypeError, ValueError):
+            out['confidence'] = None
+    if 'notes' in value:
+        out['notes'] = _text(value['notes'])
+    return out
+
+
+def tasks(value: Any) -> Optional[List[Task]]:
+    if isinstance(value, dict):
+        if 'task' in value:
+            value = [value]
+        else:
+            value = value.get('tasks', value.get('action_items'))
+    if not isinstance(value, list):
+        return None
+    out = []
+    for item in value:
+        if isinstance(item, str):
+            item = {'task': item}
+        if not isinstance(item, dict) or not _text(item.get('task')):
+            continue
+        out.append({**item, 'task': _text(item['task']), **{f: _text(item.get(f)) for f in TASK_FIELDS}})
+    # a non-empty list where nothing looked like a task is not a tasks list
+    return out if out or not value else None
+
+
+def analysis(value: Any) -> Optional[Analysis]:
+    out = categories(value) if isinstance(value, dict) else None
+    if out is None:
+        return None
+    out['tasks'] = tasks(value.get('tasks') or []) or []
+    return out
+
+
+def draft(value: Any) -> Optional[Draft]:
+    if not isinstance(value, dict) or not isinstance(value.get('body'), str):
+        return None
+    followups = value.get('followups') or []
+    if isinstance(followups, str):
+        followups = [followups]
+    return {**value, 'subject': _text(value.get('subject')), 'body': value['body'],
+            'followups': [_text(f) for f in followups if _text(f)] if isinstance(followups, list) else []}
+
+
+_VALIDATORS = {'categorize': categories, 'extract': tasks, 'analyze': analysis, 'draft': draft}
+
+
+def validate(task: str, value: Any) -> Any:
+    """`value` in the shape expected for `task`, or None; other tasks pass through."""
+    validator = _VALIDATORS.get(task)
+    if validator is None:
+        return value
+    valid = validator(value)
+    # {"result": {...}}: the expected value under a single wrapper key
+    if valid is None and isinstance(value, dict) and len(value) == 1:
+        inner = next(iter(value.values()))
+        if isinstance(inner, (dict, list)):
+            valid = validator(inner)
+    return valid
+
+
+def response_format(task: str, mode: str) -> Optional[Dict[str, Any]]:
+    """`response_format` request parameter for `task`: a strict JSON schema
+    ('json_schema'), plain JSON mode ('json_object'), or None."""
+    if mode == 'json_schema' and task in JSON_SCHEMAS:
+        return {'type': 'json_schema', 'json_schema': {'name': task, 'strict': True, 'schema': JSON_SCHEMAS[task]}}
+    if mode in ('json_schema', 'json_object') and task in _VALIDATORS:
+        return {'type': 'json_object'}
+    return None
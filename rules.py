@@ -0,0 +1,210 @@
+"""
+Deterministic pre-LLM classifier for obvious bulk mail.
+
+classify(email) runs before categorize/extract_actions and returns the
+categories for emails it is sure about (Newsletter, Spam, Promo, Alert), so
+they are saved without a model call; everything else returns None and goes
+to the LLM as before.
+
+Two kinds of rules:
+- user rules from the `classifier_rules` table (field sender/subject/body,
+  a pattern, a category): always win, confidence 1.0. Sender patterns are
+  globs ("*@spammy.io", "newsletter@*"), subject and body patterns are
+  case-insensitive substrings.
+- built-in signals (List-Unsubscribe / Precedence / Auto-Submitted headers,
+  automated sender addresses, keyword and URL heuristics) with weights that
+  add up per category. A category is only assigned at RULES_MIN_CONFIDENCE
+  (default 0.9). An email that asks the reader to act ("could you",
+  "please review", "by Friday") is never given a bulk category
+  (Newsletter, Promo, Alert), whatever its headers say, so it reaches the
+  model.
+
+Counters (stats()) show how many emails, and model calls, were avoided.
+
+Functions:
+- classify(email, llm_calls=1), score(email)
+- list_rules(), add_rule(field, pattern, category), delete_rule(rule_id)
+- stats()
+"""
+import email.utils
+import fnmatch
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import db
+
+ENABLED = os.getenv('RULES_DISABLED', '').lower() not in ('1', 'true', 'yes')
+MIN_CONFIDENCE = float(os.getenv('RULES_MIN_CONFIDENCE', '0.9'))
+# user rules are re-read from SQLite at most this often (seconds), so rules
+# added by another process are picked up
+RELOAD_INTERVAL = 10.0
+
+CATEGORIES = ('Newsletter', 'Spam', 'Promo', 'Alert')
+FIELDS = ('sender', 'subject', 'body')
+
+_AUTOMATED_SENDER = re.compile(
+    r'^(?:no-?reply|do-?not-?reply|notifications?|notify|alerts?|newsletters?|news|digest|updates|mailer'
+    r'|marketing|offers|deals|promo(?:tions)?|info|hello|bounce)\b', re.I)
+_IP_URL = re.compile(r'https?://\d{1,3}(?:\.\d{1,3}){3}', re.I)
+# asks something of the reader: not bulk mail, whatever else it looks like
+_REQUEST = re.compile(
+    r"\b(?:could|can|would|will) you\b|\bplease (?:review|confirm|send|approve|update|revise|reply|let (?:me|us) know|investigate)\b"
+    r'|\bby (?:monday|tuesday|wednesday|thursday|friday|tomorrow|eod|end of day)\b', re.I)
+
+# (category, weight, description, field, pattern); field 'text' is subject + body
+_SIGNALS: List[Tuple[str, float, str, str, re.Pattern]] = [
+    ('Newsletter', 0.5, 'newsletter wording', 'text', re.compile(
+        r'\b(?:newsletter|digest|weekly (?:update|roundup|recap)|monthly (?:update|roundup|recap)|top stories'
+        r'|this week in|edition|issue #?\d+|view (?:it )?in (?:your )?browser)\b', re.I)),
+    ('Promo', 0.5, 'promotional wording', 'text', re.compile(
+        r'\d+\s?% off|\b(?:sale|deals?|discount|coupon|promo code|black friday|cyber monday|limited[- ]time'
+        r'|free shipping|exclusive (?:offer|access)|shop now|buy now)\b', re.I)),
+    ('Spam', 0.6, 'prize or scam wording', 'text', re.compile(
+        r"\b(?:you(?:'ve| have)? won|winner|claim your (?:reward|prize)|lottery|jackpot|inheritance|wire transfer"
+        r'|crypto(?:currency)? (?:giveaway|opportunity)|act now|risk[- ]free|100% free)\b', re.I)),
+    ('Spam', 0.2, 'shouting subject', 'subject', re.compile(r'!!|\$\$|^[^a-z]{12,}$')),
+    ('Spam', 0.3, '"click here" link', 'body', re.compile(r'\bclick here\b', re.I)),
+    ('Alert', 0.5, 'notification wording', 'text', re.compile(
+        r'\b(?:security alert|new sign-?in|verification code|password (?:reset|changed)|login attempt'
+        r'|new followers?|(?:mentioned|tagged) you|your (?:order|package) (?:has )?shipped|receipt for)\b', re.I)),
+]
+_BULK_CATEGORIES = ('Newsletter', 'Promo', 'Alert')
+
+_lock = threading.Lock()
+_counters: Dict[str, Any] = {'emails': 0, 'classified': 0, 'forwarded': 0, 'llm_calls_avoided': 0,
+                             'user_rules': 0, 'by_category': {}}
+_user_rules: List[Dict[str, Any]] = []
+_loaded_at = 0.0
+
+
+def _address(sender: str) -> str:
+    return (email.utils.parseaddr(sender or '')[1] or sender or '').lower()
+
+
+def _load_rules() -> List[Dict[str, Any]]:
+    global _user_rules, _loaded_at
+    if time.monotonic() - _loaded_at > RELOAD_INTERVAL:
+        try:
+            _user_rules = db.get_classifier_rules()
+        except Exception:
+            pass  # keep the last known rules
+        _loaded_at = time.monotonic()
+    return _user_rules
+
+
+def _user_rule(em: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    sender = _address(em.get('sender'))
+    for rule in _load_rules():
+        pattern = rule['pattern'].lower()
+        if rule['field'] == 'sender':
+            matched = fnmatch.fnmatchcase(sender, pattern)
+        else:
+            matched = pattern in (em.get(rule['field']) or '').lower()
+        if matched:
+            return rule
+    return None
+
+
+def score(em: Dict[str, Any]) -> Dict[str, Tuple[float, List[str]]]:
+    """Built-in signal scores per category: {category: (score, reasons)}."""
+    subject = em.get('subject') or ''
+    body = em.get('body') or ''
+    fields = {'subject': subject, 'body': body, 'text': f'{subject}\n{body}'}
+    scores: Dict[str, Tuple[float, List[str]]] = {}
+
+    def add(categories, weight, reason):
+        for c in categories:
+            total, reasons = scores.get(c, (0.0, []))
+            scores[c] = (total + weight, reasons + [reason])
+
+    if em.get('list_unsubscribe'):
+        add(_BULK_CATEGORIES, 0.5, 'List-Unsubscribe header')
+    if (em.get('precedence') or '').strip().lower() in ('bulk', 'list', 'junk'):
+        add(_BULK_CATEGORIES, 0.4, f"Precedence: {em['precedence'].strip()}")
+    if (em.get('auto_submitted') or 'no').strip().lower() != 'no':
+        add(('Alert',), 0.4, 'Auto-Submitted header')
+    local = _address(em.get('sender')).partition('@')[0]
+    if _AUTOMATED_SENDER.match(local):
+        add(_BULK_CATEGORIES, 0.4, f'automated sender "{local}@"')
+    for category, weight, reason, field, pattern in _SIGNALS:
+        if pattern.search(fields[field]):
+            add((category,), weight, reason)
+    if _IP_URL.search(body):
+        add(('Spam',), 0.4, 'link to a bare IP address')
+    if _REQUEST.search(fields['text']):
+        # a veto, not a penalty: bulk headers alone can outweigh any penalty
+        for c in _BULK_CATEGORIES:
+            scores.pop(c, None)
+    return scores
+
+
+def _count(result: Optional[Dict[str, Any]], llm_calls: int, user_rule: bool = False):
+    with _lock:
+        _counters['emails'] += 1
+        if result is None:
+            _counters['forwarded'] += 1
+            return
+        _counters['classified'] += 1
+        _counters['llm_calls_avoided'] += llm_calls
+        _counters['user_rules'] += int(user_rule)
+        category = result['categories'][0]
+        _counters['by_category'][category] = _counters['by_category'].get(category, 0) + 1
+
+
+def classify(em: Dict[str, Any], llm_calls: int = 1) -> Optional[Dict[str, Any]]:
+    """Categories for `em` (an email dict: sender, subject, body and the
+    bulk-mail headers) when a rule is confident, else None. `llm_calls` is
+    what the email would cost otherwise, for the counters."""
+    if not ENABLED or not em:
+        return None
+    rule = _user_rule(em)
+    if rule is not None:
+        result = {'categories': [rule['category']], 'confidence': 1.0, 'source': 'rules',
+                  'notes': f"User rule #{rule['id']}: {rule['field']} matches \"{rule['pattern']}\"."}
+        _count(result, llm_calls, user_rule=True)
+        return result
+    scores = score(em)
+    result = None
+    if scores:
+        category, (total, reasons) = max(scores.items(), key=lambda kv: kv[1][0])
+        if round(total, 2) >= MIN_CONFIDENCE:
+            result = {'categories': [category], 'confidence': round(min(total, 0.99), 2), 'source': 'rules',
+                      'notes': 'Rules: ' + ', '.join(reasons) + '.'}
+    _count(result, llm_calls)
+    return result
+
+
+def list_rules() -> List[Dict[str, Any]]:
+    return db.get_classifier_rules()
+
+
+def add_rule(field: str, pattern: str, category: str) -> Dict[str, Any]:
+    """Store a user rule; raises ValueError for an unknown field or an empty pattern."""
+    global _loaded_at
+    field = (field or '').strip().lower()
+    pattern = (pattern or '').strip()
+    category = (category or '').strip()
+    if field not in FIELDS:
+        raise ValueError(f'field must be one of {", ".join(FIELDS)}')
+    if not pattern or not category:
+        raise ValueError('pattern and category are required')
+    rule_id = db.add_classifier_rule(field, pattern, category)
+    _loaded_at = 0.0
+    return {'id': rule_id, 'field': field, 'pattern': pattern, 'category': category}
+
+
+def delete_rule(rule_id: int) -> bool:
+    global _loaded_at
+    deleted = db.delete_classifier_rule(rule_id)
+    _loaded_at = 0.0
+    return deleted
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        out = dict(_counters, by_category=dict(_counters['by_category']))
+    out['share_classified'] = out['classified'] / out['emails'] if out['emails'] else 0.0
+    return out